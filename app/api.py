@@ -1,20 +1,28 @@
 from fastapi import FastAPI, HTTPException, Response, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel, Field, model_validator
 from contextlib import asynccontextmanager
-from typing import Optional, Any, Dict
+from typing import Optional, Any, Dict, List, Union
+from datetime import date
 import os
+import asyncio
 from time import perf_counter
 import logging
 from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
-from opensearchpy import OpenSearch
+from app.os_index import get_os_client, close_os_client
 
 from app.config import get_settings
 from app.schemas import ClassifyResponse, HealthResponse
 from app.metrics import REQUESTS, LATENCY
-from app.generator_gemini import generate_label, generate_followup_answer
+from app.generator_gemini import generate_label, generate_followup_answer, PROMPT_DOCS
+from app.embeddings import get_embedder
 from app.os_retrieval import retrieve_support_for_code  # si implementaste esta función
-from app.os_retrieval import hybrid_search_with_fallback
+from app.os_retrieval import hybrid_search_with_fallback, build_filters, hydrate_hits
+from app.os_retrieval import candidate_codes, prefetch_support, match_prefetched
+from app.index_state import IndexReadiness, KnnWarmup
+from app.response_cache import build_response_cache, is_cacheable
+from app.local_ann import get_local_ann
 
 # Configuración del logger
 logger = logging.getLogger("tariff_rag.api")
@@ -28,17 +36,12 @@ async def lifespan(app: FastAPI):
     settings = get_settings()
     logger.info(f"[Startup] API iniciada. OpenSearch host: {settings.opensearch_host}")
 
-    # Inicializar OpenSearch y guardarlo en app.state
+    # Inicializar OpenSearch (cliente compartido con pool afinado) y guardarlo en app.state
     try:
-        client = OpenSearch(
-            hosts=[settings.opensearch_host],
-            http_auth=None,           # agrega auth si la defines en Settings
-            verify_certs=False,
-            timeout=10,
-        )
+        client = get_os_client()
         # Chequeo liviano
         try:
-            health = client.cluster.health()
+            health = client.cluster.health(request_timeout=settings.opensearch_health_timeout)
             logger.info(f"OpenSearch OK: {health.get('status')} (nodes={health.get('number_of_nodes')})")
         except Exception as e:
             logger.exception("OpenSearch health check failed: %s", e)
@@ -49,14 +52,41 @@ async def lifespan(app: FastAPI):
         app.state.os_client = None
         app.state.index_name = None
 
+    # Validar índice/mapping una sola vez; la deriva de mapping aborta el arranque
+    app.state.index_readiness = None
+    if app.state.os_client is not None:
+        readiness = IndexReadiness(app.state.os_client, app.state.index_name)
+        state = readiness.refresh(raise_on_drift=True)
+        if state.ready:
+            logger.info(f"Índice {state.name} listo (generación: {state.generation})")
+        app.state.index_readiness = readiness
+
+    # k-NN warmup en segundo plano; /health responde 503 hasta que termina. Si el
+    # cluster no responde en el arranque, se lanza con el primer refresh exitoso
+    app.state.knn_warmup = KnnWarmup(app.state.os_client, app.state.index_name)
+    if app.state.index_readiness is None:
+        app.state.knn_warmup.skip("OpenSearch no configurado")
+    else:
+        warmup = app.state.knn_warmup
+        app.state.index_readiness.on_ready = lambda state: warmup.start()
+        if app.state.index_readiness.state.ready:
+            warmup.start()
+
+    # Índice kNN local (memory-map) del bucket caliente, si LOCAL_ANN_PATH está configurado
+    local_ann = get_local_ann()
+    if local_ann is not None:
+        logger.info(f"Índice kNN local: {len(local_ann)} vectores ({settings.local_ann_bucket})")
+
+    # Caché de respuestas de /classify (exacta + casi-duplicados)
+    app.state.response_cache = build_response_cache()
+
     # Lifespan activo
     try:
         yield
     finally:
         # Liberar recursos si aplica
         try:
-            if getattr(app.state, "os_client", None):
-                app.state.os_client.close()
+            close_os_client()
         except Exception:
             pass
         logger.info("[Shutdown] Liberando recursos...")
@@ -98,12 +128,21 @@ async def prometheus_instrumentation(request: Request, call_next):
             pass
 
 # === REQUEST MODEL CON VALIDACIONES ===
+class ClassifyFilters(BaseModel):
+    """Pre-filtros de metadatos (un valor o lista por campo)"""
+    bucket: Optional[Union[str, List[str]]] = Field(None, description="Ej: ASGARD, HS_NOTES")
+    edition: Optional[Union[str, List[str]]] = Field(None, description="Ej: HS_2022")
+    chapter: Optional[Union[str, List[str]]] = None
+    hs6: Optional[Union[str, List[str]]] = None
+    valid_at: Optional[date] = Field(None, description="Solo fragmentos vigentes en esta fecha")
+
 class ClassifyRequest(BaseModel):
     text: Optional[str] = Field(None, description="Query text (legacy)", max_length=4000)
     query: Optional[str] = Field(None, description="Query text (preferred)", max_length=4000)
     top_k: int = Field(default=5, ge=1, le=20)
     file_url: Optional[str] = Field(None, description="Optional file URL for context")
     debug: bool = Field(default=False, description="Enable debug mode")
+    filters: Optional[ClassifyFilters] = Field(None, description="Metadata pre-filters for retrieval")
 
     @model_validator(mode='after')
     def check_query_provided(self):
@@ -135,22 +174,28 @@ def read_root():
     }
 
 @app.get("/health", response_model=HealthResponse, tags=["Health"])
-def health_check():
-    """Health check completo: verifica OpenSearch, MySQL y configuración de Gemini"""
+def health_check(request: Request, response: Response):
+    """Health check completo: verifica OpenSearch, MySQL y configuración de Gemini.
+    503 con status "warming" mientras el k-NN warmup del arranque no termina."""
     settings = get_settings()
     status = {"status": "ok", "services": {}}
 
-    # OpenSearch
+    warmup = getattr(request.app.state, "knn_warmup", None)
+    if warmup is not None:
+        status["services"]["knn_warmup"] = warmup.as_dict()
+
+    # Índice (estado cacheado; solo re-valida si no está listo, lo que además
+    # lanza el k-NN warmup pendiente cuando el cluster vuelve)
+    readiness = getattr(request.app.state, "index_readiness", None)
+    if readiness is not None:
+        index_state = readiness.get()
+        status["services"]["index"] = {"status": "ok" if index_state.ready else "fail",
+                                       **index_state.as_dict()}
+
+    # OpenSearch (cliente compartido de app.state; sin handshake nuevo por chequeo)
     try:
-        from opensearchpy import OpenSearch
-        client = OpenSearch(
-            hosts=[settings.opensearch_host],
-            http_auth=None,
-            use_ssl=False,
-            verify_certs=False,
-            timeout=5
-        )
-        cluster_health = client.cluster.health()
+        client = getattr(request.app.state, "os_client", None) or get_os_client()
+        cluster_health = client.cluster.health(request_timeout=settings.opensearch_health_timeout)
         status["services"]["opensearch"] = {
             "status": "ok",
             "cluster_name": cluster_health.get("cluster_name"),
@@ -187,6 +232,12 @@ def health_check():
     if not gemini_key_present:
         status["status"] = "degraded"
 
+    if warmup is not None and not warmup.ready:
+        status["status"] = "warming"
+        response.status_code = 503
+    elif warmup is not None and warmup.status == "failed":
+        status["status"] = "degraded"
+
     # Azure Document Intelligence
     azure_fr_configured = bool(settings.azure_formrec_endpoint and settings.azure_formrec_key)
     status["services"]["azure_di"] = {
@@ -196,8 +247,18 @@ def health_check():
 
     return status
 
+async def _embed_query_or_none(query_text: str):
+    """Embedding de la consulta sin ocupar un worker del threadpool.
+    None si el embedder no está disponible; /classify busca entonces solo con
+    BM25 (skip_knn) sin volver a llamar al embedder."""
+    try:
+        return await get_embedder().embed_query_async(query_text)
+    except Exception as e:
+        logger.warning(f"Query embedding failed: {e}")
+        return None
+
 @app.post("/classify", response_model=ClassifyResponse)
-def classify_endpoint(req: ClassifyRequest, fastapi_request: Request):
+async def classify_endpoint(req: ClassifyRequest, fastapi_request: Request, response: Response):
     try:
         os_client = getattr(fastapi_request.app.state, "os_client", None)
         index_name = getattr(fastapi_request.app.state, "index_name", None)
@@ -220,15 +281,61 @@ def classify_endpoint(req: ClassifyRequest, fastapi_request: Request):
                 versions={"hs_edition": "HS_2022"}
             )
 
-        # 1) retrieval con fallback
-        try:
-            hits = hybrid_search_with_fallback(os_client, index_name, query_text, k=req.top_k or 5) or []
-        except Exception as e:
-            logger.warning(f"Retrieval failed: {e}. Using empty hits.")
-            hits = []
+        # Estado del índice cacheado; solo consulta el cluster si se invalidó o venció el TTL
+        readiness = getattr(fastapi_request.app.state, "index_readiness", None)
+        index_state = await run_in_threadpool(readiness.get) if readiness is not None else None
+        if index_state is not None and index_state.mapping_mismatch:
+            raise HTTPException(status_code=503, detail="Search index mapping does not match settings")
+
+        # Caché de respuestas: exacta antes de embeber, casi-duplicados con el vector de consulta
+        cache = getattr(fastapi_request.app.state, "response_cache", None)
+        cache_key = None
+        if cache is not None:
+            generation = index_state.generation if index_state is not None else ""
+            cache.check_generation(generation)
+            scope = req.filters.model_dump_json(exclude_none=True) if req.filters else ""
+            cache_key = cache.make_key(query_text, req.top_k, generation, scope)
+            cached = cache.get(cache_key)
+            if cached is not None:
+                response.headers["X-Classify-Cache"] = "exact"
+                return ClassifyResponse(**cached)
+
+        # 1) retrieval con fallback (el embedding se espera de forma asíncrona)
+        query_vector = await _embed_query_or_none(query_text)
+        if cache is not None:
+            cached = cache.get_similar(cache_key, query_vector)
+            if cached is not None:
+                response.headers["X-Classify-Cache"] = "semantic"
+                return ClassifyResponse(**cached)
+        hits = []
+        if index_state is None or index_state.ready:
+            try:
+                hits = await run_in_threadpool(
+                    hybrid_search_with_fallback, os_client, index_name, query_text,
+                    k=req.top_k or 5, query_vector=query_vector,
+                    filters=build_filters(**req.filters.model_dump()) if req.filters else None,
+                    skip_knn=query_vector is None,
+                ) or []
+            except Exception as e:
+                logger.warning(f"Retrieval failed: {e}. Using empty hits.")
+                if readiness is not None:
+                    readiness.invalidate(f"retrieval error: {e.__class__.__name__}")
+        else:
+            logger.warning(f"Index not ready ({index_state.error}). Using empty hits.")
 
-        # 2) generación (asegúrate dict)
-        result_dict = generate_label(query=query_text, context_docs=hits, max_candidates=req.top_k or 3)
+        # Modo pipeline: la evidencia de los códigos ya visibles en los hits se busca
+        # en paralelo con la generación; al terminar solo se une (o se corrige)
+        settings = get_settings()
+        prefetch = None
+        codes = candidate_codes(hits, settings.classify_prefetch_codes) if settings.classify_pipelined else []
+        if codes:
+            prefetch = asyncio.create_task(run_in_threadpool(prefetch_support, os_client, index_name, codes, 3))
+
+        # 2) generación (asegúrate dict); texto completo solo para los hits del prompt,
+        # la evidencia devuelta conserva los snippets
+        prompt_hits = [{**h, "_source": dict(h.get("_source") or {})} for h in hits[:PROMPT_DOCS]]
+        prompt_hits = await run_in_threadpool(hydrate_hits, os_client, index_name, prompt_hits, PROMPT_DOCS)
+        result_dict = await run_in_threadpool(generate_label, query=query_text, context_docs=prompt_hits, max_candidates=req.top_k or 3)
         if not isinstance(result_dict, dict):
             result_dict = result_dict.dict() if hasattr(result_dict, "dict") else {}
 
@@ -256,15 +363,33 @@ def classify_endpoint(req: ClassifyRequest, fastapi_request: Request):
         if isinstance(cands, list) and cands:
             main_code = cands[0].get("code") or cands[0].get("hs_code")
 
-        result_dict["support_evidence"] = []
-        if main_code:
+        prefetched = {}
+        if prefetch is not None:
             try:
-                result_dict["support_evidence"] = retrieve_support_for_code(os_client, index_name, main_code, k=3) or []
+                prefetched = await prefetch
             except Exception:
-                logger.exception("support_evidence retrieval failed")
-                result_dict["support_evidence"] = []
+                logger.exception("support_evidence prefetch failed")
+
+        result_dict["support_evidence"] = []
+        if main_code:
+            support = match_prefetched(prefetched, main_code)
+            if support is None:
+                # Búsqueda correctiva: el LLM eligió un código no presente en los hits
+                try:
+                    support = await run_in_threadpool(
+                        retrieve_support_for_code, os_client, index_name, main_code, k=3
+                    )
+                except Exception:
+                    logger.exception("support_evidence retrieval failed")
+            result_dict["support_evidence"] = support or []
 
-        return ClassifyResponse(**result_dict)
+        out = ClassifyResponse(**result_dict)
+        # Solo se cachean respuestas completas (ver response_cache.is_cacheable)
+        if cache is not None and is_cacheable(result_dict, hits, query_vector):
+            cache.set(cache_key, out.model_dump(), query_vector)
+        if cache is not None:
+            response.headers["X-Classify-Cache"] = "miss"
+        return out
 
     except HTTPException:
         raise
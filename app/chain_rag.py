@@ -27,9 +27,9 @@ except Exception:
 
 # Embeddings (opcional)
 try:
-    from .embedder_gemini import GeminiEmbedder as _GeminiEmbedder
+    from .embeddings import get_embedder as _get_shared_embedder
 except Exception:
-    _GeminiEmbedder = None
+    _get_shared_embedder = None
 
 # Retriever (opcional)
 try:
@@ -48,14 +48,9 @@ except Exception:
 logger = logging.getLogger(__name__)
 settings = get_settings()
 
-# Estado global simple para el embedder
-_embedder = None
-
 def _get_embedder():
-    global _embedder
-    if _embedder is None and _GeminiEmbedder is not None:
-        _embedder = _GeminiEmbedder()
-    return _embedder
+    # Embedder compartido por proceso (ver embeddings.get_embedder)
+    return _get_shared_embedder() if _get_shared_embedder is not None else None
 
 def classify(
     text: str,
@@ -11,6 +11,31 @@ class Settings(BaseSettings):
     opensearch_index: str = "tariff_fragments"
     opensearch_knn_space: str = "cosinesimil"
     opensearch_emb_dim: int = 768
+    # Cliente compartido: conexiones keep-alive por host (>= hilos que buscan a la vez:
+    # threadpool de la API + pool híbrido), compresión gzip y timeouts por llamada
+    opensearch_pool_maxsize: int = 48
+    opensearch_http_compress: bool = True
+    opensearch_timeout: float = 10.0
+    opensearch_health_timeout: float = 3.0
+    opensearch_max_retries: int = 2
+    # Almacenamiento del knn_vector: float | fp16 | byte (ver app/quantization.py)
+    opensearch_vector_mode: str = "float"
+    # Perfil HNSW: latency | balanced | recall (ver app/quantization.py; m/ef_construction exigen recrear el índice)
+    opensearch_index_profile: str = "balanced"
+    # Motor HNSW del modo float ("" = el del perfil, faiss). nmslib solo para índices creados antes:
+    # no admite filtros dentro del kNN (post-filtro o kNN exacto, ver os_retrieval._knn_body)
+    opensearch_knn_engine: str = ""
+    # Códigos HS vía term sobre 'hs_codes' (False = match_phrase por variantes); si el índice no tiene
+    # el campo (sin reindexar) la API vuelve sola a las variantes (index_state.validate_index)
+    opensearch_hs_codes_field: bool = True
+    # Si el embedder entrega más dims que opensearch_emb_dim: truncate | pca
+    embed_reduction: str = "truncate"
+    embed_pca_path: str = "storage/embed_pca.npz"
+    # k-NN warmup (carga de grafos HNSW en memoria nativa) tras el arranque y las ingestas
+    knn_warmup_enabled: bool = True
+    knn_warmup_timeout: float = 300.0
+    # Segundos entre re-validaciones del mapping/alias del índice en la API (0 = solo tras errores)
+    index_state_ttl: float = 300.0
 
     # MySQL
     mysql_host: str = "mysql"
@@ -28,6 +53,26 @@ class Settings(BaseSettings):
     gemini_top_k: int = 40
     gemini_max_output_tokens: int = 2048
 
+    # Backend de embeddings: "gemini" (API) | "hashing" (local, CPU, sin red)
+    embed_backend: str = "gemini"
+
+    # Caché persistente de embeddings (vacío = desactivada)
+    embed_cache_path: str = "storage/embed_cache.sqlite"
+    embed_cache_max_entries: int = 500_000
+    # LRU en memoria de vectores de consulta
+    query_vec_cache_size: int = 2048
+    query_vec_cache_ttl: float = 3600.0
+    # Cola de re-embedding para fragmentos cuyo embedding falló
+    reembed_queue_path: str = "storage/reembed_queue.sqlite"
+    reembed_max_attempts: int = 5
+    # Segundos de espera tras el primer fallo; se duplica en cada intento
+    reembed_retry_backoff: float = 60.0
+    # Caché de respuestas de /classify (0 = desactivada); threshold = coseno mínimo
+    # para reutilizar la respuesta de una consulta casi idéntica (>1 desactiva ese nivel)
+    classify_cache_size: int = 512
+    classify_cache_ttl: float = 900.0
+    classify_cache_threshold: float = 0.97
+
     # Azure Form Recognizer
     azure_formrec_endpoint: str | None = None
     azure_formrec_key: str | None = None
@@ -38,6 +83,47 @@ class Settings(BaseSettings):
     min_evidence: int = 2
     min_score: float = 0.35
 
+    # Búsqueda híbrida (RRF sobre BM25 + kNN)
+    hybrid_rrf_k: int = 60
+    hybrid_bm25_weight: float = 1.0
+    hybrid_knn_weight: float = 1.0
+    hybrid_bm25_depth: int = 20
+    hybrid_knn_depth: int = 20
+    # nmslib con filtros: kNN exacto si el subconjunto filtrado tiene <= N docs;
+    # si no, kNN aproximado con k * oversample vecinos y post-filtro
+    knn_exact_max_docs: int = 20000
+    knn_filter_oversample: int = 10
+    # Con el vector de consulta ya calculado, BM25 + kNN en un único _msearch
+    hybrid_msearch: bool = True
+    # Segunda etapa (app/rerank.py): pool por lado, pesos de features y priors
+    # por bucket como JSON, p. ej. {"asgard_products": 0.1}
+    rerank_enabled: bool = True
+    rerank_pool: int = 50
+    rerank_w_rrf: float = 1.0
+    rerank_w_hs: float = 0.6
+    rerank_w_overlap: float = 0.4
+    rerank_w_cosine: float = 0.6
+    rerank_bucket_priors: str = ""
+    # Índice vectorial en proceso (app/local_ann.py) para un bucket caliente;
+    # vacío = desactivado. Sirve el lado kNN cuando los filtros se limitan a ese bucket.
+    local_ann_path: str = ""
+    local_ann_bucket: str = "asgard_products"
+    local_ann_ivf_min_rows: int = 20000
+    local_ann_nprobe: int = 8
+    # Hits de /classify con snippet (highlight) de N caracteres en vez del 'text'
+    # completo; 0 = texto completo. El prompt rehidrata solo sus fragmentos.
+    # Otros llamadores de hybrid_search (LangChain, evaluación) reciben el texto completo.
+    retrieval_snippet_chars: int = 300
+    # /classify: precarga la evidencia de los códigos HS de los hits mientras genera Gemini
+    classify_pipelined: bool = True
+    classify_prefetch_codes: int = 3
+    # Caché en memoria de evidencia por código HS (retrieve_support_for_code)
+    support_cache_size: int = 1024
+    support_cache_ttl: float = 600.0
+    # Vocabulario de dominio por capítulo para BM25 (ver app/domain_terms.py)
+    domain_terms_path: str = ""
+    domain_default_chapters: str = "40"
+
     # lee .env fuera de Docker; en Docker vienen por env
     model_config = SettingsConfigDict(
         env_file=".env",
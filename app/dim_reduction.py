@@ -0,0 +1,95 @@
+"""
+app/dim_reduction.py
+Reducción de dimensión de embeddings antes de indexar/consultar.
+
+- truncate: estilo Matryoshka; conserva las primeras `dim` componentes y
+            renormaliza L2 (text-embedding-004 está entrenado para ello).
+- pca:      proyección PCA ajustada sobre el corpus y guardada como artefacto
+            .npz (mean, components); ver scripts/eval_dims.py --save-pca.
+
+La caché de embeddings guarda siempre el vector completo, de modo que
+cambiar OPENSEARCH_EMB_DIM no obliga a re-embeber, solo a re-indexar.
+"""
+import math
+from functools import lru_cache
+from typing import List, Sequence
+
+from app.config import get_settings
+
+REDUCTION_METHODS = ("truncate", "pca")
+
+
+def truncate_vector(vec: Sequence[float], dim: int) -> List[float]:
+    head = [float(v) for v in vec[:dim]]
+    norm = math.sqrt(sum(v * v for v in head))
+    return [v / norm for v in head] if norm > 0 else head
+
+
+class PCAProjection:
+    """Proyección lineal x -> (x - mean) @ components[:dim].T, normalizada L2."""
+
+    def __init__(self, mean, components):
+        import numpy as np
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.components = np.asarray(components, dtype=np.float32)
+
+    @property
+    def max_dim(self) -> int:
+        return int(self.components.shape[0])
+
+    def project_many(self, vectors, dim: int):
+        import numpy as np
+        if dim > self.max_dim:
+            raise ValueError(f"El artefacto PCA tiene {self.max_dim} componentes; se pidieron {dim}")
+        x = np.asarray(vectors, dtype=np.float32) - self.mean
+        y = x @ self.components[:dim].T
+        norms = np.linalg.norm(y, axis=1, keepdims=True)
+        return y / np.where(norms > 0, norms, 1.0)
+
+    def project(self, vec: Sequence[float], dim: int) -> List[float]:
+        return self.project_many([vec], dim)[0].tolist()
+
+    def save(self, path: str) -> None:
+        import numpy as np
+        from pathlib import Path
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        np.savez(path, mean=self.mean, components=self.components)
+
+    @classmethod
+    def fit(cls, vectors, n_components: int) -> "PCAProjection":
+        import numpy as np
+        x = np.asarray(vectors, dtype=np.float32)
+        mean = x.mean(axis=0)
+        # SVD de la matriz centrada: filas de vt = direcciones principales
+        _, _, vt = np.linalg.svd(x - mean, full_matrices=False)
+        return cls(mean, vt[:n_components])
+
+
+@lru_cache(maxsize=4)
+def load_pca(path: str) -> PCAProjection:
+    import numpy as np
+    data = np.load(path)
+    return PCAProjection(data["mean"], data["components"])
+
+
+def reduce_vector(vec: Sequence[float], dim: int, method: str = "truncate", pca_path: str | None = None) -> List[float]:
+    """Lleva `vec` a `dim` componentes; sin cambios si ya tiene esa dimensión."""
+    n = len(vec)
+    if n == dim:
+        return list(vec)
+    if n < dim:
+        raise ValueError(f"Embedding de {n} dims no alcanza OPENSEARCH_EMB_DIM={dim}")
+    m = (method or "truncate").strip().lower()
+    if m == "truncate":
+        return truncate_vector(vec, dim)
+    if m == "pca":
+        if not pca_path:
+            raise ValueError("EMBED_REDUCTION=pca requiere EMBED_PCA_PATH")
+        return load_pca(pca_path).project(vec, dim)
+    raise ValueError(f"EMBED_REDUCTION inválido: {method!r} (usa {', '.join(REDUCTION_METHODS)})")
+
+
+def reduce_for_index(vec: Sequence[float]) -> List[float]:
+    """reduce_vector con la dimensión/método de Settings."""
+    s = get_settings()
+    return reduce_vector(vec, int(s.opensearch_emb_dim), s.embed_reduction, s.embed_pca_path)
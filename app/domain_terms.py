@@ -0,0 +1,55 @@
+"""
+app/domain_terms.py
+Vocabulario de dominio por capítulo HS para los boosts léxicos de BM25.
+
+Por defecto solo el capítulo 40 (neumáticos/caucho), que era la lista fija
+histórica. DOMAIN_TERMS_PATH apunta a un JSON {"40": ["neumático", ...],
+"39": ["resina", ...]} que reemplaza/añade capítulos; DOMAIN_DEFAULT_CHAPTERS
+(coma-separado) son los capítulos usados cuando la consulta no trae código HS.
+"""
+import json
+from functools import lru_cache
+from typing import Dict, Iterable, Tuple
+
+from app.config import get_settings
+
+DEFAULT_DOMAIN_TERMS: Dict[str, Tuple[str, ...]] = {
+    "40": ("neumático", "neumáticos", "llanta", "llantas", "caucho",
+           "pneumatic", "tyre", "tyres", "tire", "tires"),
+}
+
+
+@lru_cache(maxsize=8)
+def load_domain_terms(path: str = "") -> Dict[str, Tuple[str, ...]]:
+    terms = dict(DEFAULT_DOMAIN_TERMS)
+    if path:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        for chapter, words in data.items():
+            terms[str(chapter).zfill(2)] = tuple(dict.fromkeys(str(w) for w in words if str(w).strip()))
+    return terms
+
+
+def chapter_of(code: str) -> str:
+    """'4011.10' -> '40'."""
+    digits = "".join(ch for ch in (code or "") if ch.isdigit())
+    return digits[:2]
+
+
+def default_chapters() -> Tuple[str, ...]:
+    raw = get_settings().domain_default_chapters or ""
+    return tuple(c.strip().zfill(2) for c in raw.split(",") if c.strip())
+
+
+def terms_for(chapters: Iterable[str]) -> Tuple[str, ...]:
+    """Términos de los capítulos dados (sin duplicados, en orden)."""
+    table = load_domain_terms(get_settings().domain_terms_path or "")
+    out: Dict[str, None] = {}
+    for ch in chapters:
+        for t in table.get(ch, ()):
+            out.setdefault(t, None)
+    return tuple(out)
+
+
+def has_terms(chapter: str) -> bool:
+    return chapter in load_domain_terms(get_settings().domain_terms_path or "")
@@ -0,0 +1,175 @@
+"""
+app/embed_cache.py
+Caché persistente (SQLite) de embeddings direccionada por contenido.
+
+Clave: (modelo de embeddings, sha256 del texto normalizado).
+Compartida por la ingesta (scripts/*) y las consultas de la API.
+
+Las lecturas no escriben: los aciertos se anotan en memoria y su last_used
+se vuelca a SQLite en la siguiente escritura (put_many, antes de expulsar)
+o al acumular TOUCH_FLUSH_MAX claves.
+"""
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from array import array
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from app.config import get_settings
+from app.metrics import EMBED_CACHE
+
+logger = logging.getLogger(__name__)
+
+# Claves leídas pendientes de actualizar last_used antes de forzar el volcado
+TOUCH_FLUSH_MAX = 10_000
+
+
+def normalize_for_key(text: str) -> str:
+    """Normaliza espacios para que variantes triviales compartan entrada."""
+    return " ".join((text or "").split())
+
+
+def text_key(text: str) -> str:
+    return hashlib.sha256(normalize_for_key(text).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """Almacén SQLite de vectores float32 con expulsión LRU acotada por tamaño."""
+
+    def __init__(self, path: str, max_entries: int = 500_000):
+        self.path = path
+        self.max_entries = max(1, int(max_entries))
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._touched: Dict[Tuple[str, str], float] = {}
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " model TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " dim INTEGER NOT NULL,"
+            " vec BLOB NOT NULL,"
+            " last_used REAL NOT NULL,"
+            " PRIMARY KEY (model, key))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used)")
+        self._conn.commit()
+
+    def get_many(self, model: str, texts: Sequence[str]) -> Dict[int, List[float]]:
+        """Devuelve {posición: vector} para los textos presentes en caché."""
+        if not texts:
+            return {}
+        keys = [text_key(t) for t in texts]
+        found: Dict[str, List[float]] = {}
+        unique = list(dict.fromkeys(keys))
+        with self._lock:
+            # SQLite limita la cantidad de parámetros por sentencia
+            for i in range(0, len(unique), 500):
+                chunk = unique[i:i + 500]
+                marks = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, vec FROM embeddings WHERE model = ? AND key IN ({marks})",
+                    [model, *chunk],
+                ).fetchall()
+                for k, blob in rows:
+                    found[k] = array("f", blob).tolist()
+            now = time.time()
+            for k in found:
+                self._touched[(model, k)] = now
+            if len(self._touched) >= TOUCH_FLUSH_MAX:
+                self._flush_touched_locked()
+                self._conn.commit()
+
+        out = {i: found[k] for i, k in enumerate(keys) if k in found}
+        hits = len(out)
+        self.hits += hits
+        self.misses += len(keys) - hits
+        EMBED_CACHE.labels(result="hit").inc(hits)
+        EMBED_CACHE.labels(result="miss").inc(len(keys) - hits)
+        return out
+
+    def put_many(self, model: str, texts: Sequence[str], vectors: Sequence[Sequence[float]]) -> None:
+        now = time.time()
+        rows = [
+            (model, text_key(t), len(v), array("f", v).tobytes(), now)
+            for t, v in zip(texts, vectors)
+        ]
+        if not rows:
+            return
+        with self._lock:
+            self._flush_touched_locked()
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, key, dim, vec, last_used) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._evict_locked()
+            self._conn.commit()
+
+    def _flush_touched_locked(self) -> None:
+        """Vuelca el last_used de las lecturas pendientes (sin commit)."""
+        if not self._touched:
+            return
+        self._conn.executemany(
+            "UPDATE embeddings SET last_used = ? WHERE model = ? AND key = ?",
+            [(ts, model, key) for (model, key), ts in self._touched.items()],
+        )
+        self._touched.clear()
+
+    def _evict_locked(self) -> None:
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        if count <= self.max_entries:
+            return
+        # Expulsa hasta el 90% del máximo para no evaluar en cada escritura
+        excess = count - int(self.max_entries * 0.9)
+        self._conn.execute(
+            "DELETE FROM embeddings WHERE rowid IN ("
+            " SELECT rowid FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+            (excess,),
+        )
+        logger.info("Embedding cache: expulsadas %d entradas (máx=%d)", excess, self.max_entries)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": (self.hits / total) if total else 0.0,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush_touched_locked()
+            self._conn.commit()
+            self._conn.close()
+
+
+_cache: Optional[EmbeddingCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_embedding_cache() -> Optional[EmbeddingCache]:
+    """Caché compartida por proceso; None si EMBED_CACHE_PATH está vacío."""
+    global _cache
+    s = get_settings()
+    if not s.embed_cache_path:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            try:
+                _cache = EmbeddingCache(s.embed_cache_path, s.embed_cache_max_entries)
+            except Exception as e:
+                logger.warning("No se pudo abrir la caché de embeddings (%s): %s", s.embed_cache_path, e)
+                return None
+    return _cache
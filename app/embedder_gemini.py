@@ -2,11 +2,94 @@
 app/embedder_gemini.py
 """
 import os
-from typing import List, Any
+import re
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Any, Optional
 import google.generativeai as genai
+from google.api_core import exceptions as gexc
+from tenacity import AsyncRetrying, Retrying, retry_if_exception, stop_after_attempt, wait_random_exponential
+
+from app.config import get_settings
+from app.embed_cache import get_embedding_cache, normalize_for_key
+from app.rate_limit import TokenBucket
+from app.ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# batchEmbedContents accepts at most 100 requests per call.
+MAX_BATCH_ITEMS = 100
+# Rough per-request payload budget (chars). Gemini counts tokens, not chars;
+# ~4 chars/token keeps us well under the per-request limits.
+MAX_BATCH_CHARS = 60_000
+# text-embedding-004 truncates/rejects inputs above ~2048 tokens.
+MAX_TEXT_CHARS = 8_000
+# Older model used when the configured one is rejected by this lib/version.
+FALLBACK_MODEL = "models/embedding-001"
+# Full-size batches that must succeed in a row before a shrunk item limit doubles back.
+BATCH_GROW_AFTER = 8
+
+# 429 / 5xx / timeouts: worth retrying with backoff. Anything else is a real
+# rejection: payload errors go to split logic, model errors to the fallback,
+# and the rest (auth, permissions, quota config) are raised as-is.
+_TRANSIENT_ERRORS = (
+    gexc.TooManyRequests,
+    gexc.ResourceExhausted,
+    gexc.InternalServerError,
+    gexc.BadGateway,
+    gexc.ServiceUnavailable,
+    gexc.GatewayTimeout,
+    gexc.DeadlineExceeded,
+    ConnectionError,
+    TimeoutError,
+)
+
+
+def _is_transient(exc: BaseException) -> bool:
+    return isinstance(exc, _TRANSIENT_ERRORS)
+
+
+_TOO_LARGE_RE = re.compile(r"payload size|too large|too long|too many|exceed", re.IGNORECASE)
+_MODEL_RE = re.compile(r"\bmodels?\b", re.IGNORECASE)
+
+
+def _is_payload_rejection(exc: BaseException) -> bool:
+    """400 / INVALID_ARGUMENT / 413: something in the batch is the problem, so
+    halving it isolates the culprit. EmbeddingError covers a short/malformed
+    batch reply."""
+    return (isinstance(exc, (gexc.BadRequest, EmbeddingError))
+            or getattr(exc, "code", None) == 413)
+
+
+def _is_too_large(exc: BaseException) -> bool:
+    """The request as a whole exceeded a size/token budget (vs. one bad text)."""
+    return getattr(exc, "code", None) == 413 or (
+        isinstance(exc, gexc.BadRequest) and bool(_TOO_LARGE_RE.search(str(exc))))
+
+
+def _is_model_rejection(exc: BaseException) -> bool:
+    """Unknown or unsupported model name in this lib/API version. A 400 about
+    the content itself is not one: the fallback model would only embed that
+    text in another vector space."""
+    if isinstance(exc, gexc.NotFound):
+        return True
+    return isinstance(exc, gexc.BadRequest) and bool(_MODEL_RE.search(str(exc))) and not _is_too_large(exc)
+
+
+class EmbeddingError(ValueError):
+    """The API answered, but not with a usable embedding."""
+
+
+class FallbackVector(list):
+    """Vector produced by FALLBACK_MODEL. It lives in a different embedding
+    space, so it is cached under that model and never memoized as a query
+    vector of the primary one."""
+    model = FALLBACK_MODEL
+
 
 class GeminiEmbedder:
-    def __init__(self):
+    def __init__(self, use_cache: bool = True):
         gapi = os.getenv("GOOGLE_API_KEY")
         gkey = os.getenv("GEMINI_API_KEY")
         if gapi and gkey:
@@ -20,6 +103,30 @@ class GeminiEmbedder:
         model = os.getenv("GEMINI_EMBED_MODEL", "models/text-embedding-004")
         self.model_name = self._ensure_model_prefix(model)
 
+        # Batch limits; the item limit shrinks when the API rejects a batch as too
+        # large and grows back (up to the configured value) after successful ones.
+        self.batch_items_limit = max(1, min(MAX_BATCH_ITEMS, int(os.getenv("GEMINI_EMBED_BATCH_MAX", MAX_BATCH_ITEMS))))
+        self.batch_max_items = self.batch_items_limit
+        self._batch_ok_streak = 0
+        self.batch_max_chars = max(1, int(os.getenv("GEMINI_EMBED_BATCH_CHARS", MAX_BATCH_CHARS)))
+        self.max_text_chars = max(1, int(os.getenv("GEMINI_EMBED_MAX_TEXT_CHARS", MAX_TEXT_CHARS)))
+
+        # Concurrency, quota (texts per minute) and retry policy.
+        self.concurrency = max(1, int(os.getenv("GEMINI_EMBED_CONCURRENCY", 4)))
+        rpm = float(os.getenv("GEMINI_EMBED_RPM", 1500))
+        self.limiter = TokenBucket(rate=rpm / 60.0, capacity=max(1.0, rpm / 60.0))
+        self.max_retries = max(1, int(os.getenv("GEMINI_EMBED_MAX_RETRIES", 5)))
+        self.backoff_base = float(os.getenv("GEMINI_EMBED_BACKOFF_BASE", 0.5))
+        self.backoff_max = float(os.getenv("GEMINI_EMBED_BACKOFF_MAX", 30))
+        self._pool: Optional[ThreadPoolExecutor] = None
+
+        # Persistent content-addressed cache shared with ingestion scripts.
+        self.cache = get_embedding_cache() if use_cache else None
+
+        # In-memory LRU/TTL of query vectors (hot path of /classify).
+        s = get_settings()
+        self.query_cache = TTLCache(s.query_vec_cache_size, s.query_vec_cache_ttl)
+
     def _ensure_model_prefix(self, name: str) -> str:
         if name.startswith("models/") or name.startswith("tunedModels/"):
             return name
@@ -54,28 +161,273 @@ class GeminiEmbedder:
                 first = resp["data"][0]
                 if isinstance(first, dict) and isinstance(first.get("embedding"), list):
                     return first["embedding"]
-        # Last resort: safe zero vector
-        return [0.0] * 768
+        # A zero vector would be indexed and silently degrade cosine kNN.
+        raise EmbeddingError(f"Unexpected embedding response shape: {type(resp).__name__}")
+
+    def _extract_embeddings(self, resp: dict, n: int) -> List[List[float]]:
+        # Batch shapes:
+        # - {'embedding': [[...], [...]]}                  (google-generativeai 0.8.x)
+        # - {'embeddings': [{'values': [...]}, ...]}       (raw batchEmbedContents)
+        # Raises ValueError on a count mismatch so the caller can split and retry.
+        rows: Any = None
+        if isinstance(resp, dict):
+            rows = resp.get("embedding")
+            if rows is None:
+                rows = resp.get("embeddings")
+        if not isinstance(rows, list) or len(rows) != n:
+            raise EmbeddingError(f"Unexpected batch embedding response for {n} inputs")
+        out: List[List[float]] = []
+        for row in rows:
+            if isinstance(row, dict):
+                row = row.get("values")
+            if not isinstance(row, list):
+                raise EmbeddingError("Unexpected batch embedding row shape")
+            out.append(row)
+        return out
+
+    def _call_embed(self, model: str, content: Any) -> dict:
+        """Rate-limited embed_content call; retries transient errors with
+        jittered exponential backoff. Quota is counted per text."""
+        cost = len(content) if isinstance(content, list) else 1
+        for attempt in Retrying(
+            retry=retry_if_exception(_is_transient),
+            wait=wait_random_exponential(multiplier=self.backoff_base, max=self.backoff_max),
+            stop=stop_after_attempt(self.max_retries),
+            reraise=True,
+        ):
+            with attempt:
+                self.limiter.acquire(cost)
+                return genai.embed_content(model=model, content=content)
+
+    async def _call_embed_async(self, model: str, content: Any) -> dict:
+        """Async twin of _call_embed. Runs on the library's shared grpc.aio
+        channel, so no threadpool worker is held while waiting."""
+        cost = len(content) if isinstance(content, list) else 1
+        async for attempt in AsyncRetrying(
+            retry=retry_if_exception(_is_transient),
+            wait=wait_random_exponential(multiplier=self.backoff_base, max=self.backoff_max),
+            stop=stop_after_attempt(self.max_retries),
+            reraise=True,
+        ):
+            with attempt:
+                await self.limiter.acquire_async(cost)
+                return await genai.embed_content_async(model=model, content=content)
+
+    def _shrink_batch_limit(self, size: int) -> None:
+        """Remembers a smaller item limit so later batches don't hit the same wall."""
+        self._batch_ok_streak = 0
+        if size < self.batch_max_items:
+            self.batch_max_items = max(1, size)
+
+    def _batch_succeeded(self, size: int) -> None:
+        """Doubles a shrunk item limit after BATCH_GROW_AFTER full batches in a row."""
+        if self.batch_max_items >= self.batch_items_limit or size < self.batch_max_items:
+            return
+        self._batch_ok_streak += 1
+        if self._batch_ok_streak >= BATCH_GROW_AFTER:
+            self._batch_ok_streak = 0
+            self.batch_max_items = min(self.batch_items_limit, self.batch_max_items * 2)
 
     def _embed_one(self, text: str) -> List[float]:
         # Try preferred model first; fall back if model name unsupported in this lib/version.
         try:
-            resp = genai.embed_content(model=self.model_name, content=text)
+            resp = self._call_embed(self.model_name, text)
             return self._extract_embedding(resp)
         except Exception as e:
+            # Only a rejected model justifies the fallback: transient failures
+            # already exhausted their retries, and auth/permission errors or
+            # malformed responses would fail the same way (or only mix vector
+            # spaces in the index).
+            if not _is_model_rejection(e):
+                raise
             # Fallback to older embedding model if the chosen one is rejected
-            fallback = "models/embedding-001"
-            if self.model_name != fallback:
+            if self.model_name != FALLBACK_MODEL:
                 try:
-                    resp = genai.embed_content(model=fallback, content=text)
-                    return self._extract_embedding(resp)
+                    resp = self._call_embed(FALLBACK_MODEL, text)
+                    return FallbackVector(self._extract_embedding(resp))
                 except Exception:
                     raise e
             raise
 
-    def embed_texts(self, texts: List[Any]) -> List[List[float]]:
-        vectors: List[List[float]] = []
+    def _embed_batch(self, texts: List[str], strict: bool = True) -> List[Optional[List[float]]]:
+        """Embeds a sub-batch in one request; if the API rejects the payload
+        splits it in halves and retries only the half that fails. Single texts
+        use _embed_one (model fallback only for a rejected model, never for a
+        rejected text). With strict=False, texts that still fail come back as
+        None instead of aborting the whole call; auth/permission and other
+        non-payload errors are always raised."""
+        if len(texts) == 1:
+            try:
+                return [self._embed_one(texts[0])]
+            except Exception as e:
+                if strict or not (_is_transient(e) or _is_payload_rejection(e)):
+                    raise
+                logger.warning("Embedding failed for one text (%s); leaving it pending.", e)
+                return [None]
+        try:
+            resp = self._call_embed(self.model_name, texts)
+            vectors = self._extract_embeddings(resp, len(texts))
+            self._batch_succeeded(len(texts))
+            return vectors
+        except Exception as e:
+            if _is_transient(e):
+                if strict:
+                    raise
+                logger.warning("Batch of %d texts failed after retries (%s); leaving it pending.", len(texts), e)
+                return [None] * len(texts)
+            if not _is_payload_rejection(e):
+                raise
+            # Only a too-large request lowers the limit; one rejected text just
+            # gets isolated by the split.
+            mid = len(texts) // 2
+            if _is_too_large(e):
+                self._shrink_batch_limit(mid)
+            logger.warning("Batch embedding of %d texts failed (%s); splitting.", len(texts), e)
+            return self._embed_batch(texts[:mid], strict) + self._embed_batch(texts[mid:], strict)
+
+    async def _embed_one_async(self, text: str) -> List[float]:
+        try:
+            resp = await self._call_embed_async(self.model_name, text)
+            return self._extract_embedding(resp)
+        except Exception as e:
+            if not _is_model_rejection(e) or self.model_name == FALLBACK_MODEL:
+                raise
+            try:
+                resp = await self._call_embed_async(FALLBACK_MODEL, text)
+                return FallbackVector(self._extract_embedding(resp))
+            except Exception:
+                raise e
+
+    async def _embed_batch_async(self, texts: List[str], strict: bool = True) -> List[Optional[List[float]]]:
+        """Async twin of _embed_batch (same split-on-rejection policy)."""
+        if len(texts) == 1:
+            try:
+                return [await self._embed_one_async(texts[0])]
+            except Exception as e:
+                if strict or not (_is_transient(e) or _is_payload_rejection(e)):
+                    raise
+                logger.warning("Embedding failed for one text (%s); leaving it pending.", e)
+                return [None]
+        try:
+            resp = await self._call_embed_async(self.model_name, texts)
+            vectors = self._extract_embeddings(resp, len(texts))
+            self._batch_succeeded(len(texts))
+            return vectors
+        except Exception as e:
+            if _is_transient(e):
+                if strict:
+                    raise
+                logger.warning("Batch of %d texts failed after retries (%s); leaving it pending.", len(texts), e)
+                return [None] * len(texts)
+            if not _is_payload_rejection(e):
+                raise
+            mid = len(texts) // 2
+            if _is_too_large(e):
+                self._shrink_batch_limit(mid)
+            logger.warning("Batch embedding of %d texts failed (%s); splitting.", len(texts), e)
+            return (await self._embed_batch_async(texts[:mid], strict)
+                    + await self._embed_batch_async(texts[mid:], strict))
+
+    def _plan_batches(self, texts: List[str]) -> List[List[str]]:
+        """Groups texts into sub-batches bounded by item count and total chars."""
+        batches: List[List[str]] = []
+        current: List[str] = []
+        chars = 0
         for t in texts:
-            clean = self._normalize_text(t)
-            vectors.append(self._embed_one(clean))
-        return vectors
\ No newline at end of file
+            if current and (len(current) >= self.batch_max_items or chars + len(t) > self.batch_max_chars):
+                batches.append(current)
+                current, chars = [], 0
+            current.append(t)
+            chars += len(t)
+        if current:
+            batches.append(current)
+        return batches
+
+    def _run_batches(self, batches: List[List[str]], strict: bool = True) -> List[List[Optional[List[float]]]]:
+        """Embeds sub-batches with up to `concurrency` requests in flight,
+        preserving order."""
+        if self.concurrency == 1 or len(batches) <= 1:
+            return [self._embed_batch(b, strict) for b in batches]
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="gemini-embed")
+        return list(self._pool.map(lambda b: self._embed_batch(b, strict), batches))
+
+    def _store(self, texts: List[str], vectors: List[Optional[List[float]]]) -> None:
+        """Caches each vector under the model that actually produced it."""
+        if self.cache is None:
+            return
+        by_model: dict = {}
+        for t, v in zip(texts, vectors):
+            if v is not None:
+                by_model.setdefault(getattr(v, "model", self.model_name), []).append((t, v))
+        for model, ok in by_model.items():
+            self.cache.put_many(model, [t for t, _ in ok], [v for _, v in ok])
+
+    def embed_texts(self, texts: List[Any], strict: bool = True) -> List[Optional[List[float]]]:
+        """Embeds `texts` in order. strict=False returns None for texts whose
+        embedding failed (after retries/splitting) instead of raising."""
+        clean = [self._normalize_text(t)[: self.max_text_chars] for t in texts]
+        cached = self.cache.get_many(self.model_name, clean) if self.cache is not None else {}
+        missing = [i for i in range(len(clean)) if i not in cached]
+
+        fresh: List[List[float]] = []
+        for batch_vectors in self._run_batches(self._plan_batches([clean[i] for i in missing]), strict):
+            fresh.extend(batch_vectors)
+        self._store([clean[i] for i in missing], fresh)
+
+        vectors: List[List[float]] = [None] * len(clean)  # type: ignore[list-item]
+        for i, v in cached.items():
+            vectors[i] = v
+        for i, v in zip(missing, fresh):
+            vectors[i] = v
+        return vectors
+
+    async def embed_texts_async(self, texts: List[Any], strict: bool = True) -> List[Optional[List[float]]]:
+        clean = [self._normalize_text(t)[: self.max_text_chars] for t in texts]
+        # SQLite calls block (and may wait on the cache lock): keep them off the event loop.
+        cached = {}
+        if self.cache is not None:
+            cached = await asyncio.to_thread(self.cache.get_many, self.model_name, clean)
+        missing = [i for i in range(len(clean)) if i not in cached]
+
+        sem = asyncio.Semaphore(self.concurrency)
+
+        async def _bounded(batch: List[str]) -> List[List[float]]:
+            async with sem:
+                return await self._embed_batch_async(batch, strict)
+
+        batches = self._plan_batches([clean[i] for i in missing])
+        fresh: List[List[float]] = []
+        for batch_vectors in await asyncio.gather(*(_bounded(b) for b in batches)):
+            fresh.extend(batch_vectors)
+        if missing:
+            await asyncio.to_thread(self._store, [clean[i] for i in missing], fresh)
+
+        vectors: List[List[float]] = [None] * len(clean)  # type: ignore[list-item]
+        for i, v in cached.items():
+            vectors[i] = v
+        for i, v in zip(missing, fresh):
+            vectors[i] = v
+        return vectors
+
+    def embed_query(self, text: Any) -> List[float]:
+        """Embeds a single search query, memoized by its normalized form."""
+        clean = self._normalize_text(text)
+        key = normalize_for_key(clean).casefold()
+        vec = self.query_cache.get(key)
+        if vec is None:
+            vec = self.embed_texts([clean])[0]
+            if not isinstance(vec, FallbackVector):
+                self.query_cache.set(key, vec)
+        return vec
+
+    async def embed_query_async(self, text: Any) -> List[float]:
+        clean = self._normalize_text(text)
+        key = normalize_for_key(clean).casefold()
+        vec = self.query_cache.get(key)
+        if vec is None:
+            vec = (await self.embed_texts_async([clean]))[0]
+            if not isinstance(vec, FallbackVector):
+                self.query_cache.set(key, vec)
+        return vec
+
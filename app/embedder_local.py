@@ -0,0 +1,63 @@
+"""
+app/embedder_local.py
+Embedder local sin red: vectorizador determinista de n-gramas con hashing.
+"""
+import math
+import re
+import unicodedata
+import zlib
+from typing import Any, List, Optional
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def _fold(text: str) -> str:
+    """Minúsculas y sin acentos ('Neumáticos' -> 'neumaticos')."""
+    nfkd = unicodedata.normalize("NFKD", text or "")
+    return "".join(c for c in nfkd if not unicodedata.combining(c)).casefold()
+
+
+class HashingEmbedder:
+    """Proyecta palabras y n-gramas de caracteres (3..5) a `dim` cubetas con
+    signo (feature hashing) y normaliza L2. Determinista entre procesos
+    (crc32), apto para CI, benchmarks y re-indexados offline sin cuota."""
+
+    def __init__(self, dim: int = 768, ngram_range: tuple[int, int] = (3, 5)):
+        self.dim = int(dim)
+        self.ngram_range = ngram_range
+        self.model_name = f"local/hashing-ngram-v1-{self.dim}"
+
+    def _features(self, text: str) -> List[tuple[str, float]]:
+        words = _WORD_RE.findall(_fold(text))
+        feats: List[tuple[str, float]] = [("w:" + w, 1.0) for w in words]
+        lo, hi = self.ngram_range
+        for w in words:
+            padded = f"<{w}>"
+            for n in range(lo, hi + 1):
+                for i in range(len(padded) - n + 1):
+                    feats.append((padded[i:i + n], 0.5))
+        return feats
+
+    def _embed(self, text: Any) -> List[float]:
+        vec = [0.0] * self.dim
+        for feat, weight in self._features(str(text or "")):
+            h = zlib.crc32(feat.encode("utf-8"))
+            sign = 1.0 if (h >> 31) & 1 else -1.0
+            vec[h % self.dim] += sign * weight
+        norm = math.sqrt(sum(v * v for v in vec))
+        if norm > 0:
+            vec = [v / norm for v in vec]
+        return vec
+
+    def embed_texts(self, texts: List[Any], strict: bool = True) -> List[Optional[List[float]]]:
+        # Cálculo local: no hay fallos parciales que marcar como pendientes
+        return [self._embed(t) for t in texts]
+
+    def embed_query(self, text: Any) -> List[float]:
+        return self._embed(text)
+
+    async def embed_texts_async(self, texts: List[Any], strict: bool = True) -> List[Optional[List[float]]]:
+        return self.embed_texts(texts)
+
+    async def embed_query_async(self, text: Any) -> List[float]:
+        return self._embed(text)
@@ -0,0 +1,50 @@
+"""
+app/embeddings.py
+Contrato común de los backends de embeddings y selección por configuración.
+
+EMBED_BACKEND=gemini  -> GeminiEmbedder (API, por defecto)
+EMBED_BACKEND=hashing -> HashingEmbedder (local, CPU, sin red)
+"""
+import threading
+from typing import Any, List, Optional, Protocol, runtime_checkable
+
+from app.config import get_settings
+
+
+@runtime_checkable
+class Embedder(Protocol):
+    model_name: str
+
+    def embed_texts(self, texts: List[Any], strict: bool = True) -> List[Optional[List[float]]]: ...
+
+    def embed_query(self, text: Any) -> List[float]: ...
+
+    async def embed_texts_async(self, texts: List[Any], strict: bool = True) -> List[Optional[List[float]]]: ...
+
+    async def embed_query_async(self, text: Any) -> List[float]: ...
+
+
+def build_embedder(backend: str | None = None) -> Embedder:
+    s = get_settings()
+    name = (backend or s.embed_backend or "gemini").strip().lower()
+    if name in ("hashing", "local"):
+        from app.embedder_local import HashingEmbedder
+        return HashingEmbedder(dim=s.opensearch_emb_dim)
+    if name == "gemini":
+        from app.embedder_gemini import GeminiEmbedder
+        return GeminiEmbedder()
+    raise ValueError(f"EMBED_BACKEND desconocido: {name!r} (usa 'gemini' o 'hashing')")
+
+
+_embedder: Optional[Embedder] = None
+_embedder_lock = threading.Lock()
+
+
+def get_embedder() -> Embedder:
+    """Embedder compartido por proceso según Settings.embed_backend."""
+    global _embedder
+    if _embedder is None:
+        with _embedder_lock:
+            if _embedder is None:
+                _embedder = build_embedder()
+    return _embedder
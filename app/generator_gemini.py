@@ -42,14 +42,20 @@ def _offline_result(evidence: List[Dict[str, Any]] | None = None, reason: str =
     }
 
 
+# Fragmentos y caracteres por fragmento que entran al prompt (os_retrieval.hydrate_hits
+# trae el texto completo solo para estos)
+PROMPT_DOCS = 5
+PROMPT_CHARS = 600
+
+
 def _build_evidence_from_os_hits(context_docs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     evidence: List[Dict[str, Any]] = []
-    for doc in context_docs[:5]:  # Top 5 para no exceder límites
+    for doc in context_docs[:PROMPT_DOCS]:  # Top 5 para no exceder límites
         source = doc.get("_source", {}) or {}
         evidence.append({
             "fragment_id": doc.get("_id", "unknown"),
             "score": doc.get("_score", 0.0),
-            "text": source.get("text", "")[:600],  # Limitar texto
+            "text": source.get("text", "")[:PROMPT_CHARS],  # Limitar texto
             "doc_id": source.get("doc_id", ""),
             "unit": source.get("unit", ""),
             "bucket": source.get("bucket", "")
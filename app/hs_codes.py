@@ -0,0 +1,63 @@
+"""
+app/hs_codes.py
+Canonicalización de códigos HS para el campo keyword 'hs_codes'.
+
+En la ingesta (os_ingest._flatten_metadata) cada código citado en el texto,
+en cualquier grafía ("4011.10", "401110", "4011 10", "4011-10", "4011 . 10"),
+más los de metadata (hs6, partida, heading, subheading), se guarda como
+dígitos junto con sus prefijos de 4/6/8 dígitos. El normalizer 'hs_code'
+quita todo lo que no sea dígito, también en las term queries, de modo que
+buscar "4011.10" es un único term sobre hs_codes en lugar de siete
+match_phrase sobre 'text'.
+"""
+import re
+from typing import Any, Dict, List, Tuple
+
+HS_CODES_FIELD = "hs_codes"
+MAX_CODES = 64
+
+# Partida de 4 dígitos y hasta dos pares más separados por . - o espacios. Se
+# excluyen solo los números decimales ("12.5000", "4011,5"): una coma o punto
+# seguidos de dígito; "4011.10, 4011.20" y "4011, 4012" son listas de códigos.
+_TEXT_CODE_RE = re.compile(r"(?<!\d)(?<!\d[.,])(\d{4})(?:\s?[.\-]?\s?(\d{2}))?(?:\s?[.\-]?\s?(\d{2}))?(?!\d|[.,]\d)")
+_NUMBER_RE = re.compile(r"\d+")
+_META_FIELDS = ("hs6", "partida", "heading", "subheading")
+
+ANALYSIS = {
+    "char_filter": {"hs_digits": {"type": "pattern_replace", "pattern": "[^0-9]", "replacement": ""}},
+    "normalizer": {"hs_code": {"type": "custom", "char_filter": ["hs_digits"]}},
+}
+MAPPING = {"type": "keyword", "normalizer": "hs_code"}
+
+
+def hs_digits(code: Any) -> str:
+    return "".join(ch for ch in str(code or "") if ch.isdigit())
+
+
+def numeric_signature(text: str) -> Tuple[str, ...]:
+    """Códigos HS (canonicalizados a dígitos) y demás números de un texto,
+    ordenados y sin duplicados: "neumáticos 4011.10 de 16 pulgadas" -> ("16", "401110")."""
+    text = text or ""
+    out = {"".join(p for p in m.groups() if p) for m in _TEXT_CODE_RE.finditer(text)}
+    out.update(_NUMBER_RE.findall(_TEXT_CODE_RE.sub(" ", text)))
+    return tuple(sorted(out))
+
+
+def _with_prefixes(digits: str) -> List[str]:
+    return [digits[:n] for n in (4, 6, 8) if len(digits) > n] + [digits]
+
+
+def extract_hs_codes(src: Dict[str, Any]) -> List[str]:
+    """Códigos canónicos (dígitos + prefijos) del texto y metadata de un fragmento."""
+    out: Dict[str, None] = {}
+    for field in _META_FIELDS:
+        d = hs_digits(src.get(field))
+        if 4 <= len(d) <= 12:
+            for c in _with_prefixes(d):
+                out.setdefault(c, None)
+    for m in _TEXT_CODE_RE.finditer(src.get("text") or ""):
+        for c in _with_prefixes("".join(p for p in m.groups() if p)):
+            out.setdefault(c, None)
+        if len(out) >= MAX_CODES:
+            break
+    return list(out)[:MAX_CODES]
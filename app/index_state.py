@@ -0,0 +1,234 @@
+"""
+app/index_state.py
+Validación del índice en el arranque y estado de "readiness" cacheado.
+
+El lifespan de la API comprueba una vez que el campo 'embedding' del índice
+(o de los índices detrás del alias) coincide con Settings (dimensión, espacio,
+motor y data_type) y guarda el resultado en app.state. /classify solo vuelve
+a consultar el cluster cuando el estado se invalida (error de búsqueda), no
+está listo o vence index_state_ttl (detecta cambios de alias).
+
+KnnWarmup sigue el k-NN warmup del proceso, lanzado con el primer refresh
+exitoso de IndexReadiness (en el arranque o cuando el cluster vuelve): hasta
+que termina, /health responde 503 para que el balanceador no envíe tráfico
+al nodo frío.
+"""
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from app.config import get_settings
+from app.os_index import ensure_index, warmup_knn
+from app.os_retrieval import set_hs_codes_available
+from app.quantization import knn_index_settings, knn_vector_mapping
+
+logger = logging.getLogger(__name__)
+
+
+class IndexMappingError(RuntimeError):
+    """El mapping del índice no coincide con Settings (hay que re-indexar)."""
+
+
+class IndexState:
+    def __init__(self, name: str, ready: bool = False, generation: str = "", error: Optional[str] = None,
+                 mapping_mismatch: bool = False):
+        self.name = name
+        self.ready = ready
+        # True si el índice existe pero su mapping no coincide con Settings
+        self.mapping_mismatch = mapping_mismatch
+        # Índices concretos detrás del nombre/alias; cambia al mover el alias
+        self.generation = generation
+        self.error = error
+        self.checked_at = time.monotonic()
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {"index": self.name, "ready": self.ready, "generation": self.generation,
+                "mapping_mismatch": self.mapping_mismatch, "error": self.error}
+
+
+def _expected_embedding() -> Dict[str, Any]:
+    s = get_settings()
+    exp = knn_vector_mapping(int(s.opensearch_emb_dim), s.opensearch_knn_space, s.opensearch_vector_mode,
+                             s.opensearch_index_profile)
+    return {
+        "dimension": int(exp["dimension"]),
+        "space_type": exp["method"]["space_type"],
+        "engine": exp["method"]["engine"],
+        "data_type": exp.get("data_type", "float"),
+    }
+
+
+def mapping_drift(embedding_mapping: Dict[str, Any] | None) -> List[str]:
+    """Diferencias entre el mapping de 'embedding' y lo esperado por Settings."""
+    if not embedding_mapping or embedding_mapping.get("type") != "knn_vector":
+        return ["el campo 'embedding' no es knn_vector"]
+    expected = _expected_embedding()
+    method = embedding_mapping.get("method") or {}
+    actual = {
+        "dimension": int(embedding_mapping.get("dimension") or 0),
+        "space_type": method.get("space_type", "l2"),
+        "engine": method.get("engine", "nmslib"),
+        "data_type": embedding_mapping.get("data_type", "float"),
+    }
+    return [f"{k}: índice={actual[k]!r} settings={v!r}" for k, v in expected.items() if actual[k] != v]
+
+
+def apply_ef_search(os_client, index: str) -> List[str]:
+    """
+    nmslib: aplica el ef_search del perfil (setting dinámico) a los índices
+    concretos que tengan otro valor, para que cambiar OPENSEARCH_INDEX_PROFILE
+    surta efecto sin recrear el índice. Devuelve los índices actualizados.
+    faiss lo fija en el mapping al crear el índice (cambiarlo exige reindexar).
+    """
+    s = get_settings()
+    wanted = knn_index_settings(s.opensearch_vector_mode, s.opensearch_index_profile).get("knn.algo_param.ef_search")
+    if wanted is None:
+        return []
+    current = os_client.indices.get_settings(index=index, name="index.knn.algo_param.ef_search", flat_settings=True)
+    stale = sorted(name for name, body in current.items()
+                   if str((body.get("settings") or {}).get("index.knn.algo_param.ef_search")) != str(wanted))
+    if stale:
+        os_client.indices.put_settings(index=",".join(stale), body={"index": {"knn.algo_param.ef_search": wanted}})
+        logger.info("ef_search=%s aplicado a %s", wanted, ", ".join(stale))
+    return stale
+
+
+def validate_index(os_client, index: str, create: bool = True) -> IndexState:
+    """
+    Comprueba (y crea si falta) el índice y valida su mapping contra Settings.
+    Lanza IndexMappingError si hay deriva; los errores de conexión se propagan.
+    Con nmslib también alinea ef_search con el perfil (apply_ef_search).
+    Si algún índice no tiene 'hs_codes', la búsqueda vuelve a las variantes
+    del código en 'text' (os_retrieval.set_hs_codes_available).
+    """
+    if create and ensure_index(index, client=os_client):
+        logger.info("Índice creado: %s", index)
+    resp = os_client.indices.get_mapping(index=index)
+    problems: List[str] = []
+    without_hs_codes: List[str] = []
+    for concrete, body in sorted(resp.items()):
+        props = (body.get("mappings") or {}).get("properties") or {}
+        problems += [f"{concrete}: {p}" for p in mapping_drift(props.get("embedding"))]
+        if "hs_codes" not in props:
+            without_hs_codes.append(concrete)
+    if without_hs_codes and get_settings().opensearch_hs_codes_field:
+        logger.warning("%s sin el campo 'hs_codes': códigos HS por variantes en 'text' hasta reindexar",
+                       ", ".join(without_hs_codes))
+    set_hs_codes_available(not without_hs_codes)
+    if problems:
+        raise IndexMappingError(f"Mapping de '{index}' no coincide con Settings: " + "; ".join(problems))
+    try:
+        apply_ef_search(os_client, index)
+    except Exception as e:
+        logger.warning("No se pudo aplicar ef_search a %s: %s", index, e)
+    return IndexState(name=index, ready=True, generation=",".join(sorted(resp)))
+
+
+class IndexReadiness:
+    """Estado del índice compartido por la app; se refresca solo si hace falta."""
+
+    def __init__(self, os_client, index: str, ttl: float | None = None,
+                 on_ready: Optional[Callable[[IndexState], None]] = None):
+        self.os_client = os_client
+        self.index = index
+        self.ttl = float(get_settings().index_state_ttl if ttl is None else ttl)
+        # Se llama tras cada refresh con el índice listo (p. ej. KnnWarmup.start)
+        self.on_ready = on_ready
+        self.state = IndexState(name=index, error="not checked")
+        self._stale = True
+        self._lock = threading.Lock()
+
+    def _needs_refresh(self) -> bool:
+        if self._stale or not self.state.ready:
+            return True
+        return self.ttl > 0 and time.monotonic() - self.state.checked_at > self.ttl
+
+    def refresh(self, raise_on_drift: bool = False) -> IndexState:
+        previous = self.state.generation
+        try:
+            state = validate_index(self.os_client, self.index)
+        except IndexMappingError as e:
+            logger.error("%s", e)
+            state = IndexState(name=self.index, error=str(e), mapping_mismatch=True)
+            if raise_on_drift:
+                raise
+        except Exception as e:
+            logger.warning("Índice %s no disponible: %s", self.index, e)
+            state = IndexState(name=self.index, error=f"{e.__class__.__name__}: {e}")
+        if state.ready and previous and state.generation != previous:
+            logger.info("Alias %s cambió: %s -> %s", self.index, previous, state.generation)
+        self.state = state
+        self._stale = False
+        if state.ready and self.on_ready is not None:
+            try:
+                self.on_ready(state)
+            except Exception as e:
+                logger.warning("on_ready de %s falló: %s", self.index, e)
+        return state
+
+    def get(self) -> IndexState:
+        """Estado cacheado; sin llamadas al cluster salvo invalidación/TTL."""
+        if self._needs_refresh():
+            with self._lock:
+                if self._needs_refresh():
+                    return self.refresh()
+        return self.state
+
+    def invalidate(self, reason: str = "") -> None:
+        if reason:
+            logger.info("Estado del índice %s invalidado: %s", self.index, reason)
+        self._stale = True
+
+
+class KnnWarmup:
+    """Estado del k-NN warmup del proceso: pending -> running -> done | failed | skipped."""
+
+    def __init__(self, os_client, index: str):
+        self.os_client = os_client
+        self.index = index
+        self.status = "pending"
+        self.error: Optional[str] = None
+        self.shards: Optional[Dict[str, Any]] = None
+        self.seconds: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self.status not in ("pending", "running")
+
+    def skip(self, reason: str) -> None:
+        self.status, self.error = "skipped", reason
+
+    def start(self) -> bool:
+        """Lanza run en un hilo de fondo si sigue pendiente; idempotente (se
+        llama en cada refresh exitoso del índice)."""
+        with self._lock:
+            if self.status != "pending":
+                return False
+            self.status = "running"
+        threading.Thread(target=self.run, name="knn-warmup", daemon=True).start()
+        return True
+
+    def run(self) -> None:
+        """Bloqueante; se lanza en un hilo desde el lifespan. Un fallo no deja
+        el nodo fuera de servicio: solo se pierde el calentamiento."""
+        self.status = "running"
+        start = time.monotonic()
+        try:
+            self.shards = warmup_knn(self.index, client=self.os_client)
+            if self.shards is None:
+                self.skip("deshabilitado o motor sin memoria nativa")
+            elif self.shards.get("failed"):
+                self.status, self.error = "failed", f"{self.shards['failed']} shards sin calentar"
+            else:
+                self.status = "done"
+        except Exception as e:
+            logger.warning("k-NN warmup de %s falló: %s", self.index, e)
+            self.status, self.error = "failed", f"{e.__class__.__name__}: {e}"
+        self.seconds = round(time.monotonic() - start, 3)
+        logger.info("k-NN warmup de %s: %s en %.1fs", self.index, self.status, self.seconds)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {"status": self.status, "ready": self.ready, "index": self.index,
+                "shards": self.shards, "seconds": self.seconds, "error": self.error}
@@ -1,15 +1,15 @@
 from langchain.schema import Document
-from app.embedder_gemini import embed_texts
-from app.os_retrieval import bm25_search, knn_search, rrf_fusion
+from app.config import get_settings
+from app.os_index import get_os_client
+from app.os_retrieval import hybrid_search
 
 def retrieve_docs(query: str, k_bm25=12, k_knn=12, topn=24, final_k=6) -> list[Document]:
-    qvec = embed_texts([query])[0]
-    bm = bm25_search(query, size=k_bm25)
-    kn = knn_search(qvec, size=k_knn)
-    fused = rrf_fusion(bm, kn, k=60, topn=topn)
-    fused = fused[:final_k]
+    s = get_settings()
+    fused = hybrid_search(get_os_client(), s.opensearch_index, query, k=min(topn, final_k),
+                          bm25_depth=k_bm25, knn_depth=k_knn, rrf_k=60, snippet_chars=0)
     docs = []
     for f in fused:
-        meta = {k:f[k] for k in ["fragment_id","source","doc_id","chapter","heading","subheading","unit","edition","validity_from","validity_to"] if k in f}
-        docs.append(Document(page_content=f["text"], metadata=meta))
+        src = f.get("_source", {}) or {}
+        meta = {k: src[k] for k in ["fragment_id","source","doc_id","chapter","heading","subheading","unit","edition","validity_from","validity_to"] if k in src}
+        docs.append(Document(page_content=src.get("text", ""), metadata=meta))
     return docs
@@ -0,0 +1,340 @@
+"""
+app/local_ann.py
+Índice vectorial en proceso para el bucket caliente (asgard_products).
+
+Matriz float32 (vectores reducidos a OPENSEARCH_EMB_DIM y normalizados L2)
+guardada como .npy y abierta con memory-map; búsqueda por coseno exacta con
+NumPy, o IVF (k-means + nprobe listas) a partir de ivf_min_rows vectores.
+Archivos en LOCAL_ANN_PATH (directorio), todos .npy abiertos con memory-map
+para que cada worker de la API solo pagine las filas que lee:
+  vectors.npy       matriz (n, dim)
+  ids.npy           fragment_id por fila (unicode de ancho fijo)
+  field_<campo>.npy un array por campo de DOC_FIELDS ("" = ausente); los
+                    filtros (np.isin) y el _source del hit se leen de aquí
+  text.npy          prefijos de texto concatenados en UTF-8 (uint8) y
+  text_offsets.npy  sus offsets (n + 1); solo se decodifican los top-k
+  ivf.npz           centroides y listas invertidas (si aplica)
+  meta.json         {"dim", "rows", "fields"}; se escribe al final
+
+La ingesta (os_ingest.bulk_ingest_fragments) mantiene el índice al día para
+el bucket configurado; la API lo abre en el arranque y, si otro proceso lo
+reescribe, lo vuelve a mapear (se comprueba como mucho cada RELOAD_EVERY s).
+"""
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Set
+
+import numpy as np
+
+from app.config import get_settings
+from app.dim_reduction import reduce_for_index
+
+logger = logging.getLogger(__name__)
+
+# Campos del fragmento conservados para construir hits sin ir a OpenSearch
+DOC_FIELDS = ("fragment_id", "bucket", "unit", "doc_id", "chapter", "heading", "subheading",
+              "partida", "hs6", "codigo_producto", "edition")
+# Columnas por fila además del id (fragment_id es el propio id)
+_COLUMNS = tuple(f for f in DOC_FIELDS if f != "fragment_id")
+RELOAD_EVERY = 30.0
+
+
+def _str_array(values: Sequence[str]) -> np.ndarray:
+    """Unicode de ancho fijo (memory-mappable, a diferencia de dtype=object)."""
+    return np.asarray(list(values), dtype=str) if len(values) else np.zeros(0, dtype="<U1")
+
+
+class _Texts:
+    """Textos como blob UTF-8 + offsets (ambos memory-mapped); decodifica por fila."""
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray):
+        self.blob = blob
+        self.offsets = offsets
+
+    @classmethod
+    def pack(cls, texts: Sequence[str]) -> "_Texts":
+        encoded = [(t or "").encode("utf-8") for t in texts]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(b) for b in encoded], dtype=np.int64)
+        return cls(np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode("utf-8", errors="ignore")
+
+
+def _normalize_rows(x: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(x, axis=1, keepdims=True)
+    return (x / np.where(norms > 0, norms, 1.0)).astype(np.float32)
+
+
+def _kmeans(x: np.ndarray, nlist: int, iters: int = 10, seed: int = 42) -> np.ndarray:
+    """k-means esférico (coseno) sobre una muestra; devuelve centroides unitarios."""
+    rng = np.random.default_rng(seed)
+    sample = x[rng.choice(len(x), size=min(len(x), nlist * 64), replace=False)]
+    centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+    for _ in range(iters):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        for c in range(nlist):
+            members = sample[assign == c]
+            if len(members):
+                centroids[c] = members.sum(axis=0)
+        centroids = _normalize_rows(centroids)
+    return centroids
+
+
+class LocalANNIndex:
+    def __init__(self, dim: int, vectors: Optional[np.ndarray] = None, ids: Optional[Sequence[str]] = None,
+                 columns: Optional[Dict[str, Sequence[str]]] = None, texts: Optional[Sequence[str]] = None):
+        self.dim = int(dim)
+        self.vectors = vectors if vectors is not None else np.zeros((0, self.dim), dtype=np.float32)
+        # Listas al construir/ingestar; arrays memory-mapped al cargar para la API
+        self.ids: Sequence[str] = ids if ids is not None else []
+        self.columns: Dict[str, Sequence[str]] = dict(columns or {})
+        self.texts: Sequence[str] = texts if texts is not None else []
+        self._pos: Optional[Dict[str, int]] = None
+        self._appended: List[np.ndarray] = []
+        self.centroids: Optional[np.ndarray] = None
+        self.list_offsets: Optional[np.ndarray] = None
+        self.list_rows: Optional[np.ndarray] = None
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def doc(self, i: int) -> Dict[str, str]:
+        """Campos del hit de la fila i (lectura perezosa de las columnas)."""
+        out = {"fragment_id": str(self.ids[i])}
+        for name, col in self.columns.items():
+            if col[i]:
+                out[name] = str(col[i])
+        out["text"] = self.texts[i] if i < len(self.texts) else ""
+        return out
+
+    # --- escritura (ingesta) ---
+    def _make_mutable(self) -> None:
+        """Pasa ids/columnas/textos a listas (solo en la ingesta, no en la API)."""
+        if self._pos is not None:
+            return
+        n = len(self.ids)
+        self.ids = [str(x) for x in self.ids]
+        self.columns = {name: [str(v) for v in self.columns[name]] if name in self.columns else [""] * n
+                        for name in _COLUMNS}
+        self.texts = [self.texts[i] for i in range(len(self.texts))] + [""] * (n - len(self.texts))
+        self._pos = {fid: i for i, fid in enumerate(self.ids)}
+
+    def upsert(self, items: Sequence[tuple]) -> int:
+        """items: (fragment_id, vector completo del embedder, doc dict). Reemplaza por id.
+        Los vectores nuevos se acumulan y se concatenan una sola vez (_consolidate)."""
+        if not items:
+            return 0
+        new_vecs = _normalize_rows(np.asarray([reduce_for_index(v) for _, v, _ in items], dtype=np.float32))
+        if new_vecs.shape[1] != self.dim:
+            raise ValueError(f"dim {new_vecs.shape[1]} != {self.dim} del índice local")
+        if not self.vectors.flags.writeable:
+            self.vectors = np.array(self.vectors, dtype=np.float32)  # copia fuera del memmap
+        self._make_mutable()
+        base = len(self.vectors)
+        for (fid, _, doc), vec in zip(items, new_vecs):
+            i = self._pos.get(fid)
+            if i is None:
+                i = self._pos[fid] = len(self.ids)
+                self.ids.append(fid)
+                for name in _COLUMNS:
+                    self.columns[name].append("")
+                self.texts.append("")
+                self._appended.append(vec)
+            elif i < base:
+                self.vectors[i] = vec
+            else:
+                self._appended[i - base] = vec
+            for name in _COLUMNS:
+                value = doc.get(name)
+                self.columns[name][i] = "" if value is None else str(value)
+            self.texts[i] = doc.get("text") or ""
+        self.centroids = None
+        return len(items)
+
+    def _consolidate(self) -> None:
+        if self._appended:
+            self.vectors = np.vstack([self.vectors, np.asarray(self._appended, dtype=np.float32)])
+            self._appended = []
+
+    def build_ivf(self, min_rows: int) -> None:
+        self._consolidate()
+        n = len(self.ids)
+        if n < max(1, min_rows):
+            self.centroids = self.list_offsets = self.list_rows = None
+            return
+        x = np.asarray(self.vectors, dtype=np.float32)
+        self.centroids = _kmeans(x, nlist=max(1, int(np.sqrt(n))))
+        assign = np.argmax(x @ self.centroids.T, axis=1)
+        self.list_rows = np.argsort(assign, kind="stable").astype(np.int32)
+        self.list_offsets = np.searchsorted(assign[self.list_rows], np.arange(len(self.centroids) + 1)).astype(np.int64)
+
+    def save(self, path: str, text_chars: int = 300) -> None:
+        """Escritura atómica por archivo (tmp + rename) con meta.json al final: la API
+        re-mapea al cambiar meta.json y descarta un estado con filas desparejas."""
+        self._consolidate()
+        d = Path(path)
+        d.mkdir(parents=True, exist_ok=True)
+        n = len(self.ids)
+        texts = _Texts.pack([(self.texts[i] if i < len(self.texts) else "")[:text_chars] for i in range(n)])
+        arrays = {
+            "vectors": np.asarray(self.vectors, dtype=np.float32),
+            "ids": _str_array([str(x) for x in self.ids]),
+            "text": texts.blob,
+            "text_offsets": texts.offsets,
+        }
+        for name in _COLUMNS:
+            arrays[f"field_{name}"] = _str_array(self.columns.get(name) or [""] * n)
+        for name, arr in arrays.items():
+            np.save(d / f"{name}.tmp.npy", arr)
+            os.replace(d / f"{name}.tmp.npy", d / f"{name}.npy")
+        if self.centroids is not None:
+            np.savez(d / "ivf.tmp.npz", centroids=self.centroids, offsets=self.list_offsets, rows=self.list_rows)
+            os.replace(d / "ivf.tmp.npz", d / "ivf.npz")
+        elif (d / "ivf.npz").exists():
+            (d / "ivf.npz").unlink()
+        with open(d / "meta.tmp.json", "w", encoding="utf-8") as f:
+            json.dump({"dim": self.dim, "rows": n, "fields": list(_COLUMNS)}, f)
+        os.replace(d / "meta.tmp.json", d / "meta.json")
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "LocalANNIndex":
+        d = Path(path)
+        with open(d / "meta.json", "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        mode = "r" if mmap else None
+        vectors = np.load(d / "vectors.npy", mmap_mode=mode)
+        if "ids" in meta:  # formato anterior: ids y docs dentro de meta.json
+            docs = meta.get("docs") or []
+            idx = cls(meta["dim"], vectors, list(meta["ids"]),
+                      {name: [str(doc.get(name) or "") for doc in docs] for name in _COLUMNS},
+                      [doc.get("text") or "" for doc in docs])
+        else:
+            ids = np.load(d / "ids.npy", mmap_mode=mode)
+            columns = {name: np.load(d / f"field_{name}.npy", mmap_mode=mode) for name in meta.get("fields", [])
+                       if (d / f"field_{name}.npy").exists()}
+            texts = _Texts(np.load(d / "text.npy", mmap_mode=mode), np.load(d / "text_offsets.npy", mmap_mode=mode))
+            rows = {len(vectors), len(ids), len(texts), *(len(c) for c in columns.values())}
+            if rows != {int(meta.get("rows", len(ids)))}:
+                raise ValueError(f"índice local {path} a medio escribir (filas: {sorted(rows)})")
+            idx = cls(meta["dim"], vectors, ids, columns, texts)
+        if (d / "ivf.npz").exists():
+            with np.load(d / "ivf.npz") as ivf:
+                idx.centroids, idx.list_offsets, idx.list_rows = ivf["centroids"], ivf["offsets"], ivf["rows"]
+        return idx
+
+    # --- lectura (consulta) ---
+    def search(self, vector: Sequence[float], k: int, nprobe: int = 8,
+               match: Optional[Dict[str, Set[str]]] = None) -> List[Dict]:
+        """
+        Top-k por coseno como hits con forma OpenSearch. _score = (1 + cos) / 2,
+        como el coseno de lucene; nmslib cosinesimil da 1 / (2 - cos). Ambos son
+        monótonos en cos (RRF usa rangos y el rerank normaliza min-max).
+        match: {campo: valores} exigidos sobre las columnas.
+        """
+        if not len(self.ids):
+            return []
+        self._consolidate()
+        q = np.asarray(reduce_for_index(vector), dtype=np.float32)
+        norm = float(np.linalg.norm(q))
+        if norm == 0:
+            return []
+        q /= norm
+        if self.centroids is not None:
+            lists = np.argsort(-(self.centroids @ q))[:max(1, nprobe)]
+            rows = np.concatenate([self.list_rows[self.list_offsets[c]:self.list_offsets[c + 1]] for c in lists])
+        else:
+            rows = np.arange(len(self.ids))
+        for field, values in (match or {}).items():
+            if field == "fragment_id":
+                column = self.ids
+            else:
+                column = self.columns.get(field)
+                if column is None:
+                    return []
+            rows = rows[np.isin(np.asarray(column)[rows], [str(v) for v in values])]
+        if not len(rows):
+            return []
+        sims = self.vectors[rows] @ q
+        if len(sims) > k:
+            part = np.argpartition(-sims, k)[:k]
+            top = part[np.argsort(-sims[part])]
+        else:
+            top = np.argsort(-sims)
+        # _snippet: el texto guardado es un prefijo; hydrate_hits trae el completo
+        return [{
+            "_id": str(self.ids[rows[i]]),
+            "_score": float((1.0 + sims[i]) / 2.0),
+            "_source": self.doc(int(rows[i])),
+            "_snippet": True,
+            "_local": True,
+        } for i in top]
+
+
+_index: Optional[LocalANNIndex] = None
+_loaded_mtime = 0.0
+_checked_at = 0.0
+_lock = threading.Lock()
+
+
+def get_local_ann() -> Optional[LocalANNIndex]:
+    """Índice local memory-mapped (None si LOCAL_ANN_PATH está vacío o no existe)."""
+    global _index, _loaded_mtime, _checked_at
+    path = get_settings().local_ann_path
+    if not path:
+        return None
+    now = time.monotonic()
+    if _index is not None and now - _checked_at < RELOAD_EVERY:
+        return _index
+    with _lock:
+        _checked_at = now
+        meta = Path(path) / "meta.json"
+        try:
+            mtime = meta.stat().st_mtime
+        except OSError:
+            return _index
+        if _index is None or mtime != _loaded_mtime:
+            try:
+                _index = LocalANNIndex.load(path)
+                _loaded_mtime = mtime
+                logger.info("Índice local %s cargado (%d vectores, ivf=%s)", path, len(_index),
+                            _index.centroids is not None)
+            except Exception as e:
+                logger.warning("No se pudo cargar el índice local %s: %s", path, e)
+    return _index
+
+
+def open_local_ann_for_ingest() -> Optional[LocalANNIndex]:
+    """Índice local en memoria para actualizarlo durante una ingesta (None si
+    LOCAL_ANN_PATH está vacío). Se persiste una vez con save_local_ann."""
+    s = get_settings()
+    if not s.local_ann_path:
+        return None
+    if (Path(s.local_ann_path) / "meta.json").exists():
+        return LocalANNIndex.load(s.local_ann_path, mmap=False)
+    return LocalANNIndex(s.opensearch_emb_dim)
+
+
+def add_fragments(idx: LocalANNIndex, fragments: Sequence[Dict],
+                  vectors: Sequence[Optional[Sequence[float]]]) -> int:
+    """Upsert de los fragmentos del bucket LOCAL_ANN_BUCKET con embedding válido."""
+    bucket = get_settings().local_ann_bucket
+    items = [(f["fragment_id"], v, f) for f, v in zip(fragments, vectors)
+             if v is not None and f.get("bucket") == bucket]
+    return idx.upsert(items)
+
+
+def save_local_ann(idx: LocalANNIndex) -> None:
+    """Reconstruye IVF (si hay suficientes vectores) y escribe los archivos."""
+    s = get_settings()
+    with _lock:
+        idx.build_ivf(s.local_ann_ivf_min_rows)
+        idx.save(s.local_ann_path, text_chars=max(1, s.retrieval_snippet_chars or 300))
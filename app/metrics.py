@@ -16,4 +16,16 @@ LATENCY = Histogram(
 RETRIEVAL_K = Gauge(
     "retriever_docs_returned", "Docs devueltos tras fusión",
     labelnames=["strategy"]
-)
\ No newline at end of file
+)
+
+# Caché persistente de embeddings (hit/miss)
+EMBED_CACHE = Counter(
+    "embed_cache_lookups_total", "Consultas a la caché de embeddings",
+    labelnames=["result"]
+)
+
+# Caché de respuestas de /classify (exact, semantic, miss)
+CLASSIFY_CACHE = Counter(
+    "classify_cache_lookups_total", "Consultas a la caché de respuestas de /classify",
+    labelnames=["result"]
+)
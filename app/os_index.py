@@ -1,32 +1,60 @@
 # app/os_index.py
+import threading
+from typing import Optional
+
 from opensearchpy import OpenSearch
 from .config import get_settings
+from . import hs_codes
+from .quantization import engine_for, knn_index_settings, knn_vector_mapping
 
-def get_os_client() -> OpenSearch:
-    """Crea el cliente de OpenSearch usando variables de entorno/config."""
+_client: Optional[OpenSearch] = None
+_client_lock = threading.Lock()
+
+
+def build_os_client() -> OpenSearch:
+    """Cliente nuevo con el pool/timeouts de Settings.
+    pool_maxsize: conexiones keep-alive reutilizables por host (urllib3 usa 10 por
+    defecto y las ráfagas de /classify + búsquedas en paralelo hacían cola)."""
     s = get_settings()
     # Si usas usuario/contraseña, añade:
     # auth = (s.opensearch_username, s.opensearch_password) if getattr(s, "opensearch_username", None) else None
-    client = OpenSearch(
+    return OpenSearch(
         hosts=[s.opensearch_host],
         # http_auth=auth,  # descomenta si tienes autenticación
-        verify_certs=False
+        verify_certs=False,
+        ssl_show_warn=False,
+        pool_maxsize=int(s.opensearch_pool_maxsize),
+        http_compress=bool(s.opensearch_http_compress),
+        timeout=float(s.opensearch_timeout),
+        max_retries=int(s.opensearch_max_retries),
+        retry_on_timeout=False,
     )
-    return client
 
-def ensure_index(index_name: str | None = None, dim: int | None = None, space: str | None = None):
-    """Crea el índice si no existe, con campo knn_vector y 'text' para BM25.
-    index_name: permite sobreescribir el índice por defecto de settings.
-    """
-    s = get_settings()
-    client = get_os_client()
-    index = index_name or s.opensearch_index
-    if client.indices.exists(index):
-        return
-    dim_val = int(dim or getattr(s, "opensearch_emb_dim", 768))
-    space_val = str(space or getattr(s, "opensearch_knn_space", "cosinesimil"))
-    body = {
-        "settings": {"index": {"knn": True}},
+
+def get_os_client() -> OpenSearch:
+    """Cliente de OpenSearch compartido por proceso (un solo pool de conexiones)."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = build_os_client()
+    return _client
+
+
+def close_os_client() -> None:
+    global _client
+    with _client_lock:
+        if _client is not None:
+            try:
+                _client.close()
+            finally:
+                _client = None
+
+def index_body(dim: int, space: str, vector_mode: str = "float", profile: str = "balanced") -> dict:
+    """Settings + mappings del índice de fragmentos (knn_vector, 'text' para BM25 y
+    'hs_codes' con el normalizer que reduce cualquier grafía de código a dígitos)."""
+    return {
+        "settings": {"index": knn_index_settings(vector_mode, profile), "analysis": hs_codes.ANALYSIS},
         "mappings": {
             "properties": {
                 "fragment_id": {"type": "keyword"},
@@ -44,13 +72,47 @@ def ensure_index(index_name: str | None = None, dim: int | None = None, space: s
                 "partida": {"type": "keyword"},
                 "hs6": {"type": "keyword"},
                 "codigo_producto": {"type": "keyword"},
+                "hs_codes": hs_codes.MAPPING,
+                "embedding_status": {"type": "keyword"},
                 "metadata": {"type": "object", "enabled": True},
-                "embedding": {
-                    "type": "knn_vector",
-                    "dimension": dim_val,
-                    "method": {"name": "hnsw", "space_type": space_val, "engine": "nmslib"},
-                },
+                "embedding": knn_vector_mapping(dim, space, vector_mode, profile),
             }
         },
     }
-    client.indices.create(index=index, body=body)
\ No newline at end of file
+
+def ensure_index(index_name: str | None = None, dim: int | None = None, space: str | None = None,
+                 vector_mode: str | None = None, client: OpenSearch | None = None,
+                 profile: str | None = None) -> bool:
+    """Crea el índice si no existe, con campo knn_vector y 'text' para BM25.
+    index_name: permite sobreescribir el índice por defecto de settings.
+    vector_mode: float | fp16 | byte (por defecto Settings.opensearch_vector_mode).
+    client: reutiliza un cliente existente (p. ej. el de app.state).
+    profile: latency | balanced | recall (por defecto Settings.opensearch_index_profile).
+    Devuelve True si lo creó.
+    """
+    s = get_settings()
+    client = client or get_os_client()
+    index = index_name or s.opensearch_index
+    if client.indices.exists(index=index):
+        return False
+    dim_val = int(dim or getattr(s, "opensearch_emb_dim", 768))
+    space_val = str(space or getattr(s, "opensearch_knn_space", "cosinesimil"))
+    mode_val = str(vector_mode or getattr(s, "opensearch_vector_mode", "float"))
+    profile_val = str(profile or s.opensearch_index_profile)
+    client.indices.create(index=index, body=index_body(dim_val, space_val, mode_val, profile_val))
+    return True
+
+
+def warmup_knn(index_name: str | None = None, client: OpenSearch | None = None,
+               timeout: float | None = None) -> Optional[dict]:
+    """Carga los grafos HNSW del índice en memoria nativa (k-NN warmup API) para
+    que las primeras consultas kNN no paguen esa carga. Bloquea hasta terminar.
+    Devuelve '_shards' de la respuesta; None si KNN_WARMUP_ENABLED=false o el
+    motor es lucene (sus grafos viven en el heap de Lucene, sin warmup)."""
+    s = get_settings()
+    if not s.knn_warmup_enabled or engine_for(s.opensearch_vector_mode, s.opensearch_index_profile) == "lucene":
+        return None
+    client = client or get_os_client()
+    index = index_name or s.opensearch_index
+    resp = client.plugins.knn.warmup(index=index, request_timeout=float(timeout or s.knn_warmup_timeout))
+    return (resp or {}).get("_shards", {})
@@ -5,15 +5,24 @@ Bulk indexing de fragmentos en OpenSearch.
 
 import os
 import json
+import time
 from typing import List, Dict, Any, Iterable
+import numpy as np
 from opensearchpy import helpers
-from .os_index import get_os_client, ensure_index
-from .embedder_gemini import GeminiEmbedder
+from .os_index import get_os_client, ensure_index, warmup_knn
+from .embeddings import get_embedder
+from .embed_cache import normalize_for_key
+from .hs_codes import extract_hs_codes
 from .config import get_settings
+from .quantization import encode_for_index
+from .ttl_cache import TTLCache
+from .reembed_queue import get_reembed_queue
+from .local_ann import DOC_FIELDS, add_fragments, open_local_ann_for_ingest, save_local_ann
 
 def _flatten_metadata(src: Dict[str, Any]) -> Dict[str, Any]:
     """Eleva claves de metadata al nivel raíz para coincidir con el mapeo.
-    Conserva el objeto 'metadata' original.
+    Conserva el objeto 'metadata' original y calcula 'hs_codes' (códigos HS
+    del texto y metadata canonicalizados a dígitos, ver app/hs_codes.py).
     """
     clean_src = json.loads(json.dumps(src, default=str))
     meta = clean_src.get("metadata") or {}
@@ -34,6 +43,8 @@ def _flatten_metadata(src: Dict[str, Any]) -> Dict[str, Any]:
     ):
         if key not in clean_src and key in meta:
             clean_src[key] = meta[key]
+    if "hs_codes" not in clean_src:
+        clean_src["hs_codes"] = extract_hs_codes(clean_src)
     return clean_src
 
 
@@ -48,17 +59,67 @@ def _batched(iterable: Iterable[Any], n: int) -> Iterable[List[Any]]:
         yield batch
 
 
+def _indexable(embedder, vec):
+    """None si el vector no es del modelo del embedder (p.ej. FallbackVector de
+    embedding-001): mezclaría espacios vectoriales en el índice, así que el
+    fragmento queda pendiente de re-embedding."""
+    model = getattr(vec, "model", None)
+    if vec is None or (model is not None and model != getattr(embedder, "model_name", None)):
+        return None
+    return vec
+
+
+def _embed_deduplicated(embedder, texts: List[str], seen: TTLCache) -> tuple[List[List[float] | None], int]:
+    """Embebe una sola vez cada texto normalizado distinto y reparte el vector
+    a todos los fragmentos que lo comparten. `seen` conserva vectores de lotes
+    previos de la misma ingesta como arrays float32 (~3 KB por vector de 768
+    dims, frente a ~25 KB como lista de floats). Devuelve (vectores, textos
+    enviados al embedder); los textos cuyo embedding falló quedan en None.
+    """
+    keys = [normalize_for_key(t if isinstance(t, str) else str(t or "")) for t in texts]
+    vec_by_key: Dict[str, List[float]] = {}
+    pending: Dict[str, str] = {}
+    for k, t in zip(keys, texts):
+        if k in vec_by_key or k in pending:
+            continue
+        v = seen.get(k)
+        if v is not None:
+            vec_by_key[k] = v.tolist()
+        else:
+            pending[k] = t
+    if pending:
+        fresh = embedder.embed_texts(list(pending.values()), strict=False)
+        for k, v in zip(pending, fresh):
+            v = _indexable(embedder, v)
+            if v is None:
+                vec_by_key[k] = None
+                continue
+            arr = np.asarray(v, dtype=np.float32)
+            seen.set(k, arr)
+            # Misma precisión para el primer fragmento y los repetidos de otros lotes
+            vec_by_key[k] = arr.tolist()
+    return [vec_by_key[k] for k in keys], len(pending)
+
+
 def bulk_ingest_fragments(
     fragments: List[Dict[str, Any]],
     index_name: str | None = None,
     *,
     embed: bool | None = None,
     batch_size: int | None = None,
+    warmup: bool = True,
 ):
     """Ingesta en lote de fragmentos en OpenSearch.
 
     - embed: si False, omite embeddings (solo BM25). Control por env NO_EMBED.
     - batch_size: tamaño de lote para embeddings/ingesta. Env OPENSEARCH_EMBED_BATCH (por defecto 64).
+    - Textos repetidos (normalizados) se embeben una sola vez; la ventana entre
+      lotes se acota con OPENSEARCH_DEDUP_WINDOW (por defecto 50000 textos).
+    - Si el embedding de un fragmento falla, se indexa sin vector con
+      embedding_status="pending" y se encola para drain_reembed_queue; los que
+      se embeben bien salen de la cola (su texto encolado quedó obsoleto).
+    - warmup: al terminar, refresh + k-NN warmup para cargar los segmentos nuevos
+      en memoria nativa (False si quien llama ingesta por lotes y calienta al final).
     """
     s = get_settings()
     index = index_name or s.opensearch_index
@@ -72,19 +133,36 @@ def bulk_ingest_fragments(
     ensure_index(index)
 
     total = 0
-    embedder = GeminiEmbedder() if embed_flag else None
+    embedder = get_embedder() if embed_flag else None
+    seen = TTLCache(maxsize=int(os.getenv("OPENSEARCH_DEDUP_WINDOW", 50000)), ttl=0)
+    embedded = 0
+    pending = 0
+    # Índice kNN local del bucket caliente (LOCAL_ANN_PATH); se persiste al final
+    local_ann = open_local_ann_for_ingest() if embedder is not None else None
+    local_added = 0
 
     for frag_batch in _batched(fragments, max(1, int(bsize))):
         texts = [f.get("text", "") for f in frag_batch]
         vectors = None
         if embedder is not None:
-            vectors = embedder.embed_texts(texts)
+            vectors, n_new = _embed_deduplicated(embedder, texts, seen)
+            embedded += n_new
 
         actions = []
+        failed = []
+        embedded_ids = []
+        flat = []
         for i, src in enumerate(frag_batch):
             clean_src = _flatten_metadata(src)
+            flat.append(clean_src)
             if vectors is not None:
-                clean_src["embedding"] = vectors[i]
+                if vectors[i] is not None:
+                    clean_src["embedding"] = encode_for_index(vectors[i])
+                    clean_src["embedding_status"] = "ok"
+                    embedded_ids.append(clean_src["fragment_id"])
+                else:
+                    clean_src["embedding_status"] = "pending"
+                    failed.append((clean_src["fragment_id"], clean_src.get("text", "")))
             actions.append({
                 "_index": index,
                 "_id": clean_src["fragment_id"],
@@ -93,5 +171,105 @@ def bulk_ingest_fragments(
 
         helpers.bulk(client, actions)
         total += len(actions)
+        if local_ann is not None and vectors is not None:
+            local_added += add_fragments(local_ann, flat, vectors)
+        if embedded_ids:
+            get_reembed_queue().ack(index, embedded_ids)
+        if failed:
+            pending += get_reembed_queue().push_many(index, failed, error="embedding failed during ingest")
+
+    print(f"✅ Ingestados {total} fragmentos en {index} (embed={'on' if embed_flag else 'off'})")
+    if embedder is not None and total:
+        ratio = 1 - embedded / total
+        print(f"   dedup: {total} fragmentos → {embedded} textos embebidos ({ratio:.1%} de llamadas evitadas)")
+    if pending:
+        print(f"⚠️ {pending} fragmentos sin embedding quedaron en la cola de re-embedding")
+    if local_added:
+        save_local_ann(local_ann)
+        print(f"   índice local: {local_added} vectores actualizados ({len(local_ann)} en total)")
+    if warmup and embedder is not None and total:
+        try:
+            client.indices.refresh(index=index)
+            shards = warmup_knn(index, client=client)
+            if shards is not None:
+                print(f"   k-NN warmup: {shards.get('successful', 0)}/{shards.get('total', 0)} shards")
+        except Exception as e:
+            print(f"⚠️ k-NN warmup falló: {e}")
+    return {"indexed": total, "embedded": embedded, "pending": pending, "local_ann": local_added}
+
+
+def _heal_local_ann(client, local_ann, healed: List[tuple]) -> int:
+    """Añade al índice local los fragmentos re-embebidos de su bucket. La cola
+    solo guarda id y texto: los campos del hit (bucket, hs6, ...) se leen con
+    un _mget por índice."""
+    added = 0
+    by_index: Dict[str, List[tuple]] = {}
+    for index, fid, vec in healed:
+        by_index.setdefault(index, []).append((fid, vec))
+    for index, items in by_index.items():
+        resp = client.mget(index=index, body={"ids": [fid for fid, _ in items]}, _source=list(DOC_FIELDS) + ["text"])
+        found = {d["_id"]: d.get("_source") or {} for d in resp.get("docs", []) if d.get("found")}
+        pairs = [({**found[fid], "fragment_id": fid}, vec) for fid, vec in items if fid in found]
+        added += add_fragments(local_ann, [f for f, _ in pairs], [v for _, v in pairs])
+    return added
+
+
+def drain_reembed_queue(
+    index_name: str | None = None,
+    *,
+    batch_size: int = 64,
+    max_batches: int | None = None,
+) -> Dict[str, int]:
+    """Re-embebe fragmentos en cola y actualiza solo 'embedding' y
+    'embedding_status' en el índice (update parcial). Cada fila se procesa a lo
+    sumo una vez por pasada; las que vuelven a fallar suman un intento y esperan
+    su backoff (REEMBED_RETRY_BACKOFF); tras REEMBED_MAX_ATTEMPTS quedan 'dead'.
+    Los reparados del bucket LOCAL_ANN_BUCKET se añaden también al índice local.
+    """
+    queue = get_reembed_queue()
+    client = get_os_client()
+    embedder = get_embedder()
+    healed = failed = batches = 0
+    local_ann = open_local_ann_for_ingest()
+    local_added = 0
+    pass_started = time.time()
+
+    while max_batches is None or batches < max_batches:
+        rows = queue.peek_batch(batch_size, index=index_name, due_at=pass_started)
+        if not rows:
+            break
+        batches += 1
+        vectors = [_indexable(embedder, v) for v in embedder.embed_texts([r["text"] for r in rows], strict=False)]
+
+        by_index: Dict[str, Dict[str, List[str]]] = {}
+        actions = []
+        fixed = []
+        for r, v in zip(rows, vectors):
+            bucket = by_index.setdefault(r["index"], {"ok": [], "failed": []})
+            if v is None:
+                bucket["failed"].append(r["fragment_id"])
+                continue
+            bucket["ok"].append(r["fragment_id"])
+            fixed.append((r["index"], r["fragment_id"], v))
+            actions.append({
+                "_op_type": "update",
+                "_index": r["index"],
+                "_id": r["fragment_id"],
+                "doc": {"embedding": encode_for_index(v), "embedding_status": "ok"},
+            })
+        if actions:
+            helpers.bulk(client, actions)
+        if local_ann is not None and fixed:
+            try:
+                local_added += _heal_local_ann(client, local_ann, fixed)
+            except Exception as e:
+                print(f"⚠️ No se pudo actualizar el índice local con {len(fixed)} reparados: {e}")
+        for idx, res in by_index.items():
+            queue.ack(idx, res["ok"])
+            queue.fail(idx, res["failed"], "embedding failed during re-embed")
+            healed += len(res["ok"])
+            failed += len(res["failed"])
 
-    print(f"✅ Ingestados {total} fragmentos en {index} (embed={'on' if embed_flag else 'off'})")
\ No newline at end of file
+    if local_added:
+        save_local_ann(local_ann)
+    return {"healed": healed, "failed": failed, "batches": batches, "local_ann": local_added, **queue.counts()}
\ No newline at end of file
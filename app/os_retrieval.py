@@ -2,11 +2,34 @@
 app/os_retrieval.py
 Recuperación semántica desde OpenSearch usando embeddings.
 """
-from typing import List, Dict
+import json
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, List, Dict, Optional, Sequence, Tuple
 from app.os_index import get_os_client
 from app.config import get_settings
 from app.metrics import RETRIEVAL_K
-from app.embedder_gemini import GeminiEmbedder
+from app.ttl_cache import TTLCache
+from app.embeddings import get_embedder
+from app.quantization import effective_space, encode_for_index, supports_knn_filter
+from app.domain_terms import chapter_of, default_chapters, has_terms, terms_for
+from app.hs_codes import HS_CODES_FIELD, hs_digits
+from app.rerank import rerank as rerank_hits
+from app.local_ann import DOC_FIELDS as _LOCAL_FIELDS, get_local_ann
+
+logger = logging.getLogger(__name__)
+
+# Pool compartido para lanzar BM25 y kNN en paralelo (2 tareas por consulta)
+_HYBRID_POOL = ThreadPoolExecutor(max_workers=16, thread_name_prefix="hybrid-search")
+
+# Código HS mencionado en la consulta: 4011, 4011.10, 4011.10.00
+_HS_CODE_RE = re.compile(r"\b(\d{4})(?:\.(\d{2}))?(?:\.(\d{2}))?\b")
+
+_HIT_SOURCE = ["fragment_id", "text", "bucket", "unit", "doc_id", "chapter", "heading", "subheading",
+               "partida", "hs6", "hs_codes"]
+_SUPPORT_SOURCE = ["fragment_id", "text", "bucket", "unit", "doc_id"]
 
 def retrieve_fragments(query_text: str, top_k: int = 5, index: str = None) -> list:
     """
@@ -17,13 +40,12 @@ def retrieve_fragments(query_text: str, top_k: int = 5, index: str = None) -> li
         index = settings.opensearch_index
     
     client = get_os_client()
-    embedder = GeminiEmbedder()
     
     # Actualizar métrica de retrieval_k
     RETRIEVAL_K.labels(strategy="hybrid").set(top_k)
     
     # Generar embedding para la query
-    query_vector = embedder.embed_texts([query_text])[0]
+    query_vector = encode_for_index(get_embedder().embed_query(query_text))
 
     # Búsqueda kNN nativa de OpenSearch
     body = {
@@ -62,148 +84,616 @@ def _hs_variants(code: str) -> List[str]:
     with_space_after = c.replace(".", ". ")
     with_space_before = c.replace(".", " .")
     spaced_both = c.replace(".", " . ")
-    return list({c, no_dot, with_space, with_dash, with_space_after, with_space_before, spaced_both})
+    return sorted({c, no_dot, with_space, with_dash, with_space_after, with_space_before, spaced_both})
+
+@lru_cache(maxsize=256)
+def _domain_clauses(chapters: Tuple[str, ...], boost: float) -> Tuple[Dict, ...]:
+    """Un único match OR con el vocabulario de los capítulos (antes, un clause por término)."""
+    terms = terms_for(chapters)
+    if not terms:
+        return ()
+    return ({"match": {"text": {"query": " ".join(terms), "boost": boost}}},)
+
+
+# index_state.validate_index lo pone en False si algún índice detrás del
+# alias no tiene el campo (índice anterior sin reindexar)
+_HS_CODES_AVAILABLE = True
+
+
+def set_hs_codes_available(available: bool) -> None:
+    """Activa/desactiva las term queries sobre 'hs_codes' según el mapping real."""
+    global _HS_CODES_AVAILABLE
+    if available != _HS_CODES_AVAILABLE:
+        _HS_CODES_AVAILABLE = available
+        _support_clauses.cache_clear()
+        _hs_code_clauses.cache_clear()
+
+
+def _use_hs_codes_field() -> bool:
+    return get_settings().opensearch_hs_codes_field and _HS_CODES_AVAILABLE
+
+
+def _hs_terms(code: str, boost: float, heading_boost: float) -> Tuple[Dict, ...]:
+    """term sobre 'hs_codes' (todas las grafías indexadas como dígitos) para el
+    código y su partida de 4 dígitos."""
+    digits = hs_digits(code)
+    clauses = [{"term": {HS_CODES_FIELD: {"value": digits, "boost": boost}}}]
+    if len(digits) > 4:
+        clauses.append({"term": {HS_CODES_FIELD: {"value": digits[:4], "boost": heading_boost}}})
+    return tuple(clauses)
+
+
+@lru_cache(maxsize=1024)
+def _support_clauses(code: str) -> Tuple[Dict, ...]:
+    heading = code.split(".")[0]  # '4011' de '4011.10'
+    if _use_hs_codes_field():
+        return (*_hs_terms(code, 8.0, 6.0), *_domain_clauses((chapter_of(code),), 3.0))
+    # Boosts más altos al match exacto del código y el heading
+    return (
+        {"match_phrase": {"text": {"query": code, "boost": 8.0}}},
+        {"match_phrase": {"text": {"query": heading, "boost": 6.0}}},
+        *({"match": {"text": {"query": t, "boost": 3.0}}} for t in _hs_variants(code) + [heading]),
+        *_domain_clauses((chapter_of(code),), 3.0),
+    )
+
+
+@lru_cache(maxsize=1024)
+def _code_keyword_clauses(code: str) -> Tuple[Dict, ...]:
+    """
+    Lookup exacto sobre los campos keyword (sin análisis de texto, cacheable):
+    partida = línea nacional en dígitos (prefijo), hs6 = 6 dígitos,
+    subheading/heading en formato con o sin punto.
+    """
+    digits = "".join(ch for ch in code if ch.isdigit())
+    if len(digits) < 4:
+        return ()
+    h4 = digits[:4]
+
+    def boosted(flt: Dict, boost: float) -> Dict:
+        return {"constant_score": {"filter": flt, "boost": boost}}
+
+    clauses = [boosted({"prefix": {"partida": digits}}, 4.0)]
+    if len(digits) >= 6:
+        d6 = digits[:6]
+        clauses += [
+            boosted({"term": {"hs6": d6}}, 3.0),
+            boosted({"terms": {"subheading": [f"{h4}.{d6[4:]}", d6]}}, 3.0),
+        ]
+    else:
+        clauses.append(boosted({"prefix": {"hs6": h4}}, 1.0))
+    clauses.append(boosted({"terms": {"heading": [h4, f"{h4[:2]}.{h4[2:]}"]}}, 1.0))
+    return tuple(clauses)
+
+
+_SUPPORT_CACHE: Optional[TTLCache] = None
+
+
+def _support_cache() -> TTLCache:
+    global _SUPPORT_CACHE
+    if _SUPPORT_CACHE is None:
+        s = get_settings()
+        _SUPPORT_CACHE = TTLCache(s.support_cache_size, s.support_cache_ttl)
+    return _SUPPORT_CACHE
+
+
+def _support_result(h: Dict, reason: str) -> Dict:
+    src = h.get("_source", {})
+    return {
+        "fragment_id": src.get("fragment_id"),
+        "score": h.get("_score", 0.0),
+        "text": src.get("text", ""),
+        "bucket": src.get("bucket"),
+        "unit": src.get("unit"),
+        "doc_id": src.get("doc_id"),
+        "reason": reason,
+    }
+
 
 def retrieve_support_for_code(os_client, index_name: str, code: str, k: int = 5) -> List[Dict]:
     """
-    Recupera evidencia textual que soporte el código HS elegido (BM25 léxico).
+    Recupera evidencia que soporte el código HS elegido.
+    1) lookup exacto en partida/hs6/subheading/heading (keyword, request_cache);
+    2) solo si no llega a k resultados, completa con BM25 sobre 'text'
+       (variantes del código, heading y vocabulario del capítulo).
+    El resultado se cachea por (índice, código, k) en memoria.
     """
+    code = (code or "").strip()
     if not code:
         return []
-    heading = code.split(".")[0]  # '4011' de '4011.10'
-    terms = _hs_variants(code) + [heading, "neumático", "neumáticos", "tire", "tires", "tyre", "tyres", "pneumatic"]
-    # Construimos 'should' con boosts más altos al match exacto del código y el heading
-    should = [
-        {"match_phrase": {"text": {"query": code, "boost": 8.0}}},
-        {"match_phrase": {"text": {"query": heading, "boost": 6.0}}},
-    ] + [{"match": {"text": {"query": t, "boost": 3.0}}} for t in terms]
+    cache = _support_cache()
+    key = (index_name, code, int(k))
+    cached = cache.get(key)
+    if cached is not None:
+        return [dict(r) for r in cached]
 
-    body = {
-        "size": k,
-        "query": {"bool": {"should": should, "minimum_should_match": 1}},
-        "_source": ["fragment_id", "text", "bucket", "unit", "doc_id"],
-    }
-    resp = os_client.search(index=index_name, body=body)
-    hits = resp.get("hits", {}).get("hits", [])
-    results = []
+    results: List[Dict] = []
+    keyword = list(_code_keyword_clauses(code))
+    if keyword:
+        body = {
+            "size": k,
+            "query": {"bool": {"should": keyword, "minimum_should_match": 1}},
+            "_source": _SUPPORT_SOURCE,
+        }
+        resp = os_client.search(index=index_name, body=body, request_cache=True)
+        results = [_support_result(h, "hs_code_match") for h in resp.get("hits", {}).get("hits", [])]
+
+    if len(results) < k:
+        body = {
+            "size": k,
+            "query": {"bool": {"should": list(_support_clauses(code)), "minimum_should_match": 1}},
+            "_source": _SUPPORT_SOURCE,
+        }
+        resp = os_client.search(index=index_name, body=body)
+        seen = {r["fragment_id"] for r in results}
+        for h in resp.get("hits", {}).get("hits", []):
+            r = _support_result(h, "support_for_code")
+            if r["fragment_id"] not in seen and len(results) < k:
+                results.append(r)
+
+    cache.set(key, results)
+    return [dict(r) for r in results]
+
+def candidate_codes(hits: List[Dict], limit: int = 3) -> List[str]:
+    """
+    Códigos HS (6 dígitos, '4011.10') ya visibles en los hits vía hs6/partida/
+    subheading, en orden de ranking y sin duplicados.
+    """
+    codes: List[str] = []
     for h in hits:
-        src = h.get("_source", {})
-        results.append({
-            "fragment_id": src.get("fragment_id"),
-            "score": h.get("_score", 0.0),
-            "text": src.get("text", ""),
-            "bucket": src.get("bucket"),
-            "unit": src.get("unit"),
-            "doc_id": src.get("doc_id"),
-            "reason": "support_for_code",
-        })
-    return results
-
-def knn_semantic_search(os_client, index: str, query_text: str, k: int = 5) -> List[Dict]:
+        src = h.get("_source") or {}
+        for field in ("hs6", "partida", "subheading"):
+            digits = "".join(ch for ch in str(src.get(field) or "") if ch.isdigit())
+            if len(digits) >= 6:
+                code = f"{digits[:4]}.{digits[4:6]}"
+                if code not in codes:
+                    codes.append(code)
+                break
+        if len(codes) >= limit:
+            break
+    return codes
+
+
+def prefetch_support(os_client, index_name: str, codes: Sequence[str], k: int = 3) -> Dict[str, List[Dict]]:
+    """Evidencia por código para varios candidatos (se lanza mientras genera el LLM)."""
+    out: Dict[str, List[Dict]] = {}
+    for code in codes:
+        try:
+            out[code] = retrieve_support_for_code(os_client, index_name, code, k=k)
+        except Exception as e:
+            logger.warning("Prefetch de evidencia para %s falló: %s", code, e)
+    return out
+
+
+def match_prefetched(prefetched: Dict[str, List[Dict]], code: str) -> Optional[List[Dict]]:
+    """Evidencia precargada para el código elegido (mismo hs6), o None."""
+    digits = "".join(ch for ch in (code or "") if ch.isdigit())
+    if len(digits) < 6:
+        return prefetched.get(code)
+    for pcode, results in prefetched.items():
+        if "".join(ch for ch in pcode if ch.isdigit())[:6] == digits[:6]:
+            return results
+    return None
+
+
+def build_filters(
+    bucket: str | Sequence[str] | None = None,
+    edition: str | Sequence[str] | None = None,
+    chapter: str | Sequence[str] | None = None,
+    hs6: str | Sequence[str] | None = None,
+    valid_at: Any = None,
+) -> List[Dict]:
+    """
+    Cláusulas 'filter' sobre los campos keyword/date del índice. Cada campo
+    acepta un valor o una lista (OR); hs6 se normaliza a dígitos ("4011.10" ->
+    "401110", como se indexa). valid_at (fecha ISO) exige que el
+    fragmento esté vigente en esa fecha; los que no tienen vigencia pasan.
+    """
+    clauses: List[Dict] = []
+    for field, value in (("bucket", bucket), ("edition", edition), ("chapter", chapter), ("hs6", hs6)):
+        if value is None or value == "" or value == []:
+            continue
+        values = [value] if isinstance(value, str) else list(value)
+        if field == "hs6":
+            values = [hs_digits(v) for v in values]
+        clauses.append({"terms": {field: values}} if len(values) > 1 else {"term": {field: values[0]}})
+    if valid_at:
+        day = valid_at.isoformat() if hasattr(valid_at, "isoformat") else str(valid_at)
+        for field, op in (("validity_from", "lte"), ("validity_to", "gte")):
+            clauses.append({"bool": {"should": [
+                {"range": {field: {op: day}}},
+                {"bool": {"must_not": {"exists": {"field": field}}}},
+            ], "minimum_should_match": 1}})
+    return clauses
+
+
+def knn_semantic_search(os_client, index: str, query_text: str, k: int = 5,
+                        query_vector: Optional[List[float]] = None,
+                        filters: Optional[List[Dict]] = None,
+                        snippet_chars: int = 0) -> List[Dict]:
     """
     Busca semánticamente con embeddings en el campo 'embedding' (knn_vector).
     Requiere que el índice tenga el mapping con knn_vector (ver os_index.ensure_index).
+    query_vector: embedding ya calculado (p. ej. con embed_query_async); evita re-embeber.
+    filters: cláusulas de build_filters, aplicadas como pre-filtro (ver _knn_body).
+    snippet_chars: > 0 devuelve un snippet en vez del texto completo (ver _with_snippets).
     """
     if not query_text:
         return []
-    embedder = GeminiEmbedder()
-    qvec = embedder.embed_texts([query_text])[0]
-    body = {
-        "size": k,
-        "query": {
-            "knn": {
-                "embedding": {
-                    "vector": qvec,
-                    "k": k
-                }
-            }
-        },
-        "_source": ["fragment_id","text","bucket","unit","doc_id","chapter","heading","subheading"]
-    }
+    qvec = query_vector if query_vector is not None else get_embedder().embed_query(query_text)
+    exact = _exact_knn_ok(os_client, index, filters)
+    body = _with_snippets(_knn_body(qvec, k, filters, exact=exact), query_text, snippet_chars)
     resp = os_client.search(index=index, body=body)
-    return resp.get("hits", {}).get("hits", [])
+    return _apply_snippets(resp.get("hits", {}).get("hits", []))
+
+
+_FILTER_COUNTS = TTLCache(maxsize=512, ttl=300)
+
+
+def _exact_knn_ok(os_client, index: str, filters: Optional[List[Dict]]) -> bool:
+    """
+    nmslib con filtros: True si el subconjunto filtrado es pequeño (<=
+    KNN_EXACT_MAX_DOCS) y conviene el kNN exacto. El conteo se cachea por
+    filtros (un _count por combinación cada 5 min); si falla, se asume grande.
+    """
+    s = get_settings()
+    if not filters or supports_knn_filter(s.opensearch_vector_mode, s.opensearch_index_profile):
+        return False
+    key = (index, json.dumps(filters, sort_keys=True, default=str))
+    n = _FILTER_COUNTS.get(key)
+    if n is None:
+        try:
+            n = int(os_client.count(index=index, body={"query": {"bool": {"filter": filters}}}).get("count", 0))
+        except Exception as e:
+            logger.warning("Conteo de filtros falló (%s); kNN con post-filtro", e)
+            n = s.knn_exact_max_docs + 1
+        _FILTER_COUNTS.set(key, n)
+    return n <= s.knn_exact_max_docs
+
+
+def _knn_body(query_vector: List[float], k: int = 5, filters: Optional[List[Dict]] = None,
+              exact: bool = False) -> Dict:
+    """
+    Con filtros:
+    - lucene/faiss (todos los perfiles y modos por defecto): 'filter' dentro del
+      kNN, pre-filtrado eficiente que devuelve k hits del subconjunto.
+    - nmslib (solo con OPENSEARCH_KNN_ENGINE=nmslib, índices anteriores) no
+      puede pre-filtrar: con exact=True (subconjunto pequeño, ver _exact_knn_ok)
+      kNN exacto (script knn_score) sobre el subconjunto; si es grande, kNN
+      aproximado con k * KNN_FILTER_OVERSAMPLE vecinos y post-filtro, que puede
+      devolver menos de k hits. Reindexar con faiss para pre-filtrar.
+    """
+    s = get_settings()
+    vector = encode_for_index(query_vector)
+    if not filters:
+        query = {"knn": {"embedding": {"vector": vector, "k": k}}}
+    elif supports_knn_filter(s.opensearch_vector_mode, s.opensearch_index_profile):
+        query = {"knn": {"embedding": {"vector": vector, "k": k, "filter": {"bool": {"filter": filters}}}}}
+    elif not exact:
+        oversampled = k * max(1, int(s.knn_filter_oversample))
+        query = {"bool": {"must": [{"knn": {"embedding": {"vector": vector, "k": oversampled}}}],
+                          "filter": filters}}
+    else:
+        query = {"script_score": {
+            "query": {"bool": {"filter": filters}},
+            "script": {
+                "lang": "knn",
+                "source": "knn_score",
+                "params": {
+                    "field": "embedding",
+                    "query_value": vector,
+                    "space_type": effective_space(s.opensearch_knn_space, s.opensearch_vector_mode,
+                                                  s.opensearch_index_profile),
+                },
+            },
+        }}
+    return {"size": k, "query": query, "_source": _HIT_SOURCE}
 
 
-def _bm25_body(query_text: str, k: int = 5) -> Dict:
+@lru_cache(maxsize=1024)
+def _hs_code_clauses(code: str) -> Tuple[Dict, ...]:
+    if _use_hs_codes_field():
+        return _hs_terms(code, 6.0, 4.0)
+    return (
+        *({"match_phrase": {"text": {"query": v, "boost": 6.0}}} for v in _hs_variants(code)),
+        {"match_phrase": {"text": {"query": code.split(".")[0], "boost": 4.0}}},
+    )
+
+
+def _bm25_body(query_text: str, k: int = 5, filters: Optional[List[Dict]] = None) -> Dict:
     """
     BM25 léxico con leves boosts a términos del dominio y variantes HS si aplica.
+    Solo la consulta varía por request; el resto de cláusulas está precalculado.
+    El vocabulario es el del capítulo del código mencionado (si está configurado)
+    o el de DOMAIN_DEFAULT_CHAPTERS.
     """
-    terms = ["neumático", "neumáticos", "llanta", "llantas", "caucho", "pneumatic", "tyre", "tyres", "tire", "tires"]
-    should = [
-        {"match": {"text": {"query": query_text, "boost": 3.0}}},
-    ] + [{"match": {"text": {"query": t, "boost": 2.0}}} for t in terms]
+    should = [{"match": {"text": {"query": query_text, "boost": 3.0}}}]
 
     # Si el usuario ya menciona un código tipo 4011.10, añade variantes y boost
-    import re
-    m = re.search(r"\b(\d{4})(?:\.(\d{2}))?(?:\.(\d{2}))?\b", query_text)
+    m = _HS_CODE_RE.search(query_text)
+    chapters = default_chapters()
     if m:
-        code = ".".join([p for p in m.groups() if p]) if m.groups() else m.group(1)
-        for v in _hs_variants(code):
-            should.append({"match_phrase": {"text": {"query": v, "boost": 6.0}}})
-        should.append({"match_phrase": {"text": {"query": code.split('.')[0], "boost": 4.0}}})
+        code = ".".join(p for p in m.groups() if p)
+        should.extend(_hs_code_clauses(code))
+        if has_terms(chapter_of(code)):
+            chapters = (chapter_of(code),)
+    should.extend(_domain_clauses(chapters, 2.0))
 
-    return {
-        "size": k,
-        "query": {"bool": {"should": should, "minimum_should_match": 1}},
-        "_source": ["fragment_id","text","bucket","unit","doc_id","chapter","heading","subheading"],
-    }
+    query: Dict = {"bool": {"should": should, "minimum_should_match": 1}}
+    if filters:
+        query["bool"]["filter"] = filters
+    return {"size": k, "query": query, "_source": _HIT_SOURCE}
 
 
-def bm25_search(os_client, index: str, query_text: str, k: int = 5) -> List[Dict]:
-    body = _bm25_body(query_text, k=k)
+def bm25_search(os_client, index: str, query_text: str, k: int = 5,
+                filters: Optional[List[Dict]] = None, snippet_chars: int = 0) -> List[Dict]:
+    body = _with_snippets(_bm25_body(query_text, k=k, filters=filters), query_text, snippet_chars)
     resp = os_client.search(index=index, body=body)
-    return resp.get("hits", {}).get("hits", [])
+    return _apply_snippets(resp.get("hits", {}).get("hits", []))
 
 
-def ensure_index_exists(os_client, index_name: str):
-    """Crea el índice si no existe."""
-    if os_client.indices.exists(index=index_name):
-        return
-    
-    emb_dim = int(os.getenv('OPENSEARCH_EMB_DIM', '768'))
-    knn_space = os.getenv('OPENSEARCH_KNN_SPACE', 'cosinesimil')
-    
-    mapping = {
-        "settings": {
-            "index": {
-                "knn": True,
-                "knn.algo_param.ef_search": 100
-            }
-        },
-        "mappings": {
-            "properties": {
-                "text": {"type": "text"},
-                "embedding": {
-                    "type": "knn_vector",
-                    "dimension": emb_dim,
-                    "method": {
-                        "name": "hnsw",
-                        "space_type": knn_space,
-                        "engine": "nmslib"
-                    }
-                },
-                "metadata": {"type": "object", "enabled": False}
-            }
-        }
+def _with_snippets(body: Dict, query_text: str, snippet_chars: int) -> Dict:
+    """
+    Pide a OpenSearch un único fragmento resaltado de 'text' (sin etiquetas) de
+    hasta snippet_chars caracteres en lugar del campo completo; no_match_size
+    garantiza un prefijo acotado también para hits de kNN sin términos en común.
+    """
+    if not snippet_chars or snippet_chars <= 0:
+        return body
+    body["_source"] = [f for f in body.get("_source", _HIT_SOURCE) if f != "text"]
+    body["highlight"] = {
+        "pre_tags": [""],
+        "post_tags": [""],
+        "fields": {"text": {
+            "type": "unified",
+            "fragment_size": int(snippet_chars),
+            "number_of_fragments": 1,
+            "no_match_size": int(snippet_chars),
+        }},
     }
-    
-    os_client.indices.create(index=index_name, body=mapping)
-    logger.info(f"Created index: {index_name}")
+    if query_text:
+        body["highlight"]["highlight_query"] = {"match": {"text": query_text}}
+    return body
+
+
+def _apply_snippets(hits: List[Dict]) -> List[Dict]:
+    """Copia el snippet a _source.text y marca el hit como '_snippet' (texto parcial)."""
+    for h in hits:
+        src = h.setdefault("_source", {})
+        if "text" in src:
+            continue
+        fragments = (h.get("highlight") or {}).get("text") or []
+        src["text"] = " … ".join(fragments)
+        h["_snippet"] = True
+    return hits
+
 
-def hybrid_search_with_fallback(os_client, index: str, query_text: str, k: int = 5) -> List[Dict]:
+def hydrate_hits(os_client, index: str, hits: List[Dict], n: int) -> List[Dict]:
     """
-    1) Intenta KNN semántico con embeddings.
-    2) Si vacío o falla, cae a BM25 con boosts de dominio.
+    Trae el 'text' completo (un _mget) solo para los primeros n hits con snippet,
+    p. ej. los que entran al prompt. Si falla, se quedan con el snippet.
     """
-    # Asegurar que el índice existe
-    ensure_index_exists(os_client, index)
-
+    pending = [h for h in hits[:n] if h.get("_snippet") and h.get("_id")]
+    if not pending:
+        return hits
     try:
-        hits = knn_semantic_search(os_client, index, query_text, k)
-        if hits:
-            return hits
-    except Exception:
-        # log outside if you prefer; silence to fall back
-        pass
-
-    return bm25_search(os_client, index, query_text, k)
+        resp = os_client.mget(index=index, body={"ids": [h["_id"] for h in pending]}, _source=["text"])
+    except Exception as e:
+        logger.warning("No se pudo rehidratar el texto de %d hits: %s", len(pending), e)
+        return hits
+    full = {d["_id"]: (d.get("_source") or {}).get("text") for d in resp.get("docs", []) if d.get("found")}
+    for h in pending:
+        if full.get(h["_id"]) is not None:
+            h["_source"]["text"] = full[h["_id"]]
+            h.pop("_snippet", None)
+    return hits
+
+
+def msearch(os_client, index: str, bodies: List[Dict]) -> List[List[Dict] | Exception]:
+    """
+    Envía varias búsquedas en un solo _msearch y demultiplexa las respuestas.
+    Cada posición trae la lista de hits o la excepción de esa sub-búsqueda.
+    """
+    payload: List[Dict] = []
+    for b in bodies:
+        payload.append({"index": index})
+        payload.append(b)
+    resp = os_client.msearch(body=payload)
+    out: List[List[Dict] | Exception] = []
+    for r in resp.get("responses", []):
+        if r.get("error"):
+            err = r["error"]
+            reason = err.get("reason") if isinstance(err, dict) else err
+            out.append(RuntimeError(f"msearch sub-query failed: {reason}"))
+        else:
+            out.append(r.get("hits", {}).get("hits", []))
+    if len(out) != len(bodies):
+        raise RuntimeError(f"msearch devolvió {len(out)} respuestas para {len(bodies)} consultas")
+    return out
+
+
+def rrf_fusion(
+    ranked_lists: Sequence[List[Dict]],
+    k: int = 60,
+    weights: Optional[Sequence[float]] = None,
+    topn: Optional[int] = None,
+) -> List[Dict]:
+    """
+    Reciprocal Rank Fusion: score(d) = sum_i w_i / (k + rank_i(d)), rank desde 1.
+    Conserva la forma de hit de OpenSearch (_id, _score, _source); _score pasa
+    a ser el score fusionado.
+    """
+    weights = list(weights) if weights is not None else [1.0] * len(ranked_lists)
+    fused: Dict[str, float] = {}
+    first_hit: Dict[str, Dict] = {}
+    for hits, w in zip(ranked_lists, weights):
+        for rank, h in enumerate(hits or [], start=1):
+            doc_id = h.get("_id") or (h.get("_source") or {}).get("fragment_id")
+            if doc_id is None:
+                continue
+            fused[doc_id] = fused.get(doc_id, 0.0) + float(w) / (k + rank)
+            first_hit.setdefault(doc_id, h)
+    order = sorted(fused, key=lambda d: fused[d], reverse=True)
+    if topn is not None:
+        order = order[:topn]
+    return [{**first_hit[d], "_score": fused[d]} for d in order]
+
+
+def _local_match(filters: Optional[List[Dict]], bucket: str) -> Optional[Dict[str, set]]:
+    """
+    Traduce filters a {campo: valores} si el índice local puede resolverlos:
+    deben fijar bucket == LOCAL_ANN_BUCKET y el resto ser term/terms sobre
+    campos guardados localmente. None = la consulta va a OpenSearch.
+    """
+    match: Dict[str, set] = {}
+    for clause in filters or []:
+        kind = next(iter(clause), None)
+        if kind not in ("term", "terms"):
+            return None
+        field, value = next(iter(clause[kind].items()))
+        if field not in _LOCAL_FIELDS:
+            return None
+        match[field] = {str(v) for v in (value if kind == "terms" else [value])}
+    return match if match.get("bucket") == {bucket} else None
+
+
+def _local_knn_search(query_vector: Optional[List[float]], k: int,
+                      filters: Optional[List[Dict]]) -> Optional[List[Dict]]:
+    """Lado kNN servido en proceso (app/local_ann.py) si aplica; None si no."""
+    if query_vector is None or not filters:
+        return None
+    s = get_settings()
+    match = _local_match(filters, s.local_ann_bucket)
+    if match is None:
+        return None
+    local = get_local_ann()
+    if local is None or not len(local):
+        return None
+    return local.search(query_vector, k, nprobe=s.local_ann_nprobe, match=match)
+
+
+def hybrid_search(
+    os_client,
+    index: str,
+    query_text: str,
+    k: int = 5,
+    *,
+    query_vector: Optional[List[float]] = None,
+    rrf_k: Optional[int] = None,
+    bm25_weight: Optional[float] = None,
+    knn_weight: Optional[float] = None,
+    bm25_depth: Optional[int] = None,
+    knn_depth: Optional[int] = None,
+    use_msearch: Optional[bool] = None,
+    filters: Optional[List[Dict]] = None,
+    snippet_chars: int = 0,
+    rerank: Optional[bool] = None,
+    skip_knn: bool = False,
+) -> List[Dict]:
+    """
+    Híbrido real: lanza BM25 y kNN en paralelo (latencia ~ max de ambos) y
+    fusiona con RRF. Si un lado falla, se usa solo el otro.
+    use_msearch (default Settings.hybrid_msearch): con el vector de consulta ya
+    disponible, envía ambas sub-consultas en un único _msearch (un round-trip).
+    Parámetros por defecto desde Settings (hybrid_rrf_k, hybrid_*_weight, hybrid_*_depth);
+    *_depth es cuántos candidatos trae cada lado antes de fusionar.
+    filters (build_filters) restringe ambos lados; en kNN como pre-filtro.
+    snippet_chars > 0: los hits traen un snippet resaltado en _source.text y
+    quien llama rehidrata lo que necesite (hydrate_hits, como /classify vía
+    hybrid_search_with_fallback). Por defecto 0: texto completo (los hits del
+    índice local, que guarda solo un prefijo, se rehidratan aquí).
+    Si filters se limita al bucket de LOCAL_ANN_PATH, el lado kNN se resuelve
+    en proceso con el índice local memory-mapped.
+    rerank (default Settings.rerank_enabled): cada lado trae al menos
+    Settings.rerank_pool candidatos, se fusiona el pool completo y app.rerank
+    elige los k finales.
+    skip_knn: solo BM25 (p. ej. el embedding de la consulta ya falló; no se
+    vuelve a pedir al embedder desde un worker).
+    """
+    s = get_settings()
+    rrf_k = rrf_k if rrf_k is not None else s.hybrid_rrf_k
+    bm25_weight = bm25_weight if bm25_weight is not None else s.hybrid_bm25_weight
+    knn_weight = knn_weight if knn_weight is not None else s.hybrid_knn_weight
+    bm25_depth = max(k, bm25_depth if bm25_depth is not None else s.hybrid_bm25_depth)
+    knn_depth = max(k, knn_depth if knn_depth is not None else s.hybrid_knn_depth)
+
+    use_msearch = s.hybrid_msearch if use_msearch is None else use_msearch
+    rerank = s.rerank_enabled if rerank is None else rerank
+    if rerank:
+        bm25_depth = max(bm25_depth, s.rerank_pool)
+        knn_depth = max(knn_depth, s.rerank_pool)
+
+    sides, weights, knn_scores = [], [], {}
+    local_knn = None if skip_knn else _local_knn_search(query_vector, knn_depth, filters)
+    if skip_knn:
+        try:
+            bm25 = bm25_search(os_client, index, query_text, bm25_depth, filters=filters,
+                               snippet_chars=snippet_chars)
+        except Exception as e:
+            bm25 = e
+        results = [("bm25", bm25, bm25_weight)]
+    elif local_knn is not None:
+        # kNN en proceso (bucket caliente): solo BM25 viaja a OpenSearch
+        try:
+            bm25 = bm25_search(os_client, index, query_text, bm25_depth, filters=filters,
+                               snippet_chars=snippet_chars)
+        except Exception as e:
+            bm25 = e
+        results = [("bm25", bm25, bm25_weight), ("knn", local_knn, knn_weight)]
+    elif use_msearch and query_vector is not None:
+        bodies = [_with_snippets(b, query_text, snippet_chars) for b in (
+            _bm25_body(query_text, k=bm25_depth, filters=filters),
+            _knn_body(query_vector, knn_depth, filters, exact=_exact_knn_ok(os_client, index, filters)),
+        )]
+        results = [(name, res if isinstance(res, Exception) else _apply_snippets(res), w)
+                   for name, res, w in zip(("bm25", "knn"), msearch(os_client, index, bodies),
+                                           (bm25_weight, knn_weight))]
+    else:
+        f_bm25 = _HYBRID_POOL.submit(bm25_search, os_client, index, query_text, bm25_depth,
+                                     filters=filters, snippet_chars=snippet_chars)
+        f_knn = _HYBRID_POOL.submit(knn_semantic_search, os_client, index, query_text, knn_depth,
+                                    query_vector=query_vector, filters=filters, snippet_chars=snippet_chars)
+        results = []
+        for name, fut, w in (("bm25", f_bm25, bm25_weight), ("knn", f_knn, knn_weight)):
+            try:
+                results.append((name, fut.result(), w))
+            except Exception as e:
+                results.append((name, e, w))
+
+    for name, res, w in results:
+        if isinstance(res, Exception):
+            logger.warning("Búsqueda %s falló: %s", name, res)
+            continue
+        sides.append(res)
+        weights.append(w)
+        if name == "knn":
+            knn_scores = {h.get("_id"): float(h.get("_score") or 0.0) for h in res}
+    if not sides:
+        raise RuntimeError("BM25 falló" if skip_knn else "BM25 y kNN fallaron")
+
+    if not rerank:
+        hits = rrf_fusion(sides, k=rrf_k, weights=weights, topn=k)
+        RETRIEVAL_K.labels(strategy="rrf").set(len(hits))
+    else:
+        pool = rrf_fusion(sides, k=rrf_k, weights=weights)
+        query_codes = [".".join(p for p in m.groups() if p) for m in _HS_CODE_RE.finditer(query_text)]
+        hits = rerank_hits(query_text, pool, k, query_codes=query_codes, knn_scores=knn_scores)
+        RETRIEVAL_K.labels(strategy="rerank").set(len(hits))
+    if not snippet_chars and local_knn is not None:
+        hits = hydrate_hits(os_client, index, hits, len(hits))
+    return hits
+
+
+def hybrid_search_with_fallback(os_client, index: str, query_text: str, k: int = 5,
+                                query_vector: Optional[List[float]] = None,
+                                filters: Optional[List[Dict]] = None, skip_knn: bool = False) -> List[Dict]:
+    """
+    Punto de entrada de /classify: búsqueda híbrida BM25 + kNN con RRF
+    (ver hybrid_search). Si kNN no está disponible, el resultado es BM25 puro;
+    skip_knn=True (embedding de la consulta fallido) va directo a BM25.
+    Los hits traen snippets de Settings.retrieval_snippet_chars: /classify
+    rehidrata con hydrate_hits solo los que entran al prompt.
+    La existencia y el mapping del índice se validan en el arranque de la API
+    (ver app/index_state.py), no en cada consulta.
+    """
+    return hybrid_search(os_client, index, query_text, k, query_vector=query_vector, filters=filters,
+                         snippet_chars=get_settings().retrieval_snippet_chars, skip_knn=skip_knn)
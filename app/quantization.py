@@ -0,0 +1,147 @@
+"""
+app/quantization.py
+Modos de almacenamiento del campo 'embedding' (knn_vector) y codificación
+de vectores coherente entre ingesta y consulta.
+
+- float: float32 en HNSW con el motor del perfil (faiss por defecto: admite
+         'filter' dentro del kNN, es decir pre-filtrado eficiente).
+         OPENSEARCH_KNN_ENGINE=nmslib conserva el motor histórico para índices
+         creados antes; nmslib no pre-filtra (ver os_retrieval._knn_body).
+- fp16:  faiss HNSW con scalar quantization fp16 (mitad de memoria nativa).
+         faiss (OpenSearch 2.13) no soporta cosinesimil: se usa innerproduct
+         sobre vectores normalizados L2, que es equivalente.
+- byte:  lucene HNSW con data_type=byte (1/4 de memoria). Cada vector se
+         escala por su máximo absoluto a [-127, 127]; válido para cosinesimil,
+         que es invariante a la escala.
+
+Perfiles de índice (OPENSEARCH_INDEX_PROFILE): parámetros HNSW (m,
+ef_construction, ef_search) y motor del modo float. fp16 y byte fijan su
+motor (faiss / lucene) y solo toman m/ef_construction del perfil. ef_search
+va en method.parameters con faiss (fijo al crear el índice) y en el setting
+dinámico index.knn.algo_param.ef_search con nmslib (validate_index lo aplica
+también a índices existentes); lucene no lo usa (explora k candidatos).
+Medir con scripts/bench_knn_profiles.py.
+"""
+import math
+from typing import Any, Dict, List, Sequence
+
+from app.config import get_settings
+from app.dim_reduction import reduce_for_index
+
+VECTOR_MODES = ("float", "fp16", "byte")
+KNN_ENGINES = ("faiss", "lucene", "nmslib")
+
+INDEX_PROFILES: Dict[str, Dict[str, Any]] = {
+    "latency": {"engine": "faiss", "m": 8, "ef_construction": 128, "ef_search": 32},
+    "balanced": {"engine": "faiss", "m": 16, "ef_construction": 256, "ef_search": 100},
+    "recall": {"engine": "faiss", "m": 32, "ef_construction": 512, "ef_search": 400},
+}
+
+
+def _check_mode(mode: str) -> str:
+    m = (mode or "float").strip().lower()
+    if m not in VECTOR_MODES:
+        raise ValueError(f"OPENSEARCH_VECTOR_MODE inválido: {mode!r} (usa {', '.join(VECTOR_MODES)})")
+    return m
+
+
+def index_profile(profile: str = "balanced") -> Dict[str, Any]:
+    p = (profile or "balanced").strip().lower()
+    if p not in INDEX_PROFILES:
+        raise ValueError(f"OPENSEARCH_INDEX_PROFILE inválido: {profile!r} (usa {', '.join(INDEX_PROFILES)})")
+    return INDEX_PROFILES[p]
+
+
+def engine_for(mode: str, profile: str = "balanced") -> str:
+    """Motor HNSW: fijo en fp16 (faiss) y byte (lucene); en float el de
+    OPENSEARCH_KNN_ENGINE si está definido y si no el del perfil."""
+    m = _check_mode(mode)
+    if m == "fp16":
+        return "faiss"
+    if m == "byte":
+        return "lucene"
+    override = (get_settings().opensearch_knn_engine or "").strip().lower()
+    if override and override not in KNN_ENGINES:
+        raise ValueError(f"OPENSEARCH_KNN_ENGINE inválido: {override!r} (usa {', '.join(KNN_ENGINES)})")
+    return override or index_profile(profile)["engine"]
+
+
+def effective_space(space: str, mode: str, profile: str = "balanced") -> str:
+    """Espacio de similitud realmente usado por el motor para el modo."""
+    if engine_for(mode, profile) == "faiss" and space == "cosinesimil":
+        return "innerproduct"
+    return space
+
+
+def knn_vector_mapping(dim: int, space: str, mode: str = "float", profile: str = "balanced") -> Dict[str, Any]:
+    """Mapping del campo knn_vector para el modo de almacenamiento y perfil."""
+    m = _check_mode(mode)
+    prof = index_profile(profile)
+    params: Dict[str, Any] = {"m": prof["m"], "ef_construction": prof["ef_construction"]}
+    if m == "byte":
+        if space != "cosinesimil":
+            raise ValueError("El modo 'byte' requiere OPENSEARCH_KNN_SPACE=cosinesimil")
+        return {
+            "type": "knn_vector",
+            "dimension": dim,
+            "data_type": "byte",
+            "method": {"name": "hnsw", "space_type": space, "engine": "lucene", "parameters": params},
+        }
+    engine = engine_for(m, profile)
+    if engine == "faiss":
+        params["ef_search"] = prof["ef_search"]
+    if m == "fp16":
+        params["encoder"] = {"name": "sq", "parameters": {"type": "fp16", "clip": True}}
+    return {
+        "type": "knn_vector",
+        "dimension": dim,
+        "method": {
+            "name": "hnsw",
+            "space_type": effective_space(space, m, profile),
+            "engine": engine,
+            "parameters": params,
+        },
+    }
+
+
+def knn_index_settings(mode: str = "float", profile: str = "balanced") -> Dict[str, Any]:
+    """Settings 'index' del perfil. ef_search solo con nmslib (dinámico); faiss lo
+    lleva en el mapping y lucene no lo usa."""
+    out: Dict[str, Any] = {"knn": True}
+    if engine_for(mode, profile) == "nmslib":
+        out["knn.algo_param.ef_search"] = index_profile(profile)["ef_search"]
+    return out
+
+
+def supports_knn_filter(mode: str = "float", profile: str = "balanced") -> bool:
+    """True si el motor del modo aplica 'filter' dentro del kNN (pre-filtrado
+    eficiente: lucene y faiss); nmslib solo admite post-filtrado."""
+    return engine_for(mode, profile) in ("lucene", "faiss")
+
+
+def _l2_normalize(vec: Sequence[float]) -> List[float]:
+    norm = math.sqrt(sum(float(v) * float(v) for v in vec))
+    return [float(v) / norm for v in vec] if norm > 0 else [float(v) for v in vec]
+
+
+def encode_vector(vec: Sequence[float], mode: str = "float", space: str = "cosinesimil",
+                  profile: str = "balanced") -> List[Any]:
+    """Codifica un embedding para indexarlo o consultarlo en el modo dado."""
+    m = _check_mode(mode)
+    if m == "byte":
+        peak = max((abs(float(v)) for v in vec), default=0.0)
+        if peak == 0:
+            return [0] * len(vec)
+        scale = 127.0 / peak
+        return [max(-128, min(127, int(round(float(v) * scale)))) for v in vec]
+    if engine_for(m, profile) == "faiss" and space == "cosinesimil":
+        return _l2_normalize(vec)
+    return list(vec)
+
+
+def encode_for_index(vec: Sequence[float]) -> List[Any]:
+    """Reduce a OPENSEARCH_EMB_DIM y codifica con el modo/espacio/perfil de
+    Settings (mismo camino en ingesta y consulta)."""
+    s = get_settings()
+    return encode_vector(reduce_for_index(vec), s.opensearch_vector_mode, s.opensearch_knn_space,
+                         s.opensearch_index_profile)
@@ -0,0 +1,62 @@
+"""
+app/rate_limit.py
+Token bucket bloqueante y seguro entre hilos para respetar cuotas de API.
+"""
+import asyncio
+import threading
+import time
+
+
+class TokenBucket:
+    """Repone `rate` fichas por segundo hasta `capacity`.
+
+    acquire(cost) espera a que haya min(cost, capacity) fichas y descuenta
+    el costo completo; un costo mayor que la capacidad deja saldo negativo,
+    de modo que la tasa media se respeta también con lotes grandes.
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill_locked(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def _try_take(self, cost: float) -> float:
+        """Consume fichas si alcanzan; si no, devuelve la espera necesaria."""
+        need = min(float(cost), self.capacity)
+        with self._lock:
+            self._refill_locked()
+            if self._tokens >= need:
+                self._tokens -= float(cost)
+                return 0.0
+            return (need - self._tokens) / self.rate
+
+    def acquire(self, cost: float = 1.0) -> float:
+        """Bloquea hasta poder consumir `cost` fichas; devuelve segundos esperados."""
+        if self.rate <= 0:
+            return 0.0
+        waited = 0.0
+        while True:
+            delay = self._try_take(cost)
+            if delay <= 0:
+                return waited
+            time.sleep(delay)
+            waited += delay
+
+    async def acquire_async(self, cost: float = 1.0) -> float:
+        """Igual que acquire, pero cede el event loop mientras espera."""
+        if self.rate <= 0:
+            return 0.0
+        waited = 0.0
+        while True:
+            delay = self._try_take(cost)
+            if delay <= 0:
+                return waited
+            await asyncio.sleep(delay)
+            waited += delay
@@ -0,0 +1,131 @@
+"""
+app/reembed_queue.py
+Cola persistente (SQLite) de fragmentos cuyo embedding falló en la ingesta.
+
+Los fragmentos se indexan igual (BM25 funciona) pero sin 'embedding' y con
+embedding_status="pending"; scripts/reembed_pending.py drena la cola en
+lotes con os_ingest.drain_reembed_queue.
+
+Cada fallo suma un intento y aplaza el siguiente (next_attempt_at, backoff
+exponencial desde retry_backoff segundos): una caída del embedder no agota
+los intentos en una sola pasada. Tras max_attempts el fragmento queda 'dead'
+hasta requeue_dead.
+"""
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from app.config import get_settings
+
+
+class ReembedQueue:
+    def __init__(self, path: str, max_attempts: int = 5, retry_backoff: float = 60.0):
+        self.path = path
+        self.max_attempts = max(1, int(max_attempts))
+        self.retry_backoff = max(0.0, float(retry_backoff))
+        self._lock = threading.Lock()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS pending ("
+            " idx TEXT NOT NULL,"
+            " fragment_id TEXT NOT NULL,"
+            " text TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " last_error TEXT,"
+            " enqueued_at REAL NOT NULL,"
+            " next_attempt_at REAL NOT NULL DEFAULT 0,"
+            " PRIMARY KEY (idx, fragment_id))"
+        )
+        columns = {r[1] for r in self._conn.execute("PRAGMA table_info(pending)")}
+        if "next_attempt_at" not in columns:  # colas creadas antes del backoff
+            self._conn.execute("ALTER TABLE pending ADD COLUMN next_attempt_at REAL NOT NULL DEFAULT 0")
+        self._conn.commit()
+
+    def push_many(self, index: str, items: Iterable[Tuple[str, str]], error: str | None = None) -> int:
+        """Encola (fragment_id, text); re-encolar un fragmento reinicia sus intentos."""
+        now = time.time()
+        rows = [(index, fid, text or "", error, now) for fid, text in items]
+        if not rows:
+            return 0
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO pending (idx, fragment_id, text, attempts, last_error, enqueued_at,"
+                " next_attempt_at) VALUES (?, ?, ?, 0, ?, ?, 0)",
+                rows,
+            )
+            self._conn.commit()
+        return len(rows)
+
+    def peek_batch(self, limit: int, index: str | None = None, due_at: float | None = None) -> List[Dict[str, str]]:
+        """Siguiente lote con intentos disponibles y cuyo backoff venció en
+        due_at (por defecto ahora), los más antiguos primero. Fijar due_at al
+        inicio de una pasada garantiza que cada fila se procesa a lo sumo una vez."""
+        sql = "SELECT idx, fragment_id, text, attempts FROM pending WHERE attempts < ? AND next_attempt_at <= ?"
+        params: list = [self.max_attempts, time.time() if due_at is None else due_at]
+        if index:
+            sql += " AND idx = ?"
+            params.append(index)
+        sql += " ORDER BY attempts ASC, enqueued_at ASC LIMIT ?"
+        params.append(int(limit))
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [{"index": r[0], "fragment_id": r[1], "text": r[2], "attempts": r[3]} for r in rows]
+
+    def ack(self, index: str, fragment_ids: Iterable[str]) -> None:
+        with self._lock:
+            self._conn.executemany(
+                "DELETE FROM pending WHERE idx = ? AND fragment_id = ?",
+                [(index, fid) for fid in fragment_ids],
+            )
+            self._conn.commit()
+
+    def fail(self, index: str, fragment_ids: Iterable[str], error: str) -> None:
+        """Suma un intento y aplaza el siguiente retry_backoff * 2^(intentos previos)."""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE pending SET attempts = attempts + 1, last_error = ?,"
+                " next_attempt_at = ? + ? * (1 << MIN(attempts, 16)) WHERE idx = ? AND fragment_id = ?",
+                [(error[:500], now, self.retry_backoff, index, fid) for fid in fragment_ids],
+            )
+            self._conn.commit()
+
+    def requeue_dead(self, index: str | None = None) -> int:
+        """Devuelve a la cola (intentos a cero, sin espera) los fragmentos 'dead'."""
+        sql = "UPDATE pending SET attempts = 0, next_attempt_at = 0 WHERE attempts >= ?"
+        params: list = [self.max_attempts]
+        if index:
+            sql += " AND idx = ?"
+            params.append(index)
+        with self._lock:
+            n = self._conn.execute(sql, params).rowcount
+            self._conn.commit()
+        return n
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            pending, dead = self._conn.execute(
+                "SELECT SUM(attempts < ?), SUM(attempts >= ?) FROM pending",
+                (self.max_attempts, self.max_attempts),
+            ).fetchone()
+        return {"pending": int(pending or 0), "dead": int(dead or 0)}
+
+    def __len__(self) -> int:
+        return self.counts()["pending"]
+
+
+_queue: Optional[ReembedQueue] = None
+_queue_lock = threading.Lock()
+
+
+def get_reembed_queue() -> ReembedQueue:
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            s = get_settings()
+            _queue = ReembedQueue(s.reembed_queue_path, s.reembed_max_attempts, s.reembed_retry_backoff)
+    return _queue
@@ -0,0 +1,128 @@
+"""
+app/rerank.py
+Segunda etapa de la búsqueda híbrida: re-puntúa en CPU el pool de candidatos
+fusionado por RRF con features vectorizadas (NumPy) y se queda con top_k.
+
+Features por hit (cada una en [0, 1]):
+- rrf:     score de la primera etapa (min-max sobre el pool).
+- hs:      coincidencia del código HS de la consulta con hs6/partida/heading/...
+           o con códigos citados en el texto ('hs_codes' si el hit lo trae;
+           prefijo común / dígitos del código).
+- overlap: fracción de términos de la consulta presentes en el texto.
+- cosine:  similitud del embedding almacenado con la consulta, tomada del score
+           kNN (min-max); los hits fuera del top kNN reciben el mínimo, que es
+           una cota superior de su similitud real.
+más un prior aditivo por bucket (Settings.rerank_bucket_priors).
+"""
+import json
+import re
+import unicodedata
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+from app.config import get_settings
+
+FEATURES = ("rrf", "hs", "overlap", "cosine")
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_CODE_IN_TEXT_RE = re.compile(r"\b\d{4}(?:[.\s]?\d{2}){0,2}\b")
+_CODE_FIELDS = ("hs6", "partida", "subheading", "heading", "codigo_producto")
+
+
+def _tokens(text: str) -> set:
+    nfkd = unicodedata.normalize("NFKD", text or "")
+    folded = "".join(c for c in nfkd if not unicodedata.combining(c)).casefold()
+    return {w for w in _WORD_RE.findall(folded) if len(w) > 2}
+
+
+def _digits(code) -> str:
+    return "".join(ch for ch in str(code or "") if ch.isdigit())
+
+
+def _hs_match(query_codes: Sequence[str], src: Dict) -> float:
+    """Máximo prefijo común (>= 4 dígitos) relativo al largo del código consultado."""
+    if not query_codes:
+        return 0.0
+    doc_codes = [_digits(src.get(f)) for f in _CODE_FIELDS if src.get(f)]
+    if src.get("hs_codes"):
+        doc_codes += [str(c) for c in src["hs_codes"]]
+    else:
+        doc_codes += [_digits(c) for c in _CODE_IN_TEXT_RE.findall(src.get("text") or "")]
+    best = 0.0
+    for q in query_codes:
+        for d in doc_codes:
+            n = 0
+            for a, b in zip(q, d):
+                if a != b:
+                    break
+                n += 1
+            if n >= 4:
+                best = max(best, n / len(q))
+    return best
+
+
+@lru_cache(maxsize=8)
+def _bucket_priors(raw: str) -> Dict[str, float]:
+    return {str(k): float(v) for k, v in json.loads(raw).items()} if raw else {}
+
+
+def _minmax(x: np.ndarray) -> np.ndarray:
+    lo, hi = float(x.min()), float(x.max())
+    return (x - lo) / (hi - lo) if hi > lo else np.ones_like(x)
+
+
+def feature_matrix(
+    query_text: str,
+    hits: List[Dict],
+    query_codes: Sequence[str] = (),
+    knn_scores: Optional[Dict[str, float]] = None,
+) -> np.ndarray:
+    """Matriz (n_hits, len(FEATURES)) en el orden de FEATURES."""
+    n = len(hits)
+    q_tokens = _tokens(query_text)
+    codes = [_digits(c) for c in query_codes if len(_digits(c)) >= 4]
+    rrf = np.fromiter((float(h.get("_score") or 0.0) for h in hits), dtype=np.float64, count=n)
+    hs = np.fromiter((_hs_match(codes, h.get("_source") or {}) for h in hits), dtype=np.float64, count=n)
+    overlap = np.fromiter(
+        (len(q_tokens & _tokens((h.get("_source") or {}).get("text", ""))) / len(q_tokens) if q_tokens else 0.0
+         for h in hits),
+        dtype=np.float64, count=n,
+    )
+    knn_scores = knn_scores or {}
+    raw = np.array([knn_scores.get(h.get("_id"), np.nan) for h in hits], dtype=np.float64)
+    known = ~np.isnan(raw)
+    cosine = np.zeros(n)
+    if known.any():
+        raw[~known] = raw[known].min()
+        cosine = _minmax(raw) if known.sum() > 1 else known.astype(np.float64)
+    return np.column_stack([_minmax(rrf), hs, overlap, cosine])
+
+
+def rerank(
+    query_text: str,
+    hits: List[Dict],
+    top_k: int,
+    *,
+    query_codes: Iterable[str] = (),
+    knn_scores: Optional[Dict[str, float]] = None,
+    weights: Optional[Sequence[float]] = None,
+    bucket_priors: Optional[Dict[str, float]] = None,
+) -> List[Dict]:
+    """
+    Re-ordena hits (forma OpenSearch) y devuelve los top_k con _score = score
+    de rerank y _first_stage_score = score original.
+    """
+    if not hits:
+        return []
+    s = get_settings()
+    w = np.asarray(weights if weights is not None else
+                   (s.rerank_w_rrf, s.rerank_w_hs, s.rerank_w_overlap, s.rerank_w_cosine), dtype=np.float64)
+    priors = bucket_priors if bucket_priors is not None else _bucket_priors(s.rerank_bucket_priors or "")
+    feats = feature_matrix(query_text, hits, list(query_codes), knn_scores)
+    prior = np.fromiter((priors.get((h.get("_source") or {}).get("bucket") or "", 0.0) for h in hits),
+                        dtype=np.float64, count=len(hits))
+    scores = feats @ w + prior
+    order = np.argsort(-scores, kind="stable")[:top_k]
+    return [{**hits[i], "_score": float(scores[i]), "_first_stage_score": hits[i].get("_score")} for i in order]
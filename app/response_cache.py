@@ -0,0 +1,137 @@
+"""
+app/response_cache.py
+Caché de respuestas de /classify en dos niveles, en memoria:
+
+1. exacto: consulta normalizada + top_k + generación del índice + filtros.
+2. semántico: si no hay coincidencia exacta, reutiliza la respuesta de una
+   consulta cacheada cuyo embedding tenga coseno >= threshold con el de la
+   nueva (mismo top_k, generación, filtros y mismos códigos HS / números en
+   la consulta: "4011.10" y "4011.20" nunca comparten respuesta).
+
+Solo se cachean respuestas completas (is_cacheable): nada degradado por
+fallos del LLM, del embedder o de la búsqueda, que se serviría durante todo
+el TTL y a consultas parecidas.
+
+LRU + TTL; se vacía entera cuando cambia la generación del índice (alias
+movido a otro índice), porque las respuestas citan evidencia de ese índice.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.config import get_settings
+from app.embed_cache import normalize_for_key
+from app.hs_codes import numeric_signature
+from app.metrics import CLASSIFY_CACHE
+
+# Aviso de generator_gemini._offline_result
+OFFLINE_WARNING = "LLM offline"
+
+
+def _unit(vec: Sequence[float] | None) -> Optional[np.ndarray]:
+    if vec is None:
+        return None
+    v = np.asarray(vec, dtype=np.float32)
+    n = float(np.linalg.norm(v))
+    return v / n if n > 0 else None
+
+
+class ResponseCache:
+    def __init__(self, maxsize: int = 512, ttl: float = 900.0, threshold: float = 0.97):
+        self.maxsize = max(1, int(maxsize))
+        self.ttl = float(ttl)
+        self.threshold = float(threshold)
+        self.generation = ""
+        # key -> (creado, vector unitario | None, respuesta)
+        self._data: "OrderedDict[Hashable, Tuple[float, Optional[np.ndarray], Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(query: str, top_k: int, generation: str, scope: str = "") -> Tuple:
+        """scope: cualquier otro parámetro que cambie la respuesta (p. ej. filtros).
+        Todo salvo el texto (k[0]) debe coincidir también en el nivel semántico."""
+        return (normalize_for_key(query).casefold(), int(top_k), generation or "", scope,
+                numeric_signature(query))
+
+    def _expired(self, created: float, now: float) -> bool:
+        return self.ttl > 0 and now - created > self.ttl
+
+    def check_generation(self, generation: str) -> None:
+        """Vacía la caché si el índice detrás del alias cambió."""
+        generation = generation or ""
+        with self._lock:
+            if generation != self.generation:
+                self._data.clear()
+                self.generation = generation
+
+    def get(self, key: Tuple) -> Optional[Any]:
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and self._expired(item[0], now):
+                del self._data[key]
+                item = None
+            if item is None:
+                return None
+            self._data.move_to_end(key)
+        CLASSIFY_CACHE.labels(result="exact").inc()
+        return item[2]
+
+    def get_similar(self, key: Tuple, vector: Sequence[float] | None) -> Optional[Any]:
+        """Respuesta de la consulta cacheada más cercana (mismo top_k/generación/scope/códigos)."""
+        q = _unit(vector)
+        if q is None or self.threshold > 1.0:
+            CLASSIFY_CACHE.labels(result="miss").inc()
+            return None
+        now = time.monotonic()
+        best_key, best_sim = None, self.threshold
+        with self._lock:
+            for k, (created, vec, _) in list(self._data.items()):
+                if self._expired(created, now):
+                    del self._data[k]
+                    continue
+                if vec is None or k[1:] != key[1:] or vec.shape != q.shape:
+                    continue
+                sim = float(vec @ q)
+                if sim >= best_sim:
+                    best_key, best_sim = k, sim
+            if best_key is None:
+                value = None
+            else:
+                self._data.move_to_end(best_key)
+                value = self._data[best_key][2]
+        CLASSIFY_CACHE.labels(result="semantic" if value is not None else "miss").inc()
+        return value
+
+    def set(self, key: Tuple, value: Any, vector: Sequence[float] | None = None) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic(), _unit(vector), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+
+def is_cacheable(result: Dict[str, Any], hits: Sequence[Any], query_vector: Sequence[float] | None) -> bool:
+    """Respuesta con evidencia, con búsqueda híbrida (no BM25-only por fallo
+    del embedder) y con candidatos del LLM (no el resultado "LLM offline")."""
+    return (bool(hits) and query_vector is not None and bool(result.get("top_candidates"))
+            and OFFLINE_WARNING not in (result.get("warnings") or []))
+
+
+def build_response_cache() -> Optional[ResponseCache]:
+    """ResponseCache según Settings; None si CLASSIFY_CACHE_SIZE=0."""
+    s = get_settings()
+    if s.classify_cache_size <= 0:
+        return None
+    return ResponseCache(s.classify_cache_size, s.classify_cache_ttl, s.classify_cache_threshold)
@@ -50,7 +50,7 @@ class ClassifyResponse(BaseModel):
 
 class HealthResponse(BaseModel):
     """Respuesta del health check"""
-    status: str = Field(..., description="ok | degraded | fail")
+    status: str = Field(..., description="ok | degraded | warming | fail")
     services: Dict[str, Any] = Field(default_factory=dict)
 
 class Settings(BaseSettings):
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+bench_knn_profiles.py
+
+Compara los perfiles de índice HNSW (app/quantization.INDEX_PROFILES):
+recall@k frente al ranking exacto por fuerza bruta y latencia p50/p99 de
+la consulta kNN.
+
+Toma una muestra de embeddings ya indexados (campo 'embedding' del índice
+de la app), aparta --queries de ellos como consultas, y por cada perfil
+crea un índice temporal '<index>__bench_<perfil>' con el mismo modo de
+vector y espacio de Settings, lo carga, lo calienta y mide. El exacto se
+calcula con NumPy sobre la misma muestra (coseno / producto interno / l2).
+
+Uso:
+  python scripts/bench_knn_profiles.py --sample 20000 --queries 300 --k 10
+  python scripts/bench_knn_profiles.py --profiles balanced,recall --keep --out bench.json
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from typing import Dict, List
+
+import numpy as np
+from opensearchpy import helpers
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app.config import get_settings
+from app.os_index import get_os_client, index_body
+from app.quantization import INDEX_PROFILES, encode_vector, engine_for
+
+
+def fetch_vectors(client, index: str, n: int, seed: int = 42) -> np.ndarray:
+    """Muestra aleatoria de n embeddings indexados (float32)."""
+    rows: List[List[float]] = []
+    resp = client.search(index=index, scroll="2m", body={
+        "size": min(n, 1000),
+        "query": {"function_score": {
+            "query": {"exists": {"field": "embedding"}},
+            "random_score": {"seed": seed, "field": "_seq_no"},
+        }},
+        "_source": ["embedding"],
+    })
+    scroll_id = resp.get("_scroll_id")
+    try:
+        while True:
+            hits = resp.get("hits", {}).get("hits", [])
+            rows += [h["_source"]["embedding"] for h in hits if (h.get("_source") or {}).get("embedding")]
+            if not hits or len(rows) >= n:
+                break
+            resp = client.scroll(scroll_id=scroll_id, scroll="2m")
+            scroll_id = resp.get("_scroll_id")
+    finally:
+        if scroll_id:
+            client.clear_scroll(scroll_id=scroll_id)
+    return np.asarray(rows[:n], dtype=np.float32)
+
+
+def exact_topk(docs: np.ndarray, queries: np.ndarray, k: int, space: str) -> np.ndarray:
+    """Índices de los k vecinos exactos por consulta."""
+    if space == "l2":
+        scores = -(np.sum(queries ** 2, axis=1, keepdims=True) - 2 * queries @ docs.T + np.sum(docs ** 2, axis=1))
+    elif space == "innerproduct":
+        scores = queries @ docs.T
+    else:
+        d = docs / np.maximum(np.linalg.norm(docs, axis=1, keepdims=True), 1e-12)
+        q = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        scores = q @ d.T
+    part = np.argpartition(-scores, min(k, scores.shape[1] - 1), axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, part, axis=1), axis=1)
+    return np.take_along_axis(part, order, axis=1)
+
+
+def load_profile_index(client, name: str, docs: np.ndarray, space: str, mode: str, profile: str) -> None:
+    if client.indices.exists(index=name):
+        client.indices.delete(index=name)
+    body = index_body(docs.shape[1], space, mode, profile)
+    body["settings"]["index"].update({"number_of_replicas": 0, "refresh_interval": "-1"})
+    client.indices.create(index=name, body=body)
+    actions = ({"_index": name, "_id": str(i), "_source": {"embedding": encode_vector(v.tolist(), mode, space, profile)}}
+               for i, v in enumerate(docs))
+    helpers.bulk(client, actions, chunk_size=500, request_timeout=120)
+    client.indices.put_settings(index=name, body={"index": {"refresh_interval": "1s"}})
+    client.indices.refresh(index=name)
+    # Segmentos fusionados: la latencia no depende de cuántos lotes hubo
+    client.indices.forcemerge(index=name, max_num_segments=1, request_timeout=600)
+
+
+def run_queries(client, name: str, queries: np.ndarray, k: int, space: str, mode: str, profile: str):
+    encoded = [encode_vector(q.tolist(), mode, space, profile) for q in queries]
+    for vec in encoded[:min(20, len(encoded))]:  # calentamiento (carga del grafo en memoria nativa)
+        client.search(index=name, body={"size": k, "query": {"knn": {"embedding": {"vector": vec, "k": k}}},
+                                        "_source": False})
+    ids, latencies = [], []
+    for vec in encoded:
+        t0 = time.perf_counter()
+        resp = client.search(index=name, body={"size": k, "query": {"knn": {"embedding": {"vector": vec, "k": k}}},
+                                               "_source": False})
+        latencies.append((time.perf_counter() - t0) * 1000.0)
+        ids.append([int(h["_id"]) for h in resp.get("hits", {}).get("hits", [])])
+    return ids, np.asarray(latencies)
+
+
+def recall_at_k(ann: List[List[int]], exact: np.ndarray, k: int) -> float:
+    return float(np.mean([len(set(a[:k]) & set(e[:k].tolist())) / k for a, e in zip(ann, exact)]))
+
+
+def main():
+    ap = argparse.ArgumentParser(description="recall@k y latencia p50/p99 por perfil HNSW.")
+    ap.add_argument("--index", help="Índice de origen de los embeddings (default: OPENSEARCH_INDEX).")
+    ap.add_argument("--profiles", default=",".join(INDEX_PROFILES))
+    ap.add_argument("--sample", type=int, default=20000, help="Vectores de la muestra (corpus + consultas).")
+    ap.add_argument("--queries", type=int, default=300)
+    ap.add_argument("--k", type=int, default=10)
+    ap.add_argument("--mode", help="Modo de vector (default: OPENSEARCH_VECTOR_MODE).")
+    ap.add_argument("--keep", action="store_true", help="No borrar los índices temporales.")
+    ap.add_argument("--out", help="Guardar resultados JSON.")
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+
+    s = get_settings()
+    index = args.index or s.opensearch_index
+    mode = args.mode or s.opensearch_vector_mode
+    space = s.opensearch_knn_space
+    profiles = [p.strip() for p in args.profiles.split(",") if p.strip()]
+    unknown = [p for p in profiles if p not in INDEX_PROFILES]
+    if unknown:
+        raise SystemExit(f"Perfiles desconocidos: {unknown} (disponibles: {', '.join(INDEX_PROFILES)})")
+
+    client = get_os_client()
+    sample = fetch_vectors(client, index, args.sample + args.queries)
+    if len(sample) <= args.queries:
+        raise SystemExit(f"Muestra insuficiente en {index}: {len(sample)} vectores")
+    queries, docs = sample[:args.queries], sample[args.queries:]
+    exact = exact_topk(docs, queries, args.k, space)
+    logging.info("Corpus=%d, consultas=%d, dim=%d, space=%s, mode=%s", len(docs), len(queries), docs.shape[1],
+                 space, mode)
+
+    results: List[Dict] = []
+    for profile in profiles:
+        name = f"{index}__bench_{profile}"
+        t0 = time.perf_counter()
+        load_profile_index(client, name, docs, space, mode, profile)
+        build_s = time.perf_counter() - t0
+        try:
+            ann, lat = run_queries(client, name, queries, args.k, space, mode, profile)
+        finally:
+            if not args.keep:
+                client.indices.delete(index=name)
+        results.append({
+            "profile": profile,
+            **INDEX_PROFILES[profile],
+            "engine": engine_for(mode, profile),
+            f"recall@{args.k}": round(recall_at_k(ann, exact, args.k), 4),
+            "p50_ms": round(float(np.percentile(lat, 50)), 2),
+            "p99_ms": round(float(np.percentile(lat, 99)), 2),
+            "build_s": round(build_s, 1),
+        })
+        print(json.dumps(results[-1], ensure_ascii=False))
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+eval_dims.py
+
+Mide recall@k por dimensión de embedding contra data/gold/qrels.json para
+elegir el OPENSEARCH_EMB_DIM más pequeño que conserve la calidad.
+
+Para cada dimensión reduce (truncate/pca) los vectores completos de
+consultas y documentos y rankea por coseno exacto (fuerza bruta), así el
+resultado no depende del índice HNSW actual. Los textos de los documentos
+de qrels se leen del índice por _id; --distractors añade N documentos
+extra del índice para que el ranking no sea trivial.
+
+Uso:
+  python scripts/eval_dims.py --queries data/gold/queries.json --dims 768,512,256,128 --k 10
+  python scripts/eval_dims.py --queries q.json --method pca --save-pca storage/embed_pca.npz
+
+--queries: JSON {qid: texto} o JSONL con {"id"/"qid", "query"/"text"}.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+from typing import Dict, List
+
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app.config import get_settings
+from app.dim_reduction import PCAProjection, truncate_vector
+from app.embeddings import get_embedder
+from app.os_index import get_os_client
+
+
+def load_queries(path: str) -> Dict[str, str]:
+    with open(path, "r", encoding="utf-8-sig") as f:
+        content = f.read()
+    try:
+        obj = json.loads(content)
+        if isinstance(obj, dict):
+            return {str(k): str(v) for k, v in obj.items()}
+    except json.JSONDecodeError:
+        pass
+    out: Dict[str, str] = {}
+    for line in content.splitlines():
+        if not line.strip():
+            continue
+        row = json.loads(line)
+        qid = row.get("qid") or row.get("id") or row.get("query_id")
+        out[str(qid)] = row.get("query") or row.get("text") or ""
+    return out
+
+
+def fetch_corpus(client, index: str, doc_ids: List[str], distractors: int) -> Dict[str, str]:
+    """Textos de los documentos juzgados + N distractores del índice."""
+    corpus: Dict[str, str] = {}
+    for i in range(0, len(doc_ids), 500):
+        resp = client.mget(index=index, body={"ids": doc_ids[i:i + 500]}, _source=["text"])
+        for d in resp.get("docs", []):
+            if d.get("found"):
+                corpus[d["_id"]] = (d.get("_source") or {}).get("text", "")
+    if distractors > 0:
+        resp = client.search(index=index, body={
+            "size": distractors,
+            "query": {"function_score": {"query": {"match_all": {}}, "random_score": {"seed": 42, "field": "_seq_no"}}},
+            "_source": ["text"],
+        })
+        for h in resp.get("hits", {}).get("hits", []):
+            corpus.setdefault(h["_id"], (h.get("_source") or {}).get("text", ""))
+    return corpus
+
+
+def recall_at_k(qrels: Dict[str, Dict[str, int]], run: Dict[str, List[str]], k: int) -> float:
+    scores = []
+    for qid, rels in qrels.items():
+        relevant = {d for d, r in rels.items() if r > 0}
+        if not relevant or qid not in run:
+            continue
+        scores.append(len(relevant.intersection(run[qid][:k])) / len(relevant))
+    return float(np.mean(scores)) if scores else 0.0
+
+
+def reduce_matrix(x: np.ndarray, dim: int, method: str, pca: PCAProjection | None) -> np.ndarray:
+    if dim >= x.shape[1]:
+        norms = np.linalg.norm(x, axis=1, keepdims=True)
+        return x / np.where(norms > 0, norms, 1.0)
+    if method == "pca":
+        return pca.project_many(x, dim)
+    return np.asarray([truncate_vector(v, dim) for v in x], dtype=np.float32)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="recall@k por dimensión de embedding (truncate/PCA).")
+    ap.add_argument("--qrels", default="data/gold/qrels.json")
+    ap.add_argument("--queries", required=True, help="JSON {qid: texto} o JSONL.")
+    ap.add_argument("--index", help="Índice (default: OPENSEARCH_INDEX).")
+    ap.add_argument("--dims", default="768,512,384,256,128")
+    ap.add_argument("--k", type=int, default=10)
+    ap.add_argument("--method", choices=["truncate", "pca"], default="truncate")
+    ap.add_argument("--distractors", type=int, default=2000)
+    ap.add_argument("--save-pca", help="Ajusta PCA sobre el corpus y guarda el artefacto (.npz).")
+    ap.add_argument("--out", help="Guardar resultados JSON.")
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+
+    s = get_settings()
+    index = args.index or s.opensearch_index
+    with open(args.qrels, "r", encoding="utf-8") as f:
+        qrels = json.load(f)
+    queries = {qid: q for qid, q in load_queries(args.queries).items() if qid in qrels}
+    if not queries:
+        raise SystemExit("Ninguna consulta coincide con los qid de qrels.")
+
+    judged = sorted({d for rels in qrels.values() for d in rels})
+    corpus = fetch_corpus(get_os_client(), index, judged, args.distractors)
+    logging.info("Consultas=%d, documentos=%d (juzgados encontrados=%d)",
+                 len(queries), len(corpus), len(set(judged) & set(corpus)))
+
+    embedder = get_embedder()
+    doc_ids = list(corpus)
+    doc_full = np.asarray(embedder.embed_texts([corpus[d] for d in doc_ids]), dtype=np.float32)
+    qids = list(queries)
+    q_full = np.asarray([embedder.embed_query(queries[q]) for q in qids], dtype=np.float32)
+
+    dims = sorted({int(d) for d in args.dims.split(",") if d.strip()}, reverse=True)
+    pca = None
+    if args.method == "pca" or args.save_pca:
+        n_comp = min(max(dims), doc_full.shape[0], doc_full.shape[1])
+        pca = PCAProjection.fit(doc_full, n_comp)
+        if args.save_pca:
+            pca.save(args.save_pca)
+            logging.info("Artefacto PCA guardado en %s (%d componentes)", args.save_pca, n_comp)
+
+    results = []
+    for dim in dims:
+        if args.method == "pca" and dim > pca.max_dim:
+            logging.warning("dim=%d supera los componentes PCA disponibles (%d); se omite", dim, pca.max_dim)
+            continue
+        docs = reduce_matrix(doc_full, dim, args.method, pca)
+        qs = reduce_matrix(q_full, dim, args.method, pca)
+        sims = qs @ docs.T
+        top = np.argsort(-sims, axis=1)[:, :args.k]
+        run = {qid: [doc_ids[j] for j in top[i]] for i, qid in enumerate(qids)}
+        results.append({
+            "dim": dim,
+            "method": args.method,
+            f"recall@{args.k}": round(recall_at_k(qrels, run, args.k), 4),
+            "bytes_per_vector_fp32": dim * 4,
+        })
+        print(json.dumps(results[-1], ensure_ascii=False))
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
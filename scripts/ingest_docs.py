@@ -2,6 +2,7 @@ import os, sys, glob, logging
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 from app.ocr_formrec import extract_fragments_from_pdf, extract_fragments_from_afr_json
+from app.os_index import get_os_client, warmup_knn
 from app.os_ingest import bulk_ingest_fragments
 from app.config import get_settings
 
@@ -58,7 +59,7 @@ def main():
 
             if len(batch) >= BULK_BATCH:
                 logging.info(f"Indexando batch de {len(batch)} → {s.opensearch_index}")
-                bulk_ingest_fragments(batch, s.opensearch_index)
+                bulk_ingest_fragments(batch, s.opensearch_index, warmup=False)
                 batch = []
         except Exception as e:
             logging.exception(f"ERROR procesando {path}: {e}")
@@ -85,7 +86,7 @@ def main():
 
             if len(batch) >= BULK_BATCH:
                 logging.info(f"Indexando batch de {len(batch)} → {s.opensearch_index}")
-                bulk_ingest_fragments(batch, s.opensearch_index)
+                bulk_ingest_fragments(batch, s.opensearch_index, warmup=False)
                 batch = []
         except Exception as e:
             logging.exception(f"ERROR procesando JSON {path}: {e}")
@@ -93,12 +94,21 @@ def main():
     # Último batch
     if batch:
         logging.info(f"Indexando batch final de {len(batch)} → {s.opensearch_index}")
-        bulk_ingest_fragments(batch, s.opensearch_index)
+        bulk_ingest_fragments(batch, s.opensearch_index, warmup=False)
 
     if total_frags == 0:
         logging.warning("ℹ️ No se hallaron PDFs en data/corpus/**.pdf")
     else:
         logging.info(f"✅ Ingestados {total_frags} fragmentos → {s.opensearch_index}")
+        # Un solo refresh + k-NN warmup al final, no uno por batch
+        try:
+            client = get_os_client()
+            client.indices.refresh(index=s.opensearch_index)
+            shards = warmup_knn(s.opensearch_index, client=client)
+            if shards is not None:
+                logging.info("k-NN warmup: %s/%s shards", shards.get("successful", 0), shards.get("total", 0))
+        except Exception as e:
+            logging.warning("k-NN warmup falló: %s", e)
 
 if __name__ == "__main__":
     main()
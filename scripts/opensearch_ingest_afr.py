@@ -26,8 +26,10 @@ import pickle
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 from app.config import get_settings
-from app.os_index import get_os_client
+from app.os_index import get_os_client, warmup_knn
 from app.os_ingest import bulk_ingest_fragments
+from app.quantization import knn_index_settings, knn_vector_mapping
+from app import hs_codes
 
 # --------------- Lógica de AFR -> chunks --------------
 def sha16(s: str) -> str:
@@ -127,13 +129,16 @@ def detect_analyze_result(payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
 
 # --------------- OpenSearch utils ----------------------
 def ensure_index(client, index_name: str, dim: int, knn_space: str = "cosinesimil",
-                 shards: int = 1, replicas: int = 0, analyzer: str = "spanish") -> None:
+                 shards: int = 1, replicas: int = 0, analyzer: str = "spanish",
+                 vector_mode: str = "float", profile: str = "balanced") -> None:
     """
     Crea el índice si no existe con el mapping esperado por la app:
     - text (text)
-    - embedding (knn_vector, dim=dim, space=knn_space)
+    - embedding (knn_vector, dim=dim, space=knn_space, modo float|fp16|byte,
+      perfil HNSW latency|balanced|recall)
     - metadata (object enabled)
     - fragment_id/doc_id/source/page/type/role/kind/bucket (campos auxiliares)
+    - hs_codes (keyword con normalizer 'hs_code', lo llena _flatten_metadata)
     """
     if client.indices.exists(index=index_name):
         return
@@ -142,26 +147,19 @@ def ensure_index(client, index_name: str, dim: int, knn_space: str = "cosinesimi
         "index": {
             "number_of_shards": shards,
             "number_of_replicas": replicas,
-            "knn": True
+            **knn_index_settings(vector_mode, profile),
         },
         "analysis": {
             "analyzer": {
                 "default": {"type": analyzer}
-            }
+            },
+            **hs_codes.ANALYSIS,
         }
     }
     mappings = {
         "properties": {
             "text": {"type": "text"},
-            "embedding": {
-                "type": "knn_vector",
-                "dimension": dim,
-                "method": {
-                    "name": "hnsw",
-                    "space_type": knn_space,
-                    "engine": "nmslib"
-                }
-            },
+            "embedding": knn_vector_mapping(dim, knn_space, vector_mode, profile),
             "metadata": {"type": "object", "enabled": True},
             "fragment_id": {"type": "keyword"},
             "doc_id": {"type": "keyword"},
@@ -171,6 +169,8 @@ def ensure_index(client, index_name: str, dim: int, knn_space: str = "cosinesimi
             "type": {"type": "keyword"},
             "role": {"type": "keyword"},
             "kind": {"type": "keyword"},
+            "embedding_status": {"type": "keyword"},
+            "hs_codes": hs_codes.MAPPING,
             "indexed_at": {"type": "date"}
         }
     }
@@ -411,11 +411,15 @@ def main():
     # Dimensión/espacio desde settings (coherente con toda la app)
     emb_dim = int(getattr(settings, "opensearch_emb_dim", 768))
     knn_space = getattr(settings, "opensearch_knn_space", "cosinesimil")
+    vector_mode = getattr(settings, "opensearch_vector_mode", "float")
+    profile = getattr(settings, "opensearch_index_profile", "balanced")
 
     # Asegurar índice kNN compatible
     ensure_index(client, index_name, dim=emb_dim, knn_space=knn_space,
-                 shards=args.shards, replicas=args.replicas, analyzer=args.analyzer)
-    logging.info("Índice listo: %s (dim=%d, space=%s)", index_name, emb_dim, knn_space)
+                 shards=args.shards, replicas=args.replicas, analyzer=args.analyzer,
+                 vector_mode=vector_mode, profile=profile)
+    logging.info("Índice listo: %s (dim=%d, space=%s, mode=%s, profile=%s)",
+                 index_name, emb_dim, knn_space, vector_mode, profile)
 
     # Fuente de datos con tracking
     if args.afr_input:
@@ -436,7 +440,7 @@ def main():
         if not fragments:
             continue
         try:
-            bulk_ingest_fragments(fragments, index_name)
+            bulk_ingest_fragments(fragments, index_name, warmup=False)
             total += len(fragments)
             logging.info("Batch upsert: %d docs (acumulado=%d)", len(fragments), total)
             if args.refresh:
@@ -460,5 +464,15 @@ def main():
 
     logging.info("Ingesta finalizada. Total documentos upsert: %d", total)
 
+    # Un solo k-NN warmup al final (no por batch) para cargar los grafos nuevos
+    if total:
+        try:
+            client.indices.refresh(index=index_name)
+            shards = warmup_knn(index_name, client=client)
+            if shards is not None:
+                logging.info("k-NN warmup: %s/%s shards", shards.get("successful", 0), shards.get("total", 0))
+        except Exception as e:
+            logging.warning("k-NN warmup falló: %s", e)
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+reembed_pending.py
+
+Drena la cola de re-embedding (fragmentos indexados con
+embedding_status="pending" porque su embedding falló en la ingesta).
+
+Uso:
+  python scripts/reembed_pending.py                 # una pasada completa
+  python scripts/reembed_pending.py --watch 300     # en segundo plano, cada 5 min
+  python scripts/reembed_pending.py --stats         # solo mostrar conteos
+  python scripts/reembed_pending.py --requeue-dead  # reactivar los 'dead' y drenar
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from app.os_ingest import drain_reembed_queue
+from app.reembed_queue import get_reembed_queue
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Re-embebe fragmentos pendientes de la cola.")
+    ap.add_argument("--index", help="Limitar a un índice (default: todos los de la cola).")
+    ap.add_argument("--batch-size", type=int, default=64)
+    ap.add_argument("--max-batches", type=int, default=None)
+    ap.add_argument("--watch", type=float, default=None, help="Repetir cada N segundos (modo background).")
+    ap.add_argument("--stats", action="store_true", help="Solo mostrar conteos de la cola.")
+    ap.add_argument("--requeue-dead", action="store_true",
+                    help="Reiniciar los intentos de los fragmentos 'dead' antes de drenar.")
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+
+    if args.stats:
+        print(json.dumps(get_reembed_queue().counts(), ensure_ascii=False))
+        return
+    if args.requeue_dead:
+        logging.info("Reactivados %d fragmentos 'dead'", get_reembed_queue().requeue_dead(args.index))
+
+    while True:
+        out = drain_reembed_queue(args.index, batch_size=args.batch_size, max_batches=args.max_batches)
+        logging.info("Re-embedding: %s", json.dumps(out, ensure_ascii=False))
+        if args.watch is None:
+            break
+        time.sleep(args.watch)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+import pytest
+
+import app.embedder_gemini as eg
+import app.embeddings as embeddings
+from app.embed_cache import EmbeddingCache
+
+
+@pytest.fixture
+def embedder(monkeypatch):
+    monkeypatch.setenv("GEMINI_API_KEY", "fake-key-for-tests")
+    monkeypatch.delenv("GOOGLE_API_KEY", raising=False)
+    monkeypatch.setattr(eg.genai, "configure", lambda **kw: None)
+    return eg.GeminiEmbedder(use_cache=False)
+
+
+def _fake_embed(calls, fail_if=lambda content: False):
+    def embed_content(model, content, **kw):
+        calls.append(content)
+        if fail_if(content):
+            raise eg.gexc.InvalidArgument("400 payload too large")
+        if isinstance(content, list):
+            return {"embedding": [[float(len(c))] for c in content]}
+        return {"embedding": {"values": [float(len(content))]}}
+    return embed_content
+
+
+def test_embed_texts_uses_one_request_per_batch(embedder, monkeypatch):
+    """Varios textos viajan en una sola llamada batch"""
+    calls = []
+    monkeypatch.setattr(eg.genai, "embed_content", _fake_embed(calls))
+    vecs = embedder.embed_texts(["a", "bb", "ccc"])
+    assert vecs == [[1.0], [2.0], [3.0]]
+    assert calls == [["a", "bb", "ccc"]]
+
+
+def test_embed_texts_respects_char_budget(embedder, monkeypatch):
+    """El presupuesto de caracteres parte el lote"""
+    calls = []
+    monkeypatch.setattr(eg.genai, "embed_content", _fake_embed(calls))
+    embedder.batch_max_chars = 5
+    vecs = embedder.embed_texts(["aaa", "bbb", "c"])
+    assert vecs == [[3.0], [3.0], [1.0]]
+    assert calls == ["aaa", ["bbb", "c"]]
+
+
+def test_embed_texts_splits_only_failing_half(embedder, monkeypatch):
+    """Un texto rechazado se aísla partiendo el lote, sin bajar el límite ni usar el modelo de respaldo"""
+    calls = []
+
+    def embed_content(model, content, **kw):
+        calls.append((model, content))
+        if "boom" in content:
+            raise eg.gexc.InvalidArgument("400 Request contains an invalid argument.")
+        if isinstance(content, list):
+            return {"embedding": [[float(len(c))] for c in content]}
+        return {"embedding": {"values": [float(len(content))]}}
+
+    monkeypatch.setattr(eg.genai, "embed_content", embed_content)
+    before = embedder.batch_max_items
+    vecs = embedder.embed_texts(["a", "b", "c", "boom"], strict=False)
+    assert vecs == [[1.0], [1.0], [1.0], None]
+    assert (embedder.model_name, ["a", "b"]) in calls
+    assert (embedder.model_name, "boom") in calls
+    assert {m for m, _ in calls} == {embedder.model_name}
+    assert embedder.batch_max_items == before
+    with pytest.raises(eg.gexc.InvalidArgument):
+        embedder.embed_texts(["boom"])
+
+
+def test_batch_limit_shrinks_on_too_large_and_grows_back(embedder, monkeypatch):
+    """Un lote demasiado grande baja el límite de ítems; lotes completos exitosos lo recuperan"""
+    calls = []
+
+    def embed_content(model, content, **kw):
+        calls.append(content)
+        if isinstance(content, list) and len(content) > 2:
+            raise eg.gexc.InvalidArgument("400 Request payload size exceeds the limit")
+        if isinstance(content, list):
+            return {"embedding": [[float(len(c))] for c in content]}
+        return {"embedding": {"values": [float(len(content))]}}
+
+    monkeypatch.setattr(eg.genai, "embed_content", embed_content)
+    embedder.batch_items_limit = embedder.batch_max_items = 4
+    assert embedder.embed_texts(["a", "b", "c", "d"]) == [[1.0]] * 4
+    assert embedder.batch_max_items == 2
+    embedder.embed_texts([f"t{i}" for i in range(2 * eg.BATCH_GROW_AFTER)])
+    assert embedder.batch_max_items == 4
+
+
+def test_embed_texts_raises_auth_errors_without_splitting(embedder, monkeypatch):
+    """Un error de permisos no parte el lote ni reduce batch_max_items, tampoco con strict=False"""
+    calls = []
+
+    def embed_content(model, content, **kw):
+        calls.append(content)
+        raise eg.gexc.PermissionDenied("403 API key not valid")
+
+    monkeypatch.setattr(eg.genai, "embed_content", embed_content)
+    before = embedder.batch_max_items
+    with pytest.raises(eg.gexc.PermissionDenied):
+        embedder.embed_texts(["a", "b", "c", "d"], strict=False)
+    assert calls == [["a", "b", "c", "d"]]
+    assert embedder.batch_max_items == before
+
+
+def test_embed_texts_reads_through_cache(embedder, monkeypatch, tmp_path):
+    """Los textos ya cacheados no vuelven a la API"""
+    calls = []
+    monkeypatch.setattr(eg.genai, "embed_content", _fake_embed(calls))
+    embedder.cache = EmbeddingCache(str(tmp_path / "cache.sqlite"))
+    assert embedder.embed_texts(["hola", "mundo"]) == [[4.0], [5.0]]
+    assert embedder.embed_texts(["mundo", " hola ", "nuevo"]) == [[5.0], [4.0], [5.0]]
+    assert calls == [["hola", "mundo"], "nuevo"]
+    assert embedder.cache.hits == 2 and embedder.cache.misses == 3
+
+
+def test_fallback_vectors_are_cached_under_the_fallback_model(embedder, monkeypatch, tmp_path):
+    """Un vector del modelo de respaldo no se sirve después como del modelo principal"""
+    calls = []
+
+    def embed_content(model, content, **kw):
+        calls.append(model)
+        if model == embedder.model_name:
+            raise eg.gexc.NotFound("model not found")
+        return {"embedding": {"values": [9.0]}}
+
+    monkeypatch.setattr(eg.genai, "embed_content", embed_content)
+    embedder.cache = EmbeddingCache(str(tmp_path / "cache.sqlite"))
+    assert embedder.embed_texts(["hola"]) == [[9.0]]
+    assert embedder.cache.get_many(embedder.model_name, ["hola"]) == {}
+    assert embedder.cache.get_many(eg.FALLBACK_MODEL, ["hola"]) == {0: [9.0]}
+
+    embedder.embed_query("hola")
+    embedder.embed_query("hola")
+    assert calls.count(embedder.model_name) == 3
+
+
+def test_embedding_cache_evicts_least_recently_used(tmp_path):
+    """La caché respeta el máximo de entradas expulsando las menos usadas"""
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite"), max_entries=10)
+    for i in range(10):
+        cache.put_many("m", [f"t{i}"], [[float(i)]])
+    cache.get_many("m", ["t0"])
+    cache.put_many("m", ["t10"], [[10.0]])
+    assert len(cache) == 9
+    assert cache.get_many("m", ["t0", "t1"]) == {0: [0.0]}
+
+
+def test_embedding_cache_reads_do_not_write(tmp_path):
+    """get_many no escribe en SQLite; el last_used se vuelca en la siguiente escritura"""
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite"))
+    cache.put_many("m", ["t0"], [[0.0]])
+    changes = cache._conn.total_changes
+    assert cache.get_many("m", ["t0", "t1"]) == {0: [0.0]}
+    assert cache._conn.total_changes == changes
+    assert not cache._conn.in_transaction
+    cache.put_many("m", ["t1"], [[1.0]])
+    assert not cache._touched
+
+
+def test_embed_query_memoizes_normalized_query(embedder, monkeypatch):
+    """Consultas que solo difieren en espacios/mayúsculas reutilizan el vector"""
+    calls = []
+    monkeypatch.setattr(eg.genai, "embed_content", _fake_embed(calls))
+    v1 = embedder.embed_query("Neumáticos  radiales")
+    v2 = embedder.embed_query(" neumáticos radiales ")
+    assert v1 == v2
+    assert len(calls) == 1
+    assert embedder.query_cache.hits == 1
+
+
+def test_get_embedder_is_process_wide(monkeypatch):
+    """get_embedder devuelve siempre la misma instancia"""
+    monkeypatch.setenv("GEMINI_API_KEY", "fake-key-for-tests")
+    monkeypatch.setattr(eg.genai, "configure", lambda **kw: None)
+    monkeypatch.setattr(embeddings, "_embedder", None)
+    monkeypatch.setattr(eg, "get_embedding_cache", lambda: None)
+    assert embeddings.get_embedder() is embeddings.get_embedder()
+    assert isinstance(embeddings.get_embedder(), eg.GeminiEmbedder)
+
+
+def test_transient_errors_are_retried_not_split(embedder, monkeypatch):
+    """Un 429 se reintenta con backoff sin partir el lote ni cambiar de modelo"""
+    calls = []
+    failures = iter([True, True, False])
+
+    def embed_content(model, content, **kw):
+        calls.append((model, content))
+        if next(failures):
+            raise eg.gexc.TooManyRequests("quota")
+        return {"embedding": [[1.0] for _ in content]}
+
+    monkeypatch.setattr(eg.genai, "embed_content", embed_content)
+    embedder.backoff_base = 0
+    assert embedder.embed_texts(["a", "b"]) == [[1.0], [1.0]]
+    assert calls == [(embedder.model_name, ["a", "b"])] * 3
+
+
+def test_concurrent_batches_keep_order(embedder, monkeypatch):
+    """Los sub-lotes en paralelo conservan el orden de entrada"""
+    calls = []
+    monkeypatch.setattr(eg.genai, "embed_content", _fake_embed(calls))
+    embedder.batch_max_items = 2
+    embedder.concurrency = 3
+    texts = ["x" * n for n in range(1, 8)]
+    assert embedder.embed_texts(texts) == [[float(n)] for n in range(1, 8)]
+    assert len(calls) == 4
+
+
+def test_token_bucket_paces_requests(monkeypatch):
+    """El token bucket espera cuando se agota la capacidad"""
+    from app.rate_limit import TokenBucket
+    slept = []
+    monkeypatch.setattr("app.rate_limit.time.sleep", lambda d: slept.append(d))
+    bucket = TokenBucket(rate=1000.0, capacity=2)
+    bucket.acquire(2)
+    bucket.acquire(1)
+    assert slept and slept[0] > 0
+
+
+def test_embed_texts_async_batches_and_caches_queries(embedder, monkeypatch):
+    """La API asíncrona agrupa en lotes y memoiza las consultas"""
+    import asyncio
+    calls = []
+    sync_fake = _fake_embed(calls)
+
+    async def embed_content_async(model, content, **kw):
+        return sync_fake(model, content)
+
+    monkeypatch.setattr(eg.genai, "embed_content_async", embed_content_async)
+    embedder.batch_max_items = 2
+    vecs = asyncio.run(embedder.embed_texts_async(["a", "bb", "ccc"]))
+    assert vecs == [[1.0], [2.0], [3.0]]
+    assert calls == [["a", "bb"], "ccc"]
+
+    asyncio.run(embedder.embed_query_async("Llantas"))
+    asyncio.run(embedder.embed_query_async("llantas"))
+    assert calls[-1] == "Llantas" and len(calls) == 3
+
+
+def test_hashing_embedder_is_deterministic_and_normalized():
+    """El backend local es determinista, de dimensión fija y norma 1"""
+    emb = embeddings.build_embedder("hashing")
+    assert isinstance(emb, embeddings.Embedder)
+    a, b, c = emb.embed_texts(["Neumáticos radiales", "neumaticos  RADIALES", "resina epoxi"])
+    assert len(a) == emb.dim
+    assert a == emb.embed_query("Neumáticos radiales")
+    assert abs(sum(v * v for v in a) - 1.0) < 1e-9
+
+    def cos(x, y):
+        return sum(p * q for p, q in zip(x, y))
+
+    assert cos(a, b) > 0.99
+    assert cos(a, c) < 0.5
+
+
+def test_malformed_response_is_an_error_not_a_zero_vector(embedder, monkeypatch):
+    """Una respuesta con forma inesperada no produce un vector de ceros"""
+    monkeypatch.setattr(eg.genai, "embed_content", lambda model, content, **kw: {"unexpected": True})
+    with pytest.raises(eg.EmbeddingError):
+        embedder.embed_texts(["a"])
+    assert embedder.embed_texts(["a", "b"], strict=False) == [None, None]
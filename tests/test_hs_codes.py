@@ -0,0 +1,25 @@
+from app.hs_codes import extract_hs_codes, numeric_signature
+
+
+def test_extract_hs_codes_keeps_comma_separated_lists():
+    """Las listas de códigos separadas por comas no pierden ningún código"""
+    assert extract_hs_codes({"text": "las partidas 4011.10, 4011.20 y 4011.30."}) == [
+        "4011", "401110", "401120", "401130"]
+    assert extract_hs_codes({"text": "4011, 4012 y 4013"}) == ["4011", "4012", "4013"]
+
+
+def test_extract_hs_codes_ignores_decimal_numbers():
+    """Un decimal con punto o coma no es un código"""
+    assert extract_hs_codes({"text": "Peso 12.5000 kg; factor 1,4011; tasa 4011,50"}) == []
+
+
+def test_extract_hs_codes_reads_metadata_with_prefixes():
+    assert extract_hs_codes({"text": "", "hs6": "4011.10", "partida": "40111000"}) == [
+        "4011", "401110", "40111000"]
+
+
+def test_numeric_signature_canonicalizes_codes_and_numbers():
+    assert numeric_signature("neumáticos 4011.10 de 16 pulgadas") == ("16", "401110")
+    assert numeric_signature("4011 10") == numeric_signature("4011.10") == ("401110",)
+    assert numeric_signature("4011.10, 4011.20") == ("401110", "401120")
+    assert numeric_signature("resina epoxi") == ()
@@ -0,0 +1,193 @@
+import time
+
+import pytest
+
+import app.hs_codes as hs_codes_mapping
+import app.os_retrieval as osr
+from app.index_state import IndexMappingError, IndexReadiness, KnnWarmup, validate_index
+from app.quantization import knn_vector_mapping
+
+
+class _FakeIndices:
+    def __init__(self, mappings, exists=True):
+        self.mappings = mappings
+        self._exists = exists
+        self.calls = []
+        self.down = False
+
+    def exists(self, index):
+        self.calls.append("exists")
+        if self.down:
+            raise ConnectionError("cluster down")
+        return self._exists
+
+    def create(self, index, body):
+        self.calls.append("create")
+        self._exists = True
+        self.mappings = {index: {"mappings": body["mappings"]}}
+
+    def get_mapping(self, index):
+        self.calls.append("get_mapping")
+        return self.mappings
+
+    def get_settings(self, index, name, flat_settings):
+        self.calls.append("get_settings")
+        return {concrete: {"settings": {name: getattr(self, "ef_search", "100")}} for concrete in self.mappings}
+
+    def put_settings(self, index, body):
+        self.calls.append(("put_settings", index, body))
+
+
+class _FakeKnn:
+    def __init__(self, shards):
+        self.shards = shards
+        self.calls = []
+
+    def warmup(self, index, request_timeout=None):
+        self.calls.append((index, request_timeout))
+        if isinstance(self.shards, Exception):
+            raise self.shards
+        return {"_shards": self.shards}
+
+
+class _FakePlugins:
+    def __init__(self, shards):
+        self.knn = _FakeKnn(shards)
+
+
+class _FakeClient:
+    def __init__(self, mappings=None, exists=True, warmup_shards=None):
+        self.indices = _FakeIndices(mappings or {}, exists=exists)
+        self.plugins = _FakePlugins(warmup_shards or {"total": 1, "successful": 1, "failed": 0})
+
+
+def _mapping(dim=768, space="cosinesimil", mode="float", hs_codes=True):
+    props = {"embedding": knn_vector_mapping(dim, space, mode)}
+    if hs_codes:
+        props["hs_codes"] = hs_codes_mapping.MAPPING
+    return {"mappings": {"properties": props}}
+
+
+def test_validate_index_accepts_matching_alias_and_rejects_drift():
+    """El mapping coincide con Settings; dimensión/motor distintos abortan"""
+    client = _FakeClient({"frags_v2": _mapping()})
+    state = validate_index(client, "tariff_fragments")
+    assert state.ready and state.generation == "frags_v2"
+
+    drifted = _FakeClient({"frags_v1": _mapping(dim=256, mode="byte")})
+    with pytest.raises(IndexMappingError, match="dimension"):
+        validate_index(drifted, "tariff_fragments")
+
+
+def test_validate_index_falls_back_to_phrase_variants_without_hs_codes():
+    """Un índice sin 'hs_codes' (sin reindexar) desactiva las term queries hasta que lo tenga"""
+    try:
+        validate_index(_FakeClient({"frags_v1": _mapping(hs_codes=False), "frags_v2": _mapping()}), "tariff_fragments")
+        assert not osr._use_hs_codes_field()
+        assert {"match_phrase": {"text": {"query": "4011.10", "boost": 8.0}}} in osr._support_clauses("4011.10")
+        validate_index(_FakeClient({"frags_v2": _mapping()}), "tariff_fragments")
+        assert osr._use_hs_codes_field()
+        assert osr._hs_code_clauses("4011.10")[0] == {"term": {"hs_codes": {"value": "401110", "boost": 6.0}}}
+    finally:
+        osr.set_hs_codes_available(True)
+
+
+def test_validate_index_creates_missing_index():
+    client = _FakeClient(exists=False)
+    state = validate_index(client, "tariff_fragments")
+    assert state.ready
+    assert client.indices.calls == ["exists", "create", "get_mapping"]
+
+
+def test_readiness_is_cached_until_invalidated():
+    """Sin invalidación no hay llamadas al cluster; un error fuerza re-validar"""
+    client = _FakeClient({"frags_v1": _mapping()})
+    readiness = IndexReadiness(client, "tariff_fragments", ttl=0)
+    readiness.refresh(raise_on_drift=True)
+    calls = len(client.indices.calls)
+
+    for _ in range(5):
+        assert readiness.get().ready
+    assert len(client.indices.calls) == calls
+
+    client.indices.mappings = {"frags_v2": _mapping()}
+    readiness.invalidate("retrieval error")
+    assert readiness.get().generation == "frags_v2"
+    assert len(client.indices.calls) > calls
+
+
+def test_readiness_reports_outage_and_drift_without_raising():
+    client = _FakeClient({"frags_v1": _mapping()})
+    client.indices.down = True
+    readiness = IndexReadiness(client, "tariff_fragments", ttl=0)
+    state = readiness.refresh()
+    assert not state.ready and not state.mapping_mismatch and "cluster down" in state.error
+
+    client.indices.down = False
+    client.indices.mappings = {"frags_v1": _mapping(space="l2")}
+    state = readiness.get()
+    assert state.mapping_mismatch and "space_type" in state.error
+    with pytest.raises(IndexMappingError):
+        readiness.refresh(raise_on_drift=True)
+
+
+def test_validate_index_applies_profile_ef_search_to_existing_index(monkeypatch):
+    """Cambiar de perfil actualiza ef_search (dinámico) del índice nmslib existente"""
+    from app.config import get_settings
+
+    monkeypatch.setattr(get_settings(), "opensearch_knn_engine", "nmslib")
+    client = _FakeClient({"tariff_v1": _mapping()})
+    client.indices.ef_search = "100"
+    validate_index(client, "tariff")
+    assert not any(isinstance(c, tuple) for c in client.indices.calls)
+
+    monkeypatch.setattr(get_settings(), "opensearch_index_profile", "recall")
+    validate_index(client, "tariff")
+    assert ("put_settings", "tariff_v1", {"index": {"knn.algo_param.ef_search": 400}}) in client.indices.calls
+
+
+def test_knn_warmup_starts_when_the_cluster_comes_back():
+    """Con el cluster caído en el arranque el warmup queda pendiente (no listo) y
+    se lanza con el primer refresh exitoso, una sola vez"""
+    client = _FakeClient({"frags_v1": _mapping()})
+    client.indices.down = True
+    warmup = KnnWarmup(client, "tariff")
+    readiness = IndexReadiness(client, "tariff", ttl=0, on_ready=lambda state: warmup.start())
+    readiness.refresh()
+    assert warmup.status == "pending" and not warmup.ready
+
+    client.indices.down = False
+    readiness.get()
+    assert warmup.status in ("running", "done")
+    readiness.refresh()
+    for _ in range(200):
+        if warmup.ready:
+            break
+        time.sleep(0.01)
+    assert warmup.status == "done" and len(client.plugins.knn.calls) == 1
+
+
+def test_knn_warmup_tracks_readiness(monkeypatch):
+    """El warmup pasa a listo al terminar; fallos y lucene no bloquean el nodo"""
+    from app.config import get_settings
+
+    client = _FakeClient()
+    warmup = KnnWarmup(client, "tariff")
+    assert not warmup.ready and warmup.as_dict()["status"] == "pending"
+    warmup.run()
+    assert warmup.status == "done" and warmup.ready
+    assert client.plugins.knn.calls == [("tariff", get_settings().knn_warmup_timeout)]
+
+    partial = KnnWarmup(_FakeClient(warmup_shards={"total": 2, "successful": 1, "failed": 1}), "tariff")
+    partial.run()
+    assert partial.status == "failed" and partial.ready
+
+    down = KnnWarmup(_FakeClient(warmup_shards=ConnectionError("timeout")), "tariff")
+    down.run()
+    assert down.status == "failed" and "timeout" in down.error
+
+    monkeypatch.setattr(get_settings(), "opensearch_vector_mode", "byte")
+    lucene = _FakeClient()
+    skipped = KnnWarmup(lucene, "tariff")
+    skipped.run()
+    assert skipped.status == "skipped" and lucene.plugins.knn.calls == []
@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+
+import app.local_ann as local_ann
+import app.os_retrieval as osr
+from app.config import get_settings
+from app.local_ann import LocalANNIndex
+
+
+@pytest.fixture
+def ann_settings(monkeypatch, tmp_path):
+    s = get_settings()
+    monkeypatch.setattr(s, "opensearch_emb_dim", 4)
+    monkeypatch.setattr(s, "local_ann_path", str(tmp_path / "ann"))
+    monkeypatch.setattr(s, "local_ann_ivf_min_rows", 50)
+    monkeypatch.setattr(local_ann, "_index", None)
+    return s
+
+
+def _doc(i, hs6="401110"):
+    return {"fragment_id": f"p{i}", "bucket": "asgard_products", "hs6": hs6, "text": f"producto {i}"}
+
+
+def test_exact_and_ivf_search_persist_and_memory_map(ann_settings):
+    """Búsqueda exacta e IVF coinciden en el vecino más cercano; el archivo se abre con memmap"""
+    rng = np.random.default_rng(0)
+    vecs = rng.normal(size=(200, 4))
+    idx = LocalANNIndex(4)
+    idx.upsert([(f"p{i}", list(v), _doc(i, hs6=str(i % 2))) for i, v in enumerate(vecs)])
+    exact = idx.search(list(vecs[7]), k=3)
+    assert exact[0]["_id"] == "p7" and exact[0]["_score"] == pytest.approx(1.0)
+
+    idx.build_ivf(min_rows=50)
+    idx.save(ann_settings.local_ann_path)
+    loaded = LocalANNIndex.load(ann_settings.local_ann_path)
+    assert isinstance(loaded.vectors, np.memmap) and loaded.centroids is not None
+    assert loaded.search(list(vecs[7]), k=3, nprobe=4)[0]["_id"] == "p7"
+    only_even = loaded.search(list(vecs[7]), k=5, nprobe=len(loaded.centroids), match={"hs6": {"0"}})
+    assert only_even and all(h["_source"]["hs6"] == "0" for h in only_even)
+
+
+def test_ids_and_fields_are_memory_mapped_and_read_lazily(ann_settings):
+    """ids, campos y textos se guardan como .npy memory-mapped; el hit se arma solo para el top-k"""
+    idx = LocalANNIndex(4)
+    idx.upsert([("p1", [1.0, 0.0, 0.0, 0.0], _doc(1)), ("p2", [0.0, 1.0, 0.0, 0.0], _doc(2, hs6="847130"))])
+    idx.upsert([("p1", [1.0, 0.1, 0.0, 0.0], {**_doc(1), "text": "llanta radial ñ"})])
+    idx.save(ann_settings.local_ann_path)
+    loaded = LocalANNIndex.load(ann_settings.local_ann_path)
+    assert isinstance(loaded.ids, np.memmap) and isinstance(loaded.texts.blob, np.memmap)
+    assert all(isinstance(c, np.memmap) for c in loaded.columns.values())
+    hit = loaded.search([1.0, 0.0, 0.0, 0.0], k=1, match={"hs6": {"401110"}})[0]
+    assert hit["_id"] == "p1"
+    assert hit["_source"] == {"fragment_id": "p1", "bucket": "asgard_products", "hs6": "401110",
+                              "text": "llanta radial ñ"}
+
+    # Re-abrir para la ingesta y añadir filas conserva las existentes
+    again = LocalANNIndex.load(ann_settings.local_ann_path, mmap=False)
+    again.upsert([("p3", [0.0, 0.0, 1.0, 0.0], _doc(3))])
+    assert list(again.ids) == ["p1", "p2", "p3"] and again.doc(1)["hs6"] == "847130"
+
+
+def test_ingest_keeps_local_index_in_sync(ann_settings, monkeypatch, tmp_path):
+    import app.os_ingest as os_ingest
+    from app.reembed_queue import ReembedQueue
+
+    class _Emb:
+        def embed_texts(self, texts, strict=True):
+            return [[1.0, float(len(t)), 0.0, 0.0] for t in texts]
+
+    monkeypatch.setattr(os_ingest, "get_os_client", lambda: object())
+    monkeypatch.setattr(os_ingest, "ensure_index", lambda index: None)
+    monkeypatch.setattr(os_ingest, "get_embedder", lambda: _Emb())
+    monkeypatch.setattr(os_ingest, "encode_for_index", lambda v: v)
+    monkeypatch.setattr(os_ingest.helpers, "bulk", lambda client, actions: None)
+    queue = ReembedQueue(str(tmp_path / "queue.sqlite"))
+    monkeypatch.setattr(os_ingest, "get_reembed_queue", lambda: queue)
+    frags = [{"fragment_id": "p1", "text": "llanta", "metadata": {"bucket": "asgard_products"}},
+             {"fragment_id": "n1", "text": "nota", "metadata": {"bucket": "WCO"}}]
+    stats = os_ingest.bulk_ingest_fragments(frags, "idx", embed=True)
+    assert stats["local_ann"] == 1
+    assert list(local_ann.get_local_ann().ids) == ["p1"]
+
+
+def test_hybrid_search_serves_knn_locally_for_the_hot_bucket(ann_settings, monkeypatch):
+    idx = LocalANNIndex(4)
+    idx.upsert([("p1", [1.0, 0.0, 0.0, 0.0], _doc(1))])
+    monkeypatch.setattr(osr, "get_local_ann", lambda: idx)
+    monkeypatch.setattr(osr, "encode_for_index", lambda v: list(v))
+
+    class _BM25Only:
+        def search(self, index, body):
+            assert "knn" not in body["query"]
+            return {"hits": {"hits": []}}
+
+    filters = osr.build_filters(bucket="asgard_products", hs6="401110")
+    hits = osr.hybrid_search(_BM25Only(), "idx", "llanta", k=3, query_vector=[1.0, 0.0, 0.0, 0.0],
+                             filters=filters, rerank=False)
+    assert [h["_id"] for h in hits] == ["p1"] and hits[0]["_snippet"]
+    assert osr._local_match(osr.build_filters(bucket="WCO"), "asgard_products") is None
+    assert osr._local_match(osr.build_filters(bucket="asgard_products", valid_at="2024-01-01"),
+                            "asgard_products") is None
@@ -0,0 +1,19 @@
+import app.os_index as os_index
+from app.config import get_settings
+
+
+def test_os_client_is_shared_and_pooled(monkeypatch):
+    """Un solo cliente por proceso con el pool/compresión/timeout de Settings"""
+    s = get_settings()
+    monkeypatch.setattr(s, "opensearch_pool_maxsize", 33)
+    monkeypatch.setattr(os_index, "_client", None)
+    client = os_index.get_os_client()
+    try:
+        assert os_index.get_os_client() is client
+        conn = client.transport.get_connection()
+        assert conn.pool.pool.maxsize == 33
+        assert conn.http_compress is True
+        assert conn.timeout == s.opensearch_timeout
+    finally:
+        os_index.close_os_client()
+    assert os_index._client is None
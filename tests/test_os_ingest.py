@@ -0,0 +1,199 @@
+import time
+
+import pytest
+
+import app.os_ingest as os_ingest
+
+
+class _FakeEmbedder:
+    model_name = "fake"
+
+    def __init__(self, fail_on=()):
+        self.calls = []
+        self.fail_on = set(fail_on)
+
+    def embed_texts(self, texts, strict=True):
+        self.calls.append(list(texts))
+        return [None if t in self.fail_on else [float(len(t)), 1.0] for t in texts]
+
+
+class _FakeIndices:
+    def __init__(self):
+        self.refreshed = []
+
+    def refresh(self, index):
+        self.refreshed.append(index)
+
+
+class _FakeClient:
+    def __init__(self):
+        self.indices = _FakeIndices()
+        self.warmups = []
+
+    def mget(self, index, body, _source):
+        return {"docs": [{"_id": i, "found": True,
+                          "_source": {"bucket": "asgard_products", "hs6": "401110", "text": "llanta"}}
+                         for i in body["ids"]]}
+
+
+@pytest.fixture
+def ingest_env(monkeypatch, tmp_path):
+    from app.reembed_queue import ReembedQueue
+    sent = []
+    embedder = _FakeEmbedder()
+    client = _FakeClient()
+    queue = ReembedQueue(str(tmp_path / "ingest_queue.sqlite"))
+    monkeypatch.setattr(os_ingest, "get_reembed_queue", lambda: queue)
+    monkeypatch.setattr(os_ingest, "get_os_client", lambda: client)
+    monkeypatch.setattr(os_ingest, "warmup_knn", lambda index, client=None: client.warmups.append(index) or {})
+    monkeypatch.setattr(os_ingest, "ensure_index", lambda index: None)
+    monkeypatch.setattr(os_ingest, "get_embedder", lambda: embedder)
+    monkeypatch.setattr(os_ingest, "encode_for_index", lambda v: v)
+    monkeypatch.setattr(os_ingest.helpers, "bulk", lambda client, actions: sent.extend(actions))
+    return embedder, sent
+
+
+def test_bulk_ingest_embeds_each_distinct_text_once(ingest_env):
+    """Textos repetidos (también entre lotes) se embeben una sola vez"""
+    embedder, sent = ingest_env
+    frags = [
+        {"fragment_id": "a", "text": "MERCANCÍA: LLANTA | PARTIDA: 4011"},
+        {"fragment_id": "b", "text": "MERCANCÍA:  LLANTA | PARTIDA: 4011 "},
+        {"fragment_id": "c", "text": "| Código | Descripción |"},
+        {"fragment_id": "d", "text": "| Código | Descripción |"},
+    ]
+    stats = os_ingest.bulk_ingest_fragments(frags, "idx", embed=True, batch_size=3)
+    assert stats == {"indexed": 4, "embedded": 2, "pending": 0, "local_ann": 0}
+    assert embedder.calls == [["MERCANCÍA: LLANTA | PARTIDA: 4011", "| Código | Descripción |"]]
+    vecs = {a["_id"]: a["_source"]["embedding"] for a in sent}
+    assert vecs["a"] == vecs["b"] and vecs["c"] == vecs["d"]
+    assert all(isinstance(v, float) for v in vecs["d"])
+    # Un solo warmup al final de la ingesta, no por lote
+    client = os_ingest.get_os_client()
+    assert client.warmups == ["idx"] and client.indices.refreshed == ["idx"]
+    os_ingest.bulk_ingest_fragments(frags, "idx", embed=True, warmup=False)
+    assert client.warmups == ["idx"]
+
+
+def test_dedup_window_keeps_float32_arrays():
+    """La ventana de dedup guarda arrays float32, no listas de floats"""
+    from app.ttl_cache import TTLCache
+    seen = TTLCache(maxsize=10, ttl=0)
+    vectors, n_new = os_ingest._embed_deduplicated(_FakeEmbedder(), ["abc", "abc "], seen)
+    assert n_new == 1 and vectors[0] == vectors[1] == [3.0, 1.0]
+    stored = seen.get(os_ingest.normalize_for_key("abc"))
+    assert stored.dtype.name == "float32" and stored.nbytes == 8
+
+
+def test_fallback_model_vectors_are_not_indexed():
+    """Un vector de otro modelo (p.ej. embedding-001) no se indexa: el texto queda pendiente"""
+    from app.ttl_cache import TTLCache
+
+    class _OtherModel(list):
+        model = "models/embedding-001"
+
+    class _MixedEmbedder(_FakeEmbedder):
+        def embed_texts(self, texts, strict=True):
+            return [_OtherModel([1.0, 1.0]) if t == "viejo" else [2.0, 1.0] for t in texts]
+
+    seen = TTLCache(maxsize=10, ttl=0)
+    vectors, _ = os_ingest._embed_deduplicated(_MixedEmbedder(), ["viejo", "nuevo"], seen)
+    assert vectors == [None, [2.0, 1.0]]
+    assert seen.get(os_ingest.normalize_for_key("viejo")) is None
+
+
+def test_flatten_metadata_canonicalizes_hs_codes():
+    """Toda grafía de código del texto/metadata queda en hs_codes como dígitos"""
+    src = os_ingest._flatten_metadata({
+        "fragment_id": "a",
+        "text": "Subpartida 4011 . 10 y 4011-20.00; ver 8471 30. Peso 12.50 kg",
+        "metadata": {"hs6": "401110", "partida": "4011100000"},
+    })
+    assert src["hs6"] == "401110"
+    assert set(src["hs_codes"]) == {"4011", "401110", "40111000", "4011100000",
+                                    "401120", "40112000", "8471", "847130"}
+    assert os_ingest._flatten_metadata({"text": "x", "hs_codes": ["1"]})["hs_codes"] == ["1"]
+
+
+def test_failed_embeddings_are_quarantined_and_healed(ingest_env, monkeypatch, tmp_path):
+    """Fragmentos sin embedding se marcan 'pending', se encolan y el drenado los repara"""
+    from app.reembed_queue import ReembedQueue
+    embedder, sent = ingest_env
+    queue = ReembedQueue(str(tmp_path / "queue.sqlite"))
+    monkeypatch.setattr(os_ingest, "get_reembed_queue", lambda: queue)
+    embedder.fail_on = {"roto"}
+
+    stats = os_ingest.bulk_ingest_fragments(
+        [{"fragment_id": "a", "text": "bien"}, {"fragment_id": "b", "text": "roto"}], "idx", embed=True
+    )
+    assert stats["pending"] == 1
+    docs = {a["_id"]: a["_source"] for a in sent}
+    assert docs["a"]["embedding_status"] == "ok"
+    assert docs["b"]["embedding_status"] == "pending" and "embedding" not in docs["b"]
+    assert len(queue) == 1
+
+    sent.clear()
+    embedder.fail_on = set()
+    out = os_ingest.drain_reembed_queue(batch_size=10)
+    assert out["healed"] == 1 and out["pending"] == 0
+    assert sent == [{
+        "_op_type": "update", "_index": "idx", "_id": "b",
+        "doc": {"embedding": [4.0, 1.0], "embedding_status": "ok"},
+    }]
+
+
+def test_reembed_outage_spends_one_attempt_per_pass(ingest_env, monkeypatch, tmp_path):
+    """Con el embedder caído una pasada toca cada fila una sola vez; los 'dead' se pueden reactivar"""
+    from app.reembed_queue import ReembedQueue
+    embedder, sent = ingest_env
+    queue = ReembedQueue(str(tmp_path / "queue.sqlite"), max_attempts=2, retry_backoff=0)
+    monkeypatch.setattr(os_ingest, "get_reembed_queue", lambda: queue)
+    queue.push_many("idx", [(f"f{i}", f"texto {i}") for i in range(10)], error="timeout")
+    embedder.fail_on = {f"texto {i}" for i in range(10)}
+
+    out = os_ingest.drain_reembed_queue(batch_size=4)
+    assert (out["failed"], out["batches"], out["pending"], out["dead"]) == (10, 3, 10, 0)
+    out = os_ingest.drain_reembed_queue(batch_size=4)
+    assert (out["batches"], out["dead"]) == (3, 10)
+    assert os_ingest.drain_reembed_queue(batch_size=4)["batches"] == 0
+
+    assert queue.requeue_dead("idx") == 10
+    embedder.fail_on = set()
+    assert os_ingest.drain_reembed_queue(batch_size=4)["healed"] == 10
+
+
+def test_reembed_backoff_delays_next_attempt(tmp_path):
+    from app.reembed_queue import ReembedQueue
+    queue = ReembedQueue(str(tmp_path / "queue.sqlite"), retry_backoff=60)
+    queue.push_many("idx", [("a", "x")])
+    queue.fail("idx", ["a"], "timeout")
+    assert queue.peek_batch(10) == []
+    assert len(queue.peek_batch(10, due_at=time.time() + 61)) == 1
+
+
+def test_successful_reingest_acks_stale_queue_entry(ingest_env):
+    """Re-ingestar con éxito un fragmento encolado lo saca de la cola"""
+    embedder, sent = ingest_env
+    queue = os_ingest.get_reembed_queue()
+    queue.push_many("idx", [("a", "texto viejo")], error="timeout")
+    os_ingest.bulk_ingest_fragments([{"fragment_id": "a", "text": "texto nuevo"}], "idx", embed=True)
+    assert queue.counts() == {"pending": 0, "dead": 0}
+
+
+def test_reembed_drain_keeps_local_ann_in_sync(ingest_env, monkeypatch, tmp_path):
+    """Los fragmentos reparados del bucket caliente entran también al índice local"""
+    from app.config import get_settings
+    from app.local_ann import LocalANNIndex
+    from app.reembed_queue import ReembedQueue
+
+    s = get_settings()
+    monkeypatch.setattr(s, "opensearch_emb_dim", 2)
+    monkeypatch.setattr(s, "local_ann_path", str(tmp_path / "ann"))
+    queue = ReembedQueue(str(tmp_path / "queue.sqlite"))
+    monkeypatch.setattr(os_ingest, "get_reembed_queue", lambda: queue)
+    queue.push_many("idx", [("p1", "llanta")], error="timeout")
+
+    out = os_ingest.drain_reembed_queue(batch_size=10)
+    assert out["healed"] == 1 and out["local_ann"] == 1
+    idx = LocalANNIndex.load(s.local_ann_path)
+    assert list(idx.ids) == ["p1"] and idx.doc(0)["hs6"] == "401110"
@@ -0,0 +1,110 @@
+import math
+
+import pytest
+
+from app.quantization import effective_space, encode_vector, knn_index_settings, knn_vector_mapping
+
+
+def _cos(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    return dot / (math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b)))
+
+
+def test_float_mapping_defaults_to_faiss_and_keeps_nmslib_override(monkeypatch):
+    """El modo float usa faiss (pre-filtrado); OPENSEARCH_KNN_ENGINE=nmslib conserva el motor histórico"""
+    from app.config import get_settings
+
+    m = knn_vector_mapping(768, "cosinesimil", "float")
+    assert m["method"]["engine"] == "faiss" and m["method"]["space_type"] == "innerproduct"
+    assert "data_type" not in m
+    monkeypatch.setattr(get_settings(), "opensearch_knn_engine", "nmslib")
+    legacy = knn_vector_mapping(768, "cosinesimil", "float")
+    assert legacy["method"]["engine"] == "nmslib" and legacy["method"]["space_type"] == "cosinesimil"
+    assert knn_vector_mapping(4, "cosinesimil", "fp16")["method"]["engine"] == "faiss"
+    monkeypatch.setattr(get_settings(), "opensearch_knn_engine", "annoy")
+    with pytest.raises(ValueError):
+        knn_vector_mapping(4, "cosinesimil", "float")
+
+
+def test_byte_mapping_and_encoding_preserve_cosine():
+    """El modo byte usa lucene y conserva el coseno aproximado"""
+    m = knn_vector_mapping(4, "cosinesimil", "byte")
+    assert m["data_type"] == "byte" and m["method"]["engine"] == "lucene"
+    vec = [0.031, -0.002, 0.5, -0.25]
+    enc = encode_vector(vec, "byte")
+    assert all(isinstance(v, int) and -128 <= v <= 127 for v in enc)
+    assert max(abs(v) for v in enc) == 127
+    assert _cos(vec, enc) > 0.999
+
+
+def test_fp16_uses_faiss_innerproduct_on_normalized_vectors():
+    """fp16 mapea cosinesimil a innerproduct y normaliza los vectores"""
+    m = knn_vector_mapping(4, "cosinesimil", "fp16")
+    assert m["method"]["engine"] == "faiss"
+    assert m["method"]["space_type"] == effective_space("cosinesimil", "fp16") == "innerproduct"
+    enc = encode_vector([3.0, 4.0, 0.0, 0.0], "fp16")
+    assert enc == [0.6, 0.8, 0.0, 0.0]
+
+
+def test_index_profiles_set_engine_and_hnsw_parameters(monkeypatch):
+    """El perfil fija motor (modo float), m/ef_construction y ef_search"""
+    from app.config import get_settings
+
+    recall = knn_vector_mapping(4, "cosinesimil", "float", "recall")
+    assert recall["method"]["engine"] == "faiss"
+    assert recall["method"]["parameters"] == {"m": 32, "ef_construction": 512, "ef_search": 400}
+    assert "knn.algo_param.ef_search" not in knn_index_settings("float", "recall")
+
+    # nmslib (índices anteriores): ef_search como setting dinámico, no en el mapping
+    monkeypatch.setattr(get_settings(), "opensearch_knn_engine", "nmslib")
+    m = knn_vector_mapping(4, "cosinesimil", "float", "recall")
+    assert m["method"]["parameters"] == {"m": 32, "ef_construction": 512}
+    assert knn_index_settings("float", "recall")["knn.algo_param.ef_search"] == 400
+    monkeypatch.setattr(get_settings(), "opensearch_knn_engine", "")
+
+    fast = knn_vector_mapping(4, "cosinesimil", "float", "latency")
+    assert fast["method"]["engine"] == "faiss" and fast["method"]["space_type"] == "innerproduct"
+    # faiss lee ef_search del mapping, no del setting de índice (solo nmslib)
+    assert fast["method"]["parameters"]["ef_search"] == 32
+    assert "knn.algo_param.ef_search" not in knn_index_settings("float", "latency")
+    assert knn_vector_mapping(4, "cosinesimil", "fp16", "recall")["method"]["parameters"]["ef_search"] == 400
+    assert "ef_search" not in m["method"]["parameters"]
+    assert encode_vector([3.0, 4.0, 0.0, 0.0], "float", profile="latency") == [0.6, 0.8, 0.0, 0.0]
+
+    # fp16/byte conservan su motor; lucene no usa ef_search
+    assert knn_vector_mapping(4, "cosinesimil", "byte", "latency")["method"]["engine"] == "lucene"
+    assert "encoder" in knn_vector_mapping(4, "cosinesimil", "fp16", "recall")["method"]["parameters"]
+    assert "knn.algo_param.ef_search" not in knn_index_settings("byte", "recall")
+    with pytest.raises(ValueError):
+        knn_vector_mapping(4, "cosinesimil", "float", "turbo")
+
+
+def test_invalid_modes_are_rejected():
+    with pytest.raises(ValueError):
+        knn_vector_mapping(4, "cosinesimil", "int4")
+    with pytest.raises(ValueError):
+        knn_vector_mapping(4, "l2", "byte")
+
+
+def test_reduce_vector_truncates_and_renormalizes():
+    """Truncado Matryoshka: primeras componentes con norma 1"""
+    from app.dim_reduction import reduce_vector
+    out = reduce_vector([3.0, 4.0, 12.0], 2)
+    assert out == [0.6, 0.8]
+    assert reduce_vector([1.0, 2.0], 2) == [1.0, 2.0]
+    with pytest.raises(ValueError):
+        reduce_vector([1.0], 2)
+
+
+def test_pca_projection_roundtrip(tmp_path):
+    """La PCA ajustada se guarda, se recarga y proyecta a la dimensión pedida"""
+    import numpy as np
+    from app.dim_reduction import PCAProjection, load_pca, reduce_vector
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(50, 8)) @ np.diag([5, 4, 3, 1, 0.1, 0.1, 0.1, 0.1])
+    path = str(tmp_path / "pca.npz")
+    PCAProjection.fit(x, 4).save(path)
+    assert load_pca(path).max_dim == 4
+    out = reduce_vector(x[0].tolist(), 3, "pca", path)
+    assert len(out) == 3
+    assert abs(sum(v * v for v in out) - 1.0) < 1e-5
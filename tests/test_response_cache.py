@@ -0,0 +1,63 @@
+import time
+
+from app.response_cache import ResponseCache, is_cacheable
+
+
+def test_exact_hit_normalizes_query_and_respects_top_k():
+    cache = ResponseCache(maxsize=4, ttl=0)
+    cache.set(cache.make_key("Resina  Epoxi", 3, "g1"), {"answer": 1})
+    assert cache.get(cache.make_key("resina epoxi", 3, "g1")) == {"answer": 1}
+    assert cache.get(cache.make_key("resina epoxi", 5, "g1")) is None
+
+
+def test_semantic_tier_reuses_near_duplicates_only():
+    """Coseno >= threshold reutiliza la respuesta; vectores lejanos no"""
+    cache = ResponseCache(maxsize=4, ttl=0, threshold=0.95)
+    cache.set(cache.make_key("resina epoxi liquida", 3, "g1"), {"answer": 1}, [1.0, 0.0, 0.1])
+    near = cache.make_key("resina epoxi líquida en bidones", 3, "g1")
+    assert cache.get(near) is None
+    assert cache.get_similar(near, [1.0, 0.02, 0.1]) == {"answer": 1}
+    assert cache.get_similar(near, [0.0, 1.0, 0.0]) is None
+    assert cache.get_similar(cache.make_key("x", 5, "g1"), [1.0, 0.0, 0.1]) is None
+    assert cache.get_similar(near, None) is None
+
+
+def test_semantic_tier_never_mixes_hs_codes_or_numbers():
+    """Consultas que solo difieren en el código (o en un número) no comparten entrada"""
+    cache = ResponseCache(maxsize=4, ttl=0, threshold=0.5)
+    vec = [1.0, 0.0, 0.1]
+    cache.set(cache.make_key("neumáticos radiales 4011.10", 3, "g1"), {"hs": "4011.10"}, vec)
+    assert cache.get_similar(cache.make_key("neumáticos radiales 4011.20", 3, "g1"), vec) is None
+    assert cache.get_similar(cache.make_key("neumáticos radiales", 3, "g1"), vec) is None
+    assert cache.get_similar(cache.make_key("neumáticos radiales 4011 10", 3, "g1"), vec) == {"hs": "4011.10"}
+
+    cache.set(cache.make_key("llantas de 16 pulgadas", 3, "g1"), {"hs": "8708.70"}, vec)
+    assert cache.get_similar(cache.make_key("llantas de 17 pulgadas", 3, "g1"), vec) is None
+
+
+def test_generation_change_lru_and_ttl():
+    cache = ResponseCache(maxsize=2, ttl=0.05)
+    cache.check_generation("g1")
+    for q in ("a", "b", "c"):
+        cache.set(cache.make_key(q, 3, "g1"), q)
+    assert len(cache) == 2 and cache.get(cache.make_key("a", 3, "g1")) is None
+
+    cache.check_generation("g1")
+    assert len(cache) == 2
+    cache.check_generation("g2")
+    assert len(cache) == 0
+
+    cache.set(cache.make_key("d", 3, "g2"), "d")
+    time.sleep(0.06)
+    assert cache.get(cache.make_key("d", 3, "g2")) is None
+
+
+def test_degraded_responses_are_not_cacheable():
+    """Ni "LLM offline", ni sin candidatos, ni sin evidencia, ni BM25-only por fallo del embedder"""
+    ok = {"top_candidates": [{"code": "4011.10"}], "warnings": []}
+    hits, vec = [{"_id": "a"}], [1.0, 0.0]
+    assert is_cacheable(ok, hits, vec)
+    assert not is_cacheable({**ok, "warnings": ["LLM offline"]}, hits, vec)
+    assert not is_cacheable({**ok, "top_candidates": []}, hits, vec)
+    assert not is_cacheable(ok, [], vec)
+    assert not is_cacheable(ok, hits, None)
@@ -0,0 +1,358 @@
+import pytest
+
+import app.os_retrieval as osr
+
+
+@pytest.fixture(autouse=True)
+def _raw_vectors(monkeypatch):
+    monkeypatch.setattr(osr, "encode_for_index", lambda v: list(v))
+
+
+def _hit(doc_id, score=1.0):
+    return {"_id": doc_id, "_score": score, "_source": {"fragment_id": doc_id, "text": doc_id}}
+
+
+def test_rrf_fusion_rewards_agreement_and_respects_weights():
+    """RRF premia documentos presentes en ambas listas y aplica pesos"""
+    bm25 = [_hit("a"), _hit("b"), _hit("c")]
+    knn = [_hit("c"), _hit("d"), _hit("a")]
+    fused = osr.rrf_fusion([bm25, knn], k=60)
+    assert [h["_id"] for h in fused][:2] == ["a", "c"]
+    assert set(fused[0]) == {"_id", "_score", "_source"}
+
+    knn_heavy = osr.rrf_fusion([bm25, knn], k=60, weights=[0.0, 1.0], topn=2)
+    assert [h["_id"] for h in knn_heavy] == ["c", "d"]
+
+
+class _FakeClient:
+    def __init__(self, knn_fails=False):
+        self.knn_fails = knn_fails
+        self.bodies = []
+
+    def search(self, index, body):
+        self.bodies.append(body)
+        if "knn" in body["query"]:
+            if self.knn_fails:
+                raise RuntimeError("knn down")
+            return {"hits": {"hits": [_hit("k1"), _hit("shared")]}}
+        return {"hits": {"hits": [_hit("shared"), _hit("b1")]}}
+
+
+def test_hybrid_search_fuses_both_sides():
+    """hybrid_search lanza ambos lados con su profundidad y fusiona"""
+    client = _FakeClient()
+    hits = osr.hybrid_search(client, "idx", "neumáticos", k=3, query_vector=[0.1, 0.2],
+                             bm25_depth=7, knn_depth=9, use_msearch=False, rerank=False)
+    assert hits[0]["_id"] == "shared"
+    assert {h["_id"] for h in hits} == {"shared", "k1", "b1"}
+    sizes = sorted(b["size"] for b in client.bodies)
+    assert sizes == [7, 9]
+
+
+def test_hybrid_search_degrades_to_bm25_when_knn_fails():
+    """Si kNN falla, el resultado es BM25 puro"""
+    hits = osr.hybrid_search(_FakeClient(knn_fails=True), "idx", "neumáticos", k=5, query_vector=[0.1],
+                             use_msearch=False)
+    assert [h["_id"] for h in hits] == ["shared", "b1"]
+
+
+def test_failed_query_embedding_goes_bm25_only_without_reembedding(monkeypatch):
+    """Si el embedding async de /classify falla, no se reintenta en un worker: solo BM25"""
+    import asyncio
+    import app.api as api
+
+    class _DownEmbedder:
+        calls = 0
+
+        async def embed_query_async(self, text):
+            raise RuntimeError("429 quota")
+
+        def embed_query(self, text):
+            _DownEmbedder.calls += 1
+            raise RuntimeError("429 quota")
+
+    monkeypatch.setattr(api, "get_embedder", lambda: _DownEmbedder())
+    monkeypatch.setattr(osr, "get_embedder", lambda: _DownEmbedder())
+    vector = asyncio.run(api._embed_query_or_none("neumáticos"))
+    assert vector is None
+
+    client = _FakeClient()
+    hits = osr.hybrid_search_with_fallback(client, "idx", "neumáticos", k=5, query_vector=vector,
+                                           skip_knn=vector is None)
+    assert [h["_id"] for h in hits][:2] == ["shared", "b1"]
+    assert _DownEmbedder.calls == 0
+    assert len(client.bodies) == 1 and "knn" not in client.bodies[0]["query"]
+
+
+def test_hybrid_search_raises_when_both_sides_fail():
+    class Broken:
+        def search(self, index, body):
+            raise RuntimeError("down")
+    with pytest.raises(RuntimeError):
+        osr.hybrid_search(Broken(), "idx", "x", k=3, query_vector=[0.1], use_msearch=False)
+
+
+class _FakeMsearchClient(_FakeClient):
+    def __init__(self, knn_error=False):
+        super().__init__()
+        self.knn_error = knn_error
+        self.msearch_calls = 0
+
+    def msearch(self, body):
+        self.msearch_calls += 1
+        responses = []
+        for header, b in zip(body[::2], body[1::2]):
+            assert header == {"index": "idx"}
+            if "knn" in b["query"] and self.knn_error:
+                responses.append({"error": {"reason": "knn plugin unavailable"}, "status": 500})
+            else:
+                responses.append(_FakeClient.search(self, "idx", b))
+        return {"responses": responses}
+
+
+def test_hybrid_search_uses_single_msearch_round_trip():
+    """Con vector disponible, BM25 + kNN viajan en un único _msearch"""
+    client = _FakeMsearchClient()
+    hits = osr.hybrid_search(client, "idx", "neumáticos", k=3, query_vector=[0.1], use_msearch=True)
+    assert client.msearch_calls == 1
+    assert hits[0]["_id"] == "shared"
+    assert {h["_id"] for h in hits} == {"shared", "k1", "b1"}
+
+
+def test_msearch_demultiplexes_sub_query_errors():
+    """Un error en una sub-consulta no descarta la otra"""
+    client = _FakeMsearchClient(knn_error=True)
+    hits = osr.hybrid_search(client, "idx", "neumáticos", k=3, query_vector=[0.1], use_msearch=True)
+    assert [h["_id"] for h in hits] == ["shared", "b1"]
+
+
+def test_bm25_body_reuses_prebuilt_clauses_and_chapter_terms(monkeypatch, tmp_path):
+    """Cláusulas HS y de dominio precalculadas; vocabulario por capítulo configurable"""
+    from app.config import get_settings
+
+    body = osr._bm25_body("neumáticos radiales 4011.10", k=5)
+    should = body["query"]["bool"]["should"]
+    assert should[0]["match"]["text"]["query"] == "neumáticos radiales 4011.10"
+    assert {"term": {"hs_codes": {"value": "401110", "boost": 6.0}}} in should
+    assert {"term": {"hs_codes": {"value": "4011", "boost": 4.0}}} in should
+    assert not any("match_phrase" in c for c in should)
+    assert "tyre" in should[-1]["match"]["text"]["query"]
+    again = osr._bm25_body("otra consulta 4011.10", k=5)["query"]["bool"]["should"]
+    assert all(a is b for a, b in zip(should[1:], again[1:]))
+
+    terms = tmp_path / "terms.json"
+    terms.write_text('{"39": ["resina", "epoxi"]}', encoding="utf-8")
+    monkeypatch.setattr(get_settings(), "domain_terms_path", str(terms))
+    osr._domain_clauses.cache_clear()
+    osr._support_clauses.cache_clear()
+    try:
+        resin = osr._bm25_body("resina 3907.30", k=5)["query"]["bool"]["should"]
+        assert resin[-1]["match"]["text"]["query"] == "resina epoxi"
+        # Sin código HS se usan los capítulos por defecto (40)
+        plain = osr._bm25_body("resina liquida", k=5)["query"]["bool"]["should"]
+        assert "neumático" in plain[-1]["match"]["text"]["query"]
+        support = osr._support_clauses("3907.30")
+        assert support[-1]["match"]["text"]["query"] == "resina epoxi"
+    finally:
+        osr._domain_clauses.cache_clear()
+        osr._support_clauses.cache_clear()
+
+
+def test_hs_code_clauses_fall_back_to_phrase_variants(monkeypatch):
+    """Sin el campo hs_codes (índice sin reindexar) se vuelve a las variantes en texto"""
+    from app.config import get_settings
+
+    monkeypatch.setattr(get_settings(), "opensearch_hs_codes_field", False)
+    osr._hs_code_clauses.cache_clear()
+    osr._support_clauses.cache_clear()
+    try:
+        should = osr._bm25_body("neumáticos 4011.10", k=5)["query"]["bool"]["should"]
+        assert {"match_phrase": {"text": {"query": "4011 10", "boost": 6.0}}} in should
+        assert {"match_phrase": {"text": {"query": "4011.10", "boost": 8.0}}} in osr._support_clauses("4011.10")
+    finally:
+        osr._hs_code_clauses.cache_clear()
+        osr._support_clauses.cache_clear()
+
+
+def test_knn_filters_are_prefilters_by_default(monkeypatch):
+    """Con la configuración por defecto (faiss) y con lucene los filtros van dentro del kNN"""
+    from app.config import get_settings
+
+    filters = osr.build_filters(bucket="ASGARD", edition=["HS_2022", "HS_2017"], valid_at="2024-05-01")
+    assert filters[0] == {"term": {"bucket": "ASGARD"}}
+    assert filters[1] == {"terms": {"edition": ["HS_2022", "HS_2017"]}}
+    assert len(filters) == 4
+    assert osr.build_filters(hs6=["4011.10", "4011 20"]) == [{"terms": {"hs6": ["401110", "401120"]}}]
+
+    for profile in ("latency", "balanced", "recall"):
+        monkeypatch.setattr(get_settings(), "opensearch_index_profile", profile)
+        knn = osr._knn_body([0.1, 0.2], k=5, filters=filters)["query"]["knn"]["embedding"]
+        assert knn["filter"] == {"bool": {"filter": filters}} and knn["k"] == 5
+        assert osr._exact_knn_ok(None, "idx", filters) is False
+
+    monkeypatch.setattr(get_settings(), "opensearch_vector_mode", "byte")
+    body = osr._knn_body([0.1, 0.2], k=5, filters=filters)
+    assert body["query"]["knn"]["embedding"]["filter"] == {"bool": {"filter": filters}}
+
+    bm25 = osr._bm25_body("neumáticos", k=5, filters=filters)
+    assert bm25["query"]["bool"]["filter"] == filters
+
+
+def test_nmslib_cannot_prefilter_and_uses_exact_or_post_filter(monkeypatch):
+    """nmslib (OPENSEARCH_KNN_ENGINE=nmslib, índices anteriores) no pre-filtra:
+    kNN exacto sobre subconjuntos pequeños, post-filtro sobremuestreado en los grandes"""
+    from app.config import get_settings
+
+    filters = osr.build_filters(bucket="ASGARD", edition=["HS_2022", "HS_2017"], valid_at="2024-05-01")
+    monkeypatch.setattr(get_settings(), "opensearch_knn_engine", "nmslib")
+    body = osr._knn_body([0.1, 0.2], k=5, filters=filters, exact=True)
+    assert body["query"]["script_score"]["query"] == {"bool": {"filter": filters}}
+    assert body["query"]["script_score"]["script"]["params"]["space_type"] == "cosinesimil"
+    assert "knn" in osr._knn_body([0.1, 0.2], k=5)["query"]
+
+    # nmslib sobre un subconjunto grande: kNN aproximado sobremuestreado + post-filtro
+    broad = osr._knn_body([0.1, 0.2], k=5, filters=filters)["query"]["bool"]
+    assert broad["filter"] == filters
+    assert broad["must"][0]["knn"]["embedding"]["k"] == 5 * get_settings().knn_filter_oversample
+
+    class _Counter:
+        def __init__(self, n):
+            self.n, self.calls = n, 0
+
+        def count(self, index, body):
+            self.calls += 1
+            return {"count": self.n}
+
+    monkeypatch.setattr(osr, "_FILTER_COUNTS", osr.TTLCache(maxsize=8, ttl=0))
+    small, big = _Counter(50), _Counter(5_000_000)
+    assert osr._exact_knn_ok(small, "idx", filters) is True
+    assert osr._exact_knn_ok(small, "idx", filters) is True and small.calls == 1
+    assert osr._exact_knn_ok(big, "other", filters) is False
+
+
+class _SnippetClient:
+    def __init__(self):
+        self.bodies = []
+        self.mget_ids = []
+
+    def search(self, index, body):
+        self.bodies.append(body)
+        prefix = "k" if "knn" in body["query"] else "b"
+        return {"hits": {"hits": [
+            {"_id": f"{prefix}{i}", "_score": 1.0, "_source": {"fragment_id": f"{prefix}{i}"},
+             "highlight": {"text": [f"snippet {prefix}{i}"]}}
+            for i in range(3)
+        ]}}
+
+    def mget(self, index, body, _source):
+        self.mget_ids.extend(body["ids"])
+        return {"docs": [{"_id": i, "found": True, "_source": {"text": f"full {i}"}} for i in body["ids"]]}
+
+
+def test_snippet_mode_skips_text_and_hydrates_only_prompt_hits():
+    """Los hits traen un snippet acotado; solo los del prompt recuperan el texto completo"""
+    client = _SnippetClient()
+    hits = osr.hybrid_search(client, "idx", "neumáticos", k=4, query_vector=[0.1],
+                             use_msearch=False, snippet_chars=120)
+    for body in client.bodies:
+        assert "text" not in body["_source"]
+        assert body["highlight"]["fields"]["text"]["no_match_size"] == 120
+    assert all(h["_snippet"] and h["_source"]["text"].startswith("snippet") for h in hits)
+
+    osr.hydrate_hits(client, "idx", hits, n=2)
+    assert client.mget_ids == [h["_id"] for h in hits[:2]]
+    assert [h["_source"]["text"].split()[0] for h in hits] == ["full", "full", "snippet", "snippet"]
+
+
+def test_snippets_are_opt_in_for_hybrid_search_callers(monkeypatch):
+    """Por defecto (LangChain, evaluación) el texto es completo; /classify pide snippets"""
+    from app.config import get_settings
+
+    monkeypatch.setattr(get_settings(), "hybrid_msearch", False)
+    client = _SnippetClient()
+    osr.hybrid_search(client, "idx", "neumáticos", k=2, query_vector=[0.1], use_msearch=False)
+    assert all("highlight" not in b for b in client.bodies)
+
+    client = _SnippetClient()
+    osr.hybrid_search_with_fallback(client, "idx", "neumáticos", k=2, query_vector=[0.1])
+    assert client.bodies and all("highlight" in b for b in client.bodies)
+
+
+def test_rerank_promotes_hs_match_and_overlap_over_first_stage():
+    """El rerank usa código HS, solapamiento de términos, coseno kNN y priors por bucket"""
+    from app.rerank import rerank
+
+    pool = [
+        {"_id": "a", "_score": 0.033, "_source": {"text": "caucho vulcanizado", "bucket": "WCO"}},
+        {"_id": "b", "_score": 0.030, "_source": {"text": "neumáticos radiales nuevos", "hs6": "401110",
+                                                  "bucket": "WCO"}},
+        {"_id": "c", "_score": 0.016, "_source": {"text": "otros", "bucket": "asgard_products"}},
+    ]
+    out = rerank("neumáticos radiales 4011.10", pool, 2, query_codes=["4011.10"],
+                 knn_scores={"b": 0.9, "a": 0.8}, weights=[1.0, 1.0, 1.0, 1.0], bucket_priors={})
+    assert [h["_id"] for h in out] == ["b", "a"]
+    assert out[0]["_first_stage_score"] == 0.030
+
+    boosted = rerank("x", pool, 1, weights=[0.0, 0.0, 0.0, 0.0], bucket_priors={"asgard_products": 1.0})
+    assert boosted[0]["_id"] == "c"
+
+
+def test_hybrid_search_reranks_a_wider_pool(monkeypatch):
+    from app.config import get_settings
+
+    monkeypatch.setattr(get_settings(), "rerank_pool", 40)
+    client = _FakeClient()
+    hits = osr.hybrid_search(client, "idx", "neumáticos", k=2, query_vector=[0.1], use_msearch=False,
+                             rerank=True)
+    assert sorted(b["size"] for b in client.bodies) == [40, 40]
+    assert len(hits) == 2 and all("_first_stage_score" in h for h in hits)
+
+
+class _SupportClient:
+    def __init__(self, keyword_hits):
+        self.keyword_hits = keyword_hits
+        self.calls = []
+
+    def search(self, index, body, **params):
+        is_keyword = "constant_score" in body["query"]["bool"]["should"][0]
+        self.calls.append(("keyword" if is_keyword else "text", params))
+        ids = self.keyword_hits if is_keyword else ["t1", "kw1"]
+        return {"hits": {"hits": [_hit(i) for i in ids]}}
+
+
+def test_support_lookup_uses_keyword_fields_first_and_caches_per_code(monkeypatch):
+    """Lookup exacto por campos keyword; texto solo para completar; caché por código"""
+    monkeypatch.setattr(osr, "_SUPPORT_CACHE", None)
+    clauses = osr._code_keyword_clauses("4011.10")
+    assert {"constant_score": {"filter": {"term": {"hs6": "401110"}}, "boost": 3.0}} in clauses
+
+    full = _SupportClient(["kw1", "kw2"])
+    out = osr.retrieve_support_for_code(full, "idx", "4011.10", k=2)
+    assert [r["fragment_id"] for r in out] == ["kw1", "kw2"]
+    assert full.calls == [("keyword", {"request_cache": True})]
+    osr.retrieve_support_for_code(full, "idx", "4011.10", k=2)
+    assert len(full.calls) == 1
+
+    partial = _SupportClient(["kw1"])
+    out = osr.retrieve_support_for_code(partial, "idx", "4011.20", k=3)
+    assert [(r["fragment_id"], r["reason"]) for r in out] == [("kw1", "hs_code_match"), ("t1", "support_for_code")]
+    assert [c[0] for c in partial.calls] == ["keyword", "text"]
+
+
+def test_candidate_codes_and_prefetch_join(monkeypatch):
+    """Códigos visibles en los hits se precargan; el código del LLM se une por hs6"""
+    hits = [
+        {"_id": "1", "_source": {"hs6": "401110"}},
+        {"_id": "2", "_source": {"partida": "40111000000"}},
+        {"_id": "3", "_source": {"subheading": "4011.20"}},
+        {"_id": "4", "_source": {"text": "sin código"}},
+    ]
+    assert osr.candidate_codes(hits, limit=3) == ["4011.10", "4011.20"]
+
+    calls = []
+    monkeypatch.setattr(osr, "retrieve_support_for_code",
+                        lambda client, index, code, k=3: calls.append(code) or [{"fragment_id": code}])
+    prefetched = osr.prefetch_support(object(), "idx", ["4011.10", "4011.20"])
+    assert calls == ["4011.10", "4011.20"]
+    assert osr.match_prefetched(prefetched, "4011.10.00") == [{"fragment_id": "4011.10"}]
+    assert osr.match_prefetched(prefetched, "8471.30") is None